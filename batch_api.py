@@ -0,0 +1,287 @@
+"""Batch API of OpenAI: its HTTP client, an offline fake of it, and a chat model that sends the prompts as batches."""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, List, Iterable
+
+import openai
+import requests
+
+from rate_limit import StubOpenaiBackend
+from token_usage import count_chat_tokens
+from utils import OpenaiChatGpt
+
+BATCH_FINAL_STATUSES = ['completed', 'failed', 'expired', 'cancelled']
+# limits of a single batch of the Batch API
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_BYTES = 200 * 1024 * 1024
+
+
+class OpenaiBatchApi:
+    """
+    Files and Batches endpoints of the OpenAI API, over HTTP since openai<1.0 has no client for them.
+    """
+
+    def __init__(self, api_key: Optional[str] = None, api_base: Optional[str] = None, timeout: float = 600.):
+        self.api_key = api_key if api_key is not None else os.environ["OPENAI_API_KEY"]
+        self.api_base = api_base if api_base is not None else openai.api_base
+        self.timeout = timeout
+
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        response = requests.request(method, f'{self.api_base}{path}',
+                                    headers={'Authorization': f'Bearer {self.api_key}'},
+                                    timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def upload_file(self, path: str) -> str:
+        with open(path, 'rb') as f:
+            return self._request('POST', '/files', files={'file': f}, data={'purpose': 'batch'}).json()['id']
+
+    def create_batch(self, input_file_id: str, endpoint: str = '/v1/chat/completions',
+                     completion_window: str = '24h') -> Dict[str, Any]:
+        return self._request('POST', '/batches', json={'input_file_id': input_file_id,
+                                                       'endpoint': endpoint,
+                                                       'completion_window': completion_window}).json()
+
+    def retrieve_batch(self, batch_id: str) -> Dict[str, Any]:
+        return self._request('GET', f'/batches/{batch_id}').json()
+
+    def download_file(self, file_id: str) -> bytes:
+        return self._request('GET', f'/files/{file_id}/content').content
+
+
+class FakeBatchServer:
+    """
+    Offline stand-in for OpenaiBatchApi, to test the batch mode of the scripts without the API.
+    A batch is answered by chat_completion (a StubOpenaiBackend by default) once processing_seconds have passed
+    since it was created, and the requests of failing_custom_ids end up in its error file.
+    """
+
+    def __init__(self, chat_completion: Optional[StubOpenaiBackend] = None, processing_seconds: float = 0.,
+                 failing_custom_ids: Iterable[str] = ()):
+        self.chat_completion = chat_completion if chat_completion is not None else StubOpenaiBackend(latency=0.)
+        self.processing_seconds = processing_seconds
+        self.failing_custom_ids = set(failing_custom_ids)
+        self._files: Dict[str, bytes] = {}
+        self._batches: Dict[str, Dict[str, Any]] = {}
+        self._created_at: Dict[str, float] = {}
+        # BatchChatGpt polls the batches of its chunks from concurrent threads
+        self._lock = threading.RLock()
+
+    def _add_file(self, content: bytes) -> str:
+        with self._lock:
+            file_id = f'file-{len(self._files)}'
+            self._files[file_id] = content
+            return file_id
+
+    def upload_file(self, path: str) -> str:
+        with open(path, 'rb') as f:
+            return self._add_file(f.read())
+
+    def create_batch(self, input_file_id: str, endpoint: str = '/v1/chat/completions',
+                     completion_window: str = '24h') -> Dict[str, Any]:
+        with self._lock:
+            batch_id = f'batch-{len(self._batches)}'
+            self._batches[batch_id] = {'id': batch_id, 'status': 'in_progress', 'endpoint': endpoint,
+                                       'input_file_id': input_file_id, 'output_file_id': None, 'error_file_id': None}
+            self._created_at[batch_id] = time.monotonic()
+            return dict(self._batches[batch_id])
+
+    def _process(self, batch: Dict[str, Any]) -> None:
+        outputs, errors = [], []
+        for line in self._files[batch['input_file_id']].splitlines():
+            request = json.loads(line)
+            custom_id = request['custom_id']
+            try:
+                if custom_id in self.failing_custom_ids:
+                    raise openai.error.APIError('Fake batch request failure')
+                body = self.chat_completion.create(**request['body'])
+                outputs.append({'custom_id': custom_id, 'response': {'status_code': 200, 'body': body},
+                                'error': None})
+            except Exception as e:
+                errors.append({'custom_id': custom_id, 'response': None,
+                               'error': {'code': type(e).__name__, 'message': str(e)}})
+        batch['output_file_id'] = self._add_file(''.join(json.dumps(o) + '\n' for o in outputs).encode('utf-8'))
+        batch['error_file_id'] = self._add_file(''.join(json.dumps(e) + '\n' for e in errors).encode('utf-8'))
+        batch['request_counts'] = {'total': len(outputs) + len(errors), 'completed': len(outputs),
+                                   'failed': len(errors)}
+        batch['status'] = 'completed'
+
+    def retrieve_batch(self, batch_id: str) -> Dict[str, Any]:
+        with self._lock:
+            batch = self._batches[batch_id]
+            if batch['status'] == 'in_progress' and \
+                    time.monotonic() - self._created_at[batch_id] >= self.processing_seconds:
+                self._process(batch)
+            return dict(batch)
+
+    def download_file(self, file_id: str) -> bytes:
+        return self._files[file_id]
+
+
+class BatchChatGpt:
+    """
+    Sends the single-turn prompts of a fold as jobs of the Batch API, instead of one request each.
+    The requests of model (engine, system prompt, sampling parameters) get a custom id per prompt and are split
+    into chunks within the limits of a batch (max_batch_requests requests, an input file of max_batch_bytes).
+    Each chunk is submitted as a batch, and the batches are polled every poll_interval seconds until they are done;
+    the responses are then joined back to the prompts by custom id.
+
+    The batches of chunk c are recorded in <work_dir>/batch_<c>.json, so a restarted script polls the same batches
+    instead of submitting them again. A batch that failed, was cancelled or expired keeps the responses it has,
+    and its unanswered requests are resubmitted as a new batch, up to max_submissions batches per chunk.
+    Prompts answered by the response cache of model are not submitted, and the ones that still fail are sent
+    with the interactive model instead.
+    """
+
+    def __init__(self, model: OpenaiChatGpt, batch_api: Any, work_dir: str, poll_interval: float = 60.,
+                 completion_window: str = '24h', max_batch_requests: int = MAX_BATCH_REQUESTS,
+                 max_batch_bytes: int = MAX_BATCH_BYTES, max_submissions: int = 3):
+        self.model = model
+        self.batch_api = batch_api
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+        self.max_batch_requests = max_batch_requests
+        self.max_batch_bytes = max_batch_bytes
+        self.max_submissions = max_submissions
+
+    @staticmethod
+    def _get_input_lines(requests_by_id: Dict[str, Dict[str, Any]]) -> Dict[str, str]:
+        return {custom_id: json.dumps({'custom_id': custom_id,
+                                       'method': 'POST',
+                                       'url': '/v1/chat/completions',
+                                       'body': request}) + '\n'
+                for custom_id, request in requests_by_id.items()}
+
+    def _split(self, requests_by_id: Dict[str, Dict[str, Any]]) -> List[Dict[str, Dict[str, Any]]]:
+        chunks, chunk, chunk_bytes = [], {}, 0
+        for custom_id, line in self._get_input_lines(requests_by_id).items():
+            line_bytes = len(line.encode('utf-8'))
+            if len(chunk) > 0 and (len(chunk) == self.max_batch_requests or
+                                   chunk_bytes + line_bytes > self.max_batch_bytes):
+                chunks.append(chunk)
+                chunk, chunk_bytes = {}, 0
+            chunk[custom_id] = requests_by_id[custom_id]
+            chunk_bytes += line_bytes
+        if len(chunk) > 0:
+            chunks.append(chunk)
+        return chunks
+
+    def _submit(self, chunk_id: int, requests_by_id: Dict[str, Dict[str, Any]]) -> str:
+        input_path = os.path.join(self.work_dir, f'batch_input_{chunk_id:04d}.jsonl')
+        with open(input_path, 'w') as f:
+            f.write(''.join(self._get_input_lines(requests_by_id).values()))
+        input_file_id = self.batch_api.upload_file(input_path)
+        batch = self.batch_api.create_batch(input_file_id, completion_window=self.completion_window)
+        print(f'Submitted batch {batch["id"]} of chunk {chunk_id} ({len(requests_by_id)} requests)')
+        return batch['id']
+
+    def _wait(self, batch_id: str) -> Dict[str, Any]:
+        while True:
+            batch = self.batch_api.retrieve_batch(batch_id)
+            if batch['status'] in BATCH_FINAL_STATUSES:
+                return batch
+            print(f'Batch {batch_id} is {batch["status"]}: {batch.get("request_counts")}')
+            time.sleep(self.poll_interval)
+
+    def _read_responses(self, batch: Dict[str, Any],
+                        requests_by_id: Dict[str, Dict[str, Any]]) -> Dict[str, Optional[str]]:
+        # a failed, cancelled or expired batch may still have the output of the requests it completed
+        responses = {}
+        for file_id in [batch.get('output_file_id'), batch.get('error_file_id')]:
+            if file_id is None:
+                continue
+            for line in self.batch_api.download_file(file_id).decode('utf-8').splitlines():
+                record = json.loads(line)
+                response = record.get('response')
+                if response is not None and response['status_code'] == 200:
+                    completion = response['body']['choices'][0]['message']['content']
+                    prompt_tokens = count_chat_tokens(requests_by_id[record['custom_id']]['messages'],
+                                                      self.model.engine)
+                    self.model._add_usage(response['body'], prompt_tokens, completion)
+                    responses[record['custom_id']] = completion
+                else:
+                    responses[record['custom_id']] = None
+        return responses
+
+    def _run_chunk(self, chunk_id: int, requests_by_id: Dict[str, Dict[str, Any]]) -> Dict[str, Optional[str]]:
+        state_path = os.path.join(self.work_dir, f'batch_{chunk_id:04d}.json')
+        input_digest = hashlib.sha256(''.join(self._get_input_lines(requests_by_id).values()).encode('utf-8')
+                                      ).hexdigest()
+        # ids of the batches submitted for the chunk, in order, each one with the unanswered requests of the last
+        batch_ids = []
+        if os.path.exists(state_path):
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+            if state['input_digest'] == input_digest:
+                batch_ids = state['batch_ids']
+
+        responses = {}
+        pending = requests_by_id
+        for submission in range(self.max_submissions):
+            if submission < len(batch_ids):
+                print(f'Resuming batch {batch_ids[submission]} of chunk {chunk_id}')
+            else:
+                batch_ids.append(self._submit(chunk_id, pending))
+                with open(state_path + '.tmp', 'w') as f:
+                    json.dump({'input_digest': input_digest, 'batch_ids': batch_ids}, f)
+                os.replace(state_path + '.tmp', state_path)
+
+            batch = self._wait(batch_ids[submission])
+            responses.update(self._read_responses(batch, requests_by_id))
+            pending = {custom_id: request for custom_id, request in pending.items()
+                       if responses.get(custom_id) is None}
+            # the requests that failed in a completed batch fail on their own, they are sent interactively
+            if batch['status'] == 'completed' or len(pending) == 0:
+                break
+            logging.warning(f'Batch {batch_ids[submission]} is {batch["status"]}, '
+                            f'{len(pending)} of its requests are unanswered.')
+        return responses
+
+    def _run_batch(self, requests_by_id: Dict[str, Dict[str, Any]]) -> Dict[str, Optional[str]]:
+        os.makedirs(self.work_dir, exist_ok=True)
+        chunks = self._split(requests_by_id)
+        # the batches of all chunks are processed at the same time, a thread polls each one
+        with ThreadPoolExecutor(max_workers=len(chunks), thread_name_prefix='batch') as executor:
+            chunk_responses = list(executor.map(self._run_chunk, range(len(chunks)), chunks))
+        return {custom_id: response for responses in chunk_responses for custom_id, response in responses.items()}
+
+    def get_responses(self, contents: Dict[str, str]) -> Dict[str, Optional[str]]:
+        """
+        :param contents: prompt of every custom id
+        :return: response of every custom id, None if it failed both in the batch and interactively
+        """
+        response_cache = self.model.response_cache
+        requests_by_id = {custom_id: self.model._get_chat_request(self.model._get_chat_messages(content))
+                          for custom_id, content in contents.items()}
+
+        responses = {}
+        if response_cache is not None:
+            for custom_id, request in requests_by_id.items():
+                cached_response = response_cache.get(request)
+                if cached_response is not None:
+                    self.model.token_usage.add_response_cache_hit()
+                    responses[custom_id] = cached_response
+        pending = {custom_id: request for custom_id, request in requests_by_id.items() if custom_id not in responses}
+        if len(pending) == 0:
+            return responses
+
+        batch_responses = self._run_batch(pending)
+        num_failed = 0
+        for custom_id, request in pending.items():
+            response = batch_responses.get(custom_id)
+            if response is None:
+                num_failed += 1
+                response = self.model.create_response(contents[custom_id])
+                self.model.clear_chat_memory()
+            elif response_cache is not None:
+                response_cache.put(request, response)
+            responses[custom_id] = response
+        print(f'Batch: {len(pending) - num_failed} responses, {num_failed} failed requests sent interactively')
+        return responses
@@ -0,0 +1,52 @@
+"""Concurrent multi-turn conversations, one chat model each."""
+import queue
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Iterable, Iterator, Optional, TypeVar
+
+from utils import ChatLanguageModel
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+class ConversationPool:
+    """
+    Runs multi-turn conversations concurrently on a thread pool.
+    Every in-flight conversation borrows one of the num_conversations models of model_factory, so that it has
+    its own chat memory, which is cleared when the conversation ends. Build the models with the same rate limiter
+    and response cache (the default rate limiter is already shared by every model of the same engine).
+    """
+
+    def __init__(self, model_factory: Callable[[], ChatLanguageModel], num_conversations: int = 8):
+        self.num_conversations = num_conversations
+        self._models = queue.Queue()
+        for _ in range(num_conversations):
+            self._models.put(model_factory())
+
+    def _run_conversation(self, conversation: Callable[[ChatLanguageModel, T], R], item: T) -> R:
+        model = self._models.get()
+        try:
+            return conversation(model, item)
+        finally:
+            model.clear_chat_memory()
+            self._models.put(model)
+
+    def imap(self, conversation: Callable[[ChatLanguageModel, T], R], items: Iterable[T],
+             max_pending: Optional[int] = None) -> Iterator[R]:
+        """
+        :param conversation: runs the turns of the conversation about an item with a model, e.g.
+                             critique_moral_confounders.iterative_create_response
+        :param max_pending: number of items read ahead of the results, 2 * num_conversations by default;
+                            items is read lazily, so a large or lazy input is not held in memory
+        :return: results of the conversations, in the order of the items, as soon as they are done
+        """
+        max_pending = max_pending if max_pending is not None else 2 * self.num_conversations
+        with ThreadPoolExecutor(max_workers=self.num_conversations, thread_name_prefix='conversation') as executor:
+            futures: Deque[Future] = deque()
+            for item in items:
+                if len(futures) >= max_pending:
+                    yield futures.popleft().result()
+                futures.append(executor.submit(self._run_conversation, conversation, item))
+            while len(futures) > 0:
+                yield futures.popleft().result()
@@ -0,0 +1,90 @@
+"""Append-only, resumable output for the data collection fold scripts."""
+import json
+import os
+import time
+from typing import List, Dict, Any, Optional, Set
+
+
+class FoldCheckpoint:
+    """
+    Every finished item is appended to `<output>.jsonl` as {"key": ..., "output": ...} right away, and
+    `<output>.manifest.json` tracks the progress. A restarted fold skips the keys that are already done;
+    finalize() returns the outputs in the order they were appended, i.e. the order of the input items.
+
+    :param output_path: path of the final json file the script writes, e.g. dataset_coco_fold0.json
+    """
+
+    def __init__(self, output_path: str, num_total: Optional[int] = None):
+        base_path = output_path[:-len('.json')] if output_path.endswith('.json') else output_path
+        self.jsonl_path = base_path + '.jsonl'
+        self.manifest_path = base_path + '.manifest.json'
+        self.num_total = num_total
+        self._done_keys: Set[str] = set()
+        self._num_since_manifest = 0
+        self._load()
+        self._file = open(self.jsonl_path, 'a')
+
+    def _load(self) -> None:
+        if not os.path.exists(self.jsonl_path):
+            return
+        valid_size = 0
+        with open(self.jsonl_path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a line torn by a crash, everything after it is dropped
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                self._done_keys.add(record['key'])
+                valid_size += len(line)
+        if valid_size != os.path.getsize(self.jsonl_path):
+            with open(self.jsonl_path, 'r+b') as f:
+                f.truncate(valid_size)
+        if len(self._done_keys) > 0:
+            print(f'Resuming from {self.jsonl_path}: {len(self._done_keys)} items already done')
+
+    @property
+    def num_done(self) -> int:
+        return len(self._done_keys)
+
+    def is_done(self, key: Any) -> bool:
+        return str(key) in self._done_keys
+
+    def append(self, key: Any, output: Any) -> None:
+        key = str(key)
+        self._file.write(json.dumps({'key': key, 'output': output}) + '\n')
+        self._file.flush()
+        self._done_keys.add(key)
+        self._num_since_manifest += 1
+        if self._num_since_manifest >= 10:
+            self._write_manifest(finished=False)
+
+    def _write_manifest(self, finished: bool) -> None:
+        manifest = {'jsonl_path': self.jsonl_path,
+                    'num_done': self.num_done,
+                    'num_total': self.num_total,
+                    'finished': finished,
+                    'updated_at': time.strftime('%Y-%m-%d %H:%M:%S')}
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+        self._num_since_manifest = 0
+
+    def finalize(self) -> List[Dict[str, Any]]:
+        """
+        :return: all outputs of the fold, including the ones of earlier (interrupted) runs
+        """
+        return list(self.finalize_by_key().values())
+
+    def finalize_by_key(self) -> Dict[str, Any]:
+        """
+        :return: the outputs of finalize, by key
+        """
+        self._file.close()
+        self._write_manifest(finished=True)
+        with open(self.jsonl_path, 'r') as f:
+            records = [json.loads(line) for line in f]
+        return {record['key']: record['output'] for record in records}
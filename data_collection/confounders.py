@@ -0,0 +1,164 @@
+"""Parsing of the generated moral confounders into validated (action, contrastive image, reason) records.
+
+A generated response is either a JSON object {"confounders": [{"action", "contrastive_image", "reason"}, ...]},
+as asked for by the structured output mode of generate_moral_confounders.py, or the free-form numbered list of
+its USER_PROMPT, "1. Action: ..., Contrastive Image: ..., Reason: ...", one confounder per line. The complete
+confounders of a JSON that does not decode, e.g. cut at max_tokens, are still read one by one, and a response
+without any falls back to the line parser. That one tolerates the usual slips of the free-form format (a missing
+comma, other casing, extra spaces) that the previous split-based parser dropped.
+"""
+import json
+import re
+import threading
+from typing import Any, List, NamedTuple, Optional
+
+CONFOUNDERS_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'confounders': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'action': {'type': 'string'},
+                    'contrastive_image': {'type': 'string'},
+                    'reason': {'type': 'string'},
+                },
+                'required': ['action', 'contrastive_image', 'reason'],
+                'additionalProperties': False,
+            },
+        },
+    },
+    'required': ['confounders'],
+    'additionalProperties': False,
+}
+
+# response_format of the chat completion request, by structured output mode
+RESPONSE_FORMATS = {
+    # JSON mode, the schema is only given in the prompt
+    'json_object': {'type': 'json_object'},
+    # structured outputs, the response follows the schema (needs a model that supports it, e.g. gpt-4o-mini)
+    'json_schema': {'type': 'json_schema',
+                    'json_schema': {'name': 'moral_confounders', 'strict': True, 'schema': CONFOUNDERS_SCHEMA}},
+}
+
+LINE_PATTERN = re.compile(r'^\s*(?:\d+\s*[.)]\s*)?action\s*:\s*(?P<action>.+?)\s*,?\s*'
+                          r'contrastive\s+image\s*:\s*(?P<contrastive_image>.+?)\s*,?\s*'
+                          r'reason\s*:\s*(?P<reason>.+?)\s*$', re.IGNORECASE)
+ACTION_PATTERN = re.compile(r'action\s*:', re.IGNORECASE)
+JSON_BLOCK_PATTERN = re.compile(r'\{.*\}', re.DOTALL)
+# innermost objects, i.e. the confounders, of JSON that does not decode (e.g. cut at max_tokens)
+JSON_OBJECT_PATTERN = re.compile(r'\{[^{}]*\}')
+
+
+class ConfounderRecord(NamedTuple):
+    action: str
+    contrastive_image: str
+    reason: str
+
+    @classmethod
+    def validated(cls, action: Any, contrastive_image: Any, reason: Any) -> Optional['ConfounderRecord']:
+        """
+        :return: the record with its fields stripped, or None if a field is not a non-empty string
+        """
+        fields = [action, contrastive_image, reason]
+        if not all(isinstance(field, str) and len(field.strip()) > 0 for field in fields):
+            return None
+        return cls(*(field.strip() for field in fields))
+
+    @property
+    def generated_example(self) -> str:
+        # format of the examples that are critiqued and judged
+        return f'Image: {self.contrastive_image}\nAction: {self.action}'
+
+
+class ParseResult(NamedTuple):
+    records: List[ConfounderRecord]
+    # confounders of the response that were found but are malformed
+    num_rejected: int
+    # 'json', or 'lines' for the line parser
+    parser: str
+
+
+def _loads(text: str) -> Any:
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return None
+
+
+def _parse_json(response: str) -> Optional[ParseResult]:
+    match = JSON_BLOCK_PATTERN.search(response)
+    data = None if match is None else _loads(match.group(0))
+    items = data.get('confounders') if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        # the complete confounders of a truncated or otherwise broken JSON
+        texts = JSON_OBJECT_PATTERN.findall(response)
+        # and the cut one counts as malformed
+        num_cut = response.count('"action"') - sum(text.count('"action"') for text in texts)
+        items = [_loads(text) for text in texts] + [None] * max(num_cut, 0)
+        if len(texts) == 0:
+            return None
+
+    records = []
+    for item in items:
+        record = None
+        if isinstance(item, dict):
+            record = ConfounderRecord.validated(item.get('action'), item.get('contrastive_image'), item.get('reason'))
+        if record is not None:
+            records.append(record)
+    return ParseResult(records, len(items) - len(records), 'json')
+
+
+def _parse_lines(response: str) -> ParseResult:
+    records = []
+    num_rejected = 0
+    for line in response.split('\n'):
+        match = LINE_PATTERN.match(line)
+        record = None if match is None else ConfounderRecord.validated(**match.groupdict())
+        if record is not None:
+            records.append(record)
+        elif ACTION_PATTERN.search(line):
+            # other lines are the model's comments, not confounders
+            num_rejected += 1
+    return ParseResult(records, num_rejected, 'lines')
+
+
+def parse_confounders(response: Optional[str], continuation: str = '1. Action: ') -> ParseResult:
+    """
+    :param continuation: end of the free-form prompt, which the free-form response continues
+    """
+    if response is None:
+        return ParseResult([], 0, 'lines')
+    if response.lstrip().startswith(('{', '```')):
+        result = _parse_json(response)
+        if result is not None:
+            return result
+    return _parse_lines(continuation + response)
+
+
+class ParseStats:
+    """Parse outcomes of the generated responses, shared by the threads that parse them."""
+
+    def __init__(self):
+        self.num_responses = 0
+        self.num_json = 0
+        self.num_records = 0
+        self.num_rejected = 0
+        self.num_unparsed_responses = 0
+        self._lock = threading.Lock()
+
+    def add(self, result: ParseResult) -> None:
+        with self._lock:
+            self.num_responses += 1
+            self.num_json += int(result.parser == 'json')
+            self.num_records += len(result.records)
+            self.num_rejected += result.num_rejected
+            self.num_unparsed_responses += int(len(result.records) == 0)
+
+    def summary(self, name: str) -> str:
+        with self._lock:
+            success_rate = self.num_records / max(self.num_records + self.num_rejected, 1)
+            return (f'{name}: {self.num_records} confounders parsed from {self.num_responses} responses '
+                    f'({self.num_json} as JSON), {self.num_rejected} malformed ({success_rate:.1%} parse success), '
+                    f'{self.num_unparsed_responses} responses without any confounder to regenerate')
@@ -0,0 +1,121 @@
+"""Near-duplicate detection of generated examples with MinHash and LSH.
+
+Two examples are near-duplicates if the Jaccard similarity of their sets of character shingles (after lowercasing
+and stripping punctuation) is at least a threshold, e.g. "Action: Cutting the cake\nImage: A museum" and
+"Action: cut the cake\nImage: a museum." (0.74). LSH over the MinHash signatures finds the candidate pairs without
+comparing every pair, and the exact Jaccard similarity of the candidates decides.
+"""
+import re
+import zlib
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+# Mersenne prime of the universal hash functions (a * x + b) % MERSENNE_PRIME
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r'[^a-z0-9]+', ' ', text.lower()).strip()
+
+
+def get_shingles(text: str, shingle_size: int = 4) -> Set[str]:
+    text = normalize_text(text)
+    if len(text) <= shingle_size:
+        return {text}
+    return {text[i:i + shingle_size] for i in range(len(text) - shingle_size + 1)}
+
+
+def jaccard_similarity(a: Set[str], b: Set[str]) -> float:
+    return len(a & b) / len(a | b)
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = 128, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MERSENNE_PRIME, size=(num_perm, 1), dtype=np.uint64)
+        self.b = rng.integers(0, MERSENNE_PRIME, size=(num_perm, 1), dtype=np.uint64)
+
+    def signature(self, shingles: Set[str]) -> np.ndarray:
+        # crc32, unlike hash(), is the same in every process
+        hashes = np.array([zlib.crc32(shingle.encode('utf-8')) for shingle in shingles], dtype=np.uint64)
+        hashes %= MERSENNE_PRIME
+        return ((self.a * hashes[np.newaxis, :] + self.b) % MERSENNE_PRIME).min(axis=1)
+
+
+class NearDuplicateIndex:
+    """
+    Texts are added one by one; a text is either new, and becomes a representative, or a near-duplicate
+    of an earlier representative.
+
+    The signatures are split into num_bands bands of num_perm / num_bands rows, two texts are candidates if
+    they agree on all rows of a band. With the defaults, a pair of Jaccard similarity 0.7 is a candidate with
+    probability 1 - (1 - 0.7 ** 4) ** 32 > 0.9998.
+    """
+
+    def __init__(self, threshold: float = 0.7, num_perm: int = 128, num_bands: int = 32, shingle_size: int = 4):
+        if num_perm % num_bands != 0:
+            raise ValueError(f'num_perm ({num_perm}) should be a multiple of num_bands ({num_bands})')
+        self.threshold = threshold
+        self.num_bands = num_bands
+        self.rows_per_band = num_perm // num_bands
+        self.shingle_size = shingle_size
+        self.min_hasher = MinHasher(num_perm)
+        self.num_added = 0
+        self._buckets: Dict[Tuple[int, bytes], List[int]] = {}
+        self._shingles: Dict[int, Set[str]] = {}
+
+    def _band_keys(self, signature: np.ndarray) -> List[Tuple[int, bytes]]:
+        return [(band, signature[band * self.rows_per_band:(band + 1) * self.rows_per_band].tobytes())
+                for band in range(self.num_bands)]
+
+    def add(self, text: str) -> Optional[int]:
+        """
+        :return: index (in the order of add) of the representative that text is a near-duplicate of,
+                 or None if text is new
+        """
+        index = self.num_added
+        self.num_added += 1
+        shingles = get_shingles(text, self.shingle_size)
+        band_keys = self._band_keys(self.min_hasher.signature(shingles))
+
+        candidates = {candidate for band_key in band_keys for candidate in self._buckets.get(band_key, [])}
+        best_candidate, best_similarity = None, -1.
+        for candidate in sorted(candidates):
+            similarity = jaccard_similarity(shingles, self._shingles[candidate])
+            if similarity >= self.threshold and similarity > best_similarity:
+                best_candidate, best_similarity = candidate, similarity
+        if best_candidate is not None:
+            return best_candidate
+
+        self._shingles[index] = shingles
+        for band_key in band_keys:
+            self._buckets.setdefault(band_key, []).append(index)
+        return None
+
+    @property
+    def num_duplicates(self) -> int:
+        return self.num_added - len(self._shingles)
+
+
+def deduplicate(texts: List[str], threshold: float = 0.7, **index_kwargs) -> List[int]:
+    """
+    :return: for every text, the index of its representative, the first text of its group of near-duplicates
+    """
+    index = NearDuplicateIndex(threshold=threshold, **index_kwargs)
+    representatives = []
+    for i, text in enumerate(texts):
+        representative = index.add(text)
+        representatives.append(i if representative is None else representative)
+    return representatives
+
+
+def get_duplicate_output(representative_output: Dict[str, Any], source: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    :param source: image_path, image_caption, reason and generated_example of a near-duplicate
+    :return: the output of the near-duplicate, the results of its representative with its own source, and
+             'duplicate_of', the image_caption and generated_example of the representative
+    """
+    return {**representative_output, **source,
+            'duplicate_of': {'image_caption': representative_output['image_caption'],
+                             'generated_example': representative_output['generated_example']}}
@@ -0,0 +1,146 @@
+"""Cache of query embeddings, shared by the retrievers of all datasets."""
+import hashlib
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+from llama_index.embeddings import OpenAIEmbedding
+
+
+def normalize_query(query_str: str) -> str:
+    return re.sub(r'\s+', ' ', query_str).strip().lower()
+
+
+def get_embed_model_name(embed_model) -> str:
+    return getattr(embed_model, 'model_name', None) or type(embed_model).__name__
+
+
+def embed_queries(embed_model, query_strs: List[str]) -> np.ndarray:
+    """
+    :return: float32 array of the query embeddings of query_strs, as the retrieve of llama_index embeds them
+             (get_query_embedding). OpenAIEmbedding embeds the queries with the engine of the texts in its default
+             mode, its queries are then embedded with batched calls.
+    """
+    if isinstance(embed_model, OpenAIEmbedding) and embed_model._query_engine == embed_model._text_engine:
+        return np.array(embed_model.get_text_embedding_batch(query_strs), dtype=np.float32)
+    return np.array([embed_model.get_query_embedding(query_str) for query_str in query_strs], dtype=np.float32)
+
+
+class QueryEmbeddingCache:
+    """
+    Embeddings keyed by (embed model, normalized query), in an in-memory LRU of max_memory_items and,
+    if a path is given, in SQLite so that later runs reuse them. Only the key is normalized (whitespace collapsed,
+    lowercased): a query is embedded as it is, and the descriptions that differ only in case or whitespace share
+    the embedding of the first one.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_memory_items: int = 100000):
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self.hits = 0
+        self.misses = 0
+        self._memory: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending: Dict[str, threading.Event] = {}
+        self._conn = None
+        if path is not None:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS embeddings ('
+                               'key TEXT PRIMARY KEY, '
+                               'embedding BLOB NOT NULL)')
+            self._conn.commit()
+
+    @staticmethod
+    def get_key(model_name: str, normalized_query: str) -> str:
+        # 'query' tells the query embeddings apart from the text embeddings of the normalized queries, which the
+        # stores of earlier versions hold
+        return hashlib.sha256(f'{model_name}\nquery\n{normalized_query}'.encode('utf-8')).hexdigest()
+
+    def _get(self, key: str) -> Optional[np.ndarray]:
+        embedding = self._memory.get(key)
+        if embedding is not None:
+            self._memory.move_to_end(key)
+            return embedding
+        if self._conn is not None:
+            row = self._conn.execute('SELECT embedding FROM embeddings WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                embedding = np.frombuffer(row[0], dtype=np.float32)
+                self._put_memory(key, embedding)
+                return embedding
+        return None
+
+    def _put_memory(self, key: str, embedding: np.ndarray) -> None:
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get_embeddings(self, embed_model, query_strs: List[str]) -> np.ndarray:
+        """
+        :return: float32 array of shape (len(query_strs), dim); the missing queries are embedded
+                 with a single batched call of the embed model, and only by one of the concurrent callers
+        """
+        if len(query_strs) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        model_name = get_embed_model_name(embed_model)
+        keys = [self.get_key(model_name, normalize_query(query_str)) for query_str in query_strs]
+
+        embeddings = {}
+        claimed_keys = set()
+        while True:
+            claimed, waiting = {}, []
+            with self._lock:
+                for key, query_str in zip(keys, query_strs):
+                    if key in embeddings or key in claimed:
+                        continue
+                    embedding = self._get(key)
+                    if embedding is not None:
+                        embeddings[key] = embedding
+                    elif key in self._pending:
+                        # being embedded by another thread, e.g. the retriever of another datatype
+                        waiting.append(self._pending[key])
+                    else:
+                        claimed[key] = query_str
+                        self._pending[key] = threading.Event()
+
+            if len(claimed) > 0:
+                # embedded outside the lock, the retrievers of the other datatypes keep reading the cache
+                try:
+                    new_embeddings = embed_queries(embed_model, list(claimed.values()))
+                    with self._lock:
+                        for key, embedding in zip(claimed.keys(), new_embeddings):
+                            embeddings[key] = embedding
+                            self._put_memory(key, embedding)
+                        if self._conn is not None:
+                            self._conn.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?)',
+                                                   [(key, embedding.tobytes())
+                                                    for key, embedding in zip(claimed.keys(), new_embeddings)])
+                            self._conn.commit()
+                finally:
+                    with self._lock:
+                        for key in claimed:
+                            self._pending.pop(key).set()
+                claimed_keys.update(claimed)
+
+            if len(waiting) == 0:
+                break
+            # look the waited keys up again, they are embedded here if the other thread failed
+            for event in waiting:
+                event.wait()
+
+        with self._lock:
+            self.hits += sum(key not in claimed_keys for key in keys)
+            self.misses += len(claimed_keys)
+
+        return np.stack([embeddings[key] for key in keys])
+
+    def stats(self) -> str:
+        return f'query embedding cache: {self.hits} hits, {self.misses} misses'
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
@@ -0,0 +1,406 @@
+"""Streaming, sharded and resumable embedding of the caption corpora used for image retrieval.
+
+The captions of a datatype are read once, in chunks of `chunk_size` records, and each chunk is written to
+`<output_dir>/chunks/chunk_<c>.jsonl`; `split.json` records the number of chunks. Chunk c belongs to shard
+c % num_shards, and each shard reads only the records of its own chunks and embeds them into
+`<output_dir>/chunks/chunk_<c>.npy`. Shards run in parallel processes and skip chunks that are already
+embedded, so an interrupted build continues where it stopped. Once every shard is done, `complete.json`
+records the number of chunks, and merge_shards adds the chunks, in order, to a single FAISS index.
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import List, Dict, Any, Iterator, Iterable, Optional, Tuple, Union
+
+import faiss
+import numpy as np
+import openai
+
+from rate_limit import call_with_retry, get_rate_limiter
+from token_usage import count_text_tokens
+
+DATATYPES = ['sherlock', 'coco', 'narratives']
+
+
+def get_datapath(datatype: str, root_dir: str) -> str:
+    # same paths as vector_retriever.get_retriever, the index is persisted next to them
+    if datatype == 'sherlock':
+        return f'{root_dir}/sherlock_dataset/sherlock_train_v1_1.json'
+    elif datatype == 'narratives':
+        return f'{root_dir}/openimages_localized_narratives/open_images_train_v6_captions.jsonl'
+    elif datatype == 'coco':
+        return f'{root_dir}/coco/dataset_coco.json'
+    else:
+        raise NotImplementedError
+
+
+def iter_caption_records(datatype: str, root_dir: str) -> Iterator[Dict[str, str]]:
+    """
+    Yields {'doc_id', 'text', 'image'} for every caption whose image exists, in file order.
+    The jsonl file of narratives is streamed line by line; sherlock and coco are single json documents.
+    """
+    datapath = get_datapath(datatype, root_dir)
+    if datatype == 'sherlock':
+        vis_root = root_dir
+        with open(datapath, 'r') as f:
+            data = json.load(f)
+        for d in data:
+            image_url = d['inputs']['image']['url']
+            input_path_split = image_url.split('/')
+            if input_path_split[-3] == 'vcr1images':
+                input_path_simple = input_path_split[-3] + "/" + input_path_split[-2] + "/" + input_path_split[-1]
+                image_path = os.path.join(vis_root, input_path_simple)
+            else:
+                input_path_simple = input_path_split[-2] + "/" + input_path_split[-1]
+                image_path = os.path.join(vis_root, "vg/images", input_path_simple)
+
+            if not os.path.exists(image_path):
+                print(image_path)
+                continue
+
+            yield {'doc_id': d['instance_id'], 'text': d['targets']['inference'], 'image': str(image_path)}
+    elif datatype == 'narratives':
+        image_dir = f'{root_dir}/image-captioning/openimages_v6_images'
+        with open(datapath, 'r') as f:
+            for line in f:
+                data = json.loads(line.strip())
+                image_path = Path(image_dir) / f'{data["image_id"]}.jpg'
+                if not image_path.exists():
+                    print(image_path)
+                    continue
+
+                yield {'doc_id': data['image_id'], 'text': data['caption'], 'image': str(image_path)}
+    elif datatype == 'coco':
+        image_dir = f'{root_dir}/coco'
+        with open(datapath, 'r') as f:
+            images = json.load(f)['images']
+        for image in images:
+            image_path = Path(image_dir) / image['filepath'] / image['filename']
+            if not image_path.exists():
+                print(image_path)
+                continue
+
+            for sentence in image['sentences']:
+                yield {'doc_id': f'{sentence["imgid"]}_{sentence["sentid"]}',
+                       'text': sentence['raw'],
+                       'image': str(image_path)}
+    else:
+        raise NotImplementedError
+
+
+def iter_chunks(records: Iterable[Dict[str, str]], chunk_size: int) -> Iterator[List[Dict[str, str]]]:
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+class Embedder(ABC):
+    name: str
+    dim: int
+
+    @abstractmethod
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        """
+        :return: float32 array of shape (len(texts), dim)
+        """
+        raise NotImplementedError
+
+
+class OpenaiEmbedder(Embedder):
+    """OpenAI embeddings, `batch_size` texts per request, through the rate limiter of the engine."""
+    name = 'openai'
+
+    def __init__(self, engine: str = 'text-embedding-ada-002', dim: int = 1536, batch_size: int = 1000):
+        self.engine = engine
+        self.dim = dim
+        self.batch_size = batch_size
+        self.rate_limiter = get_rate_limiter(engine)
+
+    def _create_embeddings(self, texts: List[str]) -> List[List[float]]:
+        self.rate_limiter.acquire(sum(count_text_tokens(text, self.engine) for text in texts))
+        response = openai.Embedding.create(input=texts, engine=self.engine)
+        return [d['embedding'] for d in sorted(response['data'], key=lambda d: d['index'])]
+
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        embeddings = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = [text.replace('\n', ' ') for text in texts[start:start + self.batch_size]]
+            batch_embeddings = call_with_retry(lambda: self._create_embeddings(batch), self.rate_limiter)
+            if batch_embeddings is None:
+                raise RuntimeError(f'Failed to embed {len(batch)} texts with {self.engine}')
+            embeddings.extend(batch_embeddings)
+        return np.array(embeddings, dtype=np.float32).reshape(len(texts), self.dim)
+
+
+class HashingEmbedder(Embedder):
+    """
+    Local, deterministic embedding for offline runs and tests: signed feature hashing of the lowercased
+    words, L2 normalized. It is no substitute for the OpenAI embeddings in retrieval quality.
+    """
+    name = 'hashing'
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in re.findall(r'\w+', text.lower()):
+                digest = int.from_bytes(hashlib.md5(word.encode('utf-8')).digest()[:8], 'little')
+                embeddings[i, digest % self.dim] += 1. if (digest >> 63) & 1 else -1.
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+
+EMBEDDERS = {'openai': OpenaiEmbedder, 'hashing': HashingEmbedder}
+# the embedder of a persisted index, its queries have to be embedded with the same one
+EMBEDDER_FNAME = 'embedder.json'
+
+
+def get_embedder(name: str, **kwargs) -> Embedder:
+    if name not in EMBEDDERS:
+        raise NotImplementedError(f'Unknown embedder {name}, choose one of {list(EMBEDDERS)}')
+    return EMBEDDERS[name](**kwargs)
+
+
+def write_embedder_info(persist_dir: Union[str, Path], embedder_name: str, dim: int) -> None:
+    with open(Path(persist_dir) / EMBEDDER_FNAME, 'w') as f:
+        json.dump({'embedder': embedder_name, 'dim': dim}, f, indent=2)
+
+
+def read_embedder_info(persist_dir: Union[str, Path]) -> Dict[str, Any]:
+    """
+    :return: {'embedder', 'dim'} of the index in persist_dir, the OpenAI embeddings for the indexes persisted
+        before the embedder was recorded
+    """
+    embedder_path = Path(persist_dir) / EMBEDDER_FNAME
+    if not embedder_path.exists():
+        return {'embedder': 'openai', 'dim': OpenaiEmbedder().dim}
+    with open(embedder_path, 'r') as f:
+        return json.load(f)
+
+
+def _chunk_paths(output_dir: Path, chunk_id: int) -> Tuple[Path, Path]:
+    return output_dir / 'chunks' / f'chunk_{chunk_id:06d}.jsonl', output_dir / 'chunks' / f'chunk_{chunk_id:06d}.npy'
+
+
+def _check_manifest(output_dir: Path, manifest: Dict[str, Any]) -> None:
+    """Writes the build settings, or checks that a resumed build uses the same ones."""
+    manifest_path = output_dir / 'manifest.json'
+    if manifest_path.exists():
+        with open(manifest_path, 'r') as f:
+            existing_manifest = json.load(f)
+        if existing_manifest != manifest:
+            raise ValueError(f'{output_dir} was built with {existing_manifest}, not {manifest}. '
+                             f'Use another output directory, or remove it to rebuild.')
+        return
+    (output_dir / 'chunks').mkdir(parents=True, exist_ok=True)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def _write_records(records_path: Path, records: List[Dict[str, str]]) -> None:
+    with open(f'{records_path}.tmp', 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    os.replace(f'{records_path}.tmp', records_path)
+
+
+def _read_records(records_path: Path) -> List[Dict[str, str]]:
+    with open(records_path, 'r') as f:
+        return [json.loads(line) for line in f]
+
+
+def split_chunks(datatype: str, root_dir: str, output_dir: str, chunk_size: int) -> int:
+    """
+    Writes the records of every chunk, in one streamed pass over the corpus, so that the shards do not
+    read and parse the whole corpus each. Skipped if the corpus is already split.
+    :return: number of chunks of the whole corpus
+    """
+    split_path = Path(output_dir) / 'split.json'
+    if split_path.exists():
+        with open(split_path, 'r') as f:
+            return json.load(f)['num_chunks']
+
+    num_chunks = 0
+    for chunk_id, chunk in enumerate(iter_chunks(iter_caption_records(datatype, root_dir), chunk_size)):
+        _write_records(_chunk_paths(Path(output_dir), chunk_id)[0], chunk)
+        num_chunks = chunk_id + 1
+    with open(split_path, 'w') as f:
+        json.dump({'num_chunks': num_chunks}, f)
+    return num_chunks
+
+
+def build_shard(output_dir: str, shard_id: int, num_shards: int, num_chunks: int, embedder_name: str) -> int:
+    """
+    Embeds the chunks of one shard that are not embedded yet, reading only their records.
+    :return: number of chunks embedded by this call
+    """
+    output_dir = Path(output_dir)
+    embedder = get_embedder(embedder_name)
+    num_embedded = 0
+    for chunk_id in range(shard_id, num_chunks, num_shards):
+        records_path, embeddings_path = _chunk_paths(output_dir, chunk_id)
+        if embeddings_path.exists():
+            continue
+
+        chunk = _read_records(records_path)
+        embeddings = embedder.embed_texts([record['text'] for record in chunk])
+        # the .npy file is renamed into place last, its presence marks the chunk as done
+        with open(f'{embeddings_path}.tmp', 'wb') as f:
+            np.save(f, embeddings)
+        os.replace(f'{embeddings_path}.tmp', embeddings_path)
+        num_embedded += 1
+        print(f'[shard {shard_id}] embedded chunk {chunk_id} ({len(chunk)} captions)')
+    return num_embedded
+
+
+def build_shards(datatype: str, root_dir: str, output_dir: str, num_shards: int = 1, workers: int = 1,
+                 chunk_size: int = 10000, embedder_name: str = 'openai') -> int:
+    """
+    Splits the corpus into chunks, then embeds every shard, `workers` shards at a time in separate processes.
+    :return: number of chunks embedded by this call, 0 if the build was already complete
+    """
+    _check_manifest(Path(output_dir), {'datatype': datatype, 'embedder': embedder_name,
+                                       'num_shards': num_shards, 'chunk_size': chunk_size})
+    num_chunks = split_chunks(datatype, root_dir, output_dir, chunk_size)
+    shard_args = [(output_dir, shard_id, num_shards, num_chunks, embedder_name) for shard_id in range(num_shards)]
+    if workers <= 1:
+        results = [build_shard(*args) for args in shard_args]
+    else:
+        with multiprocessing.Pool(processes=min(workers, num_shards)) as pool:
+            results = pool.starmap(build_shard, shard_args)
+
+    with open(Path(output_dir) / 'complete.json', 'w') as f:
+        json.dump({'num_chunks': num_chunks}, f)
+    return sum(results)
+
+
+def _get_num_chunks(output_dir: Path) -> int:
+    if not (output_dir / 'complete.json').exists():
+        raise ValueError(f'The build in {output_dir} is not complete, run build_shards again to resume it')
+    with open(output_dir / 'complete.json', 'r') as f:
+        return json.load(f)['num_chunks']
+
+
+def iter_chunk_records(output_dir: str) -> Iterator[List[Dict[str, str]]]:
+    """
+    Yields the records of every chunk in order, i.e. in the order of the vectors of merge_shards.
+    """
+    output_dir = Path(output_dir)
+    for chunk_id in range(_get_num_chunks(output_dir)):
+        yield _read_records(_chunk_paths(output_dir, chunk_id)[0])
+
+
+def iter_embedded_chunks(output_dir: str) -> Iterator[np.ndarray]:
+    """
+    Yields the embeddings of every chunk in order, memory-mapped.
+    """
+    output_dir = Path(output_dir)
+    for chunk_id in range(_get_num_chunks(output_dir)):
+        yield np.load(_chunk_paths(output_dir, chunk_id)[1], mmap_mode='r')
+
+
+def load_embeddings(output_dir: str) -> np.ndarray:
+    """
+    :return: the embeddings of all chunks in one array, in index order
+    """
+    output_dir = Path(output_dir)
+    return np.concatenate([np.load(_chunk_paths(output_dir, chunk_id)[1], mmap_mode='r')
+                           for chunk_id in range(_get_num_chunks(output_dir))]).astype(np.float32)
+
+
+def sample_training_vectors(output_dir: str, train_size: int, seed: int = 0) -> np.ndarray:
+    """
+    :return: up to train_size embeddings sampled uniformly from all chunks, to train the IVF/PQ/SQ indexes
+    """
+    output_dir = Path(output_dir)
+    chunk_embeddings = [np.load(_chunk_paths(output_dir, chunk_id)[1], mmap_mode='r')
+                        for chunk_id in range(_get_num_chunks(output_dir))]
+    offsets = np.r_[0, np.cumsum([len(embeddings) for embeddings in chunk_embeddings])]
+    sample = np.sort(np.random.default_rng(seed).choice(offsets[-1], min(train_size, offsets[-1]), replace=False))
+    chunk_ids = np.searchsorted(offsets, sample, side='right') - 1
+    return np.stack([chunk_embeddings[c][i - offsets[c]] for c, i in zip(chunk_ids, sample)]).astype(np.float32)
+
+
+# index_type -> faiss index factory string; scores are L2 distances for all of them, like the flat index
+INDEX_TYPES = {
+    'flat': 'Flat',
+    'ivf_flat': 'IVF{nlist},Flat',
+    'ivf_pq': 'IVF{nlist},PQ{pq_m}',
+    'hnsw': 'HNSW{hnsw_m}',
+    'sq_fp16': 'SQfp16',
+    'sq_int8': 'SQ8',
+}
+
+
+def create_faiss_index(index_type: str, dim: int,
+                       nlist: int = 1024, pq_m: int = 64, hnsw_m: int = 32) -> faiss.Index:
+    """
+    :param nlist: number of IVF cells
+    :param pq_m: number of PQ sub-quantizers (bytes per vector), must divide dim
+    :param hnsw_m: number of HNSW neighbors per node
+    """
+    if index_type not in INDEX_TYPES:
+        raise NotImplementedError(f'Unknown index type {index_type}, choose one of {list(INDEX_TYPES)}')
+    return faiss.index_factory(dim, INDEX_TYPES[index_type].format(nlist=nlist, pq_m=pq_m, hnsw_m=hnsw_m))
+
+
+def set_search_params(faiss_index: faiss.Index,
+                      nprobe: Optional[int] = None, ef_search: Optional[int] = None) -> None:
+    """Query time accuracy/speed knobs: IVF cells visited per query, and the HNSW search beam width."""
+    parameter_space = faiss.ParameterSpace()
+    if nprobe is not None and faiss.try_extract_index_ivf(faiss_index) is not None:
+        parameter_space.set_index_parameter(faiss_index, 'nprobe', nprobe)
+    if ef_search is not None and hasattr(faiss_index, 'hnsw'):
+        parameter_space.set_index_parameter(faiss_index, 'efSearch', ef_search)
+
+
+def has_exact_distances(faiss_index: faiss.Index) -> bool:
+    """
+    Whether the distances of the results are exact, i.e. the vectors are stored uncompressed (flat, ivf_flat, hnsw).
+    The PQ/SQ codes of ivf_pq, sq_fp16 and sq_int8 only give approximate distances.
+    """
+    ivf_index = faiss.try_extract_index_ivf(faiss_index)
+    if ivf_index is not None:
+        return isinstance(faiss.downcast_index(ivf_index), faiss.IndexIVFFlat)
+    if hasattr(faiss_index, 'hnsw'):
+        return isinstance(faiss.downcast_index(faiss_index.storage), faiss.IndexFlat)
+    return isinstance(faiss_index, faiss.IndexFlat)
+
+
+def train_faiss_index(faiss_index: faiss.Index, train_vectors: np.ndarray) -> None:
+    if faiss_index.is_trained:
+        return
+    ivf_index = faiss.try_extract_index_ivf(faiss_index)
+    if ivf_index is not None and len(train_vectors) < ivf_index.nlist:
+        raise ValueError(f'{len(train_vectors)} training vectors are not enough for {ivf_index.nlist} IVF cells, '
+                         f'use a smaller nlist')
+    faiss_index.train(train_vectors)
+
+
+def merge_shards(output_dir: str, index_type: str = 'flat', train_size: int = 100000,
+                 **index_kwargs) -> faiss.Index:
+    """
+    :param index_type: one of INDEX_TYPES, the IVF/PQ/SQ types are trained on train_size sampled embeddings first
+    :param index_kwargs: nlist, pq_m, hnsw_m of create_faiss_index
+    :return: a FAISS index of all chunks, the records of its vectors are those of iter_chunk_records
+    """
+    faiss_index: Optional[faiss.Index] = None
+    for embeddings in iter_embedded_chunks(output_dir):
+        if faiss_index is None:
+            faiss_index = create_faiss_index(index_type, embeddings.shape[1], **index_kwargs)
+            train_faiss_index(faiss_index, sample_training_vectors(output_dir, train_size))
+        faiss_index.add(np.ascontiguousarray(embeddings, dtype=np.float32))
+    if faiss_index is None:
+        raise ValueError(f'No embedded chunks in {output_dir}')
+    return faiss_index
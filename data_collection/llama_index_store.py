@@ -0,0 +1,82 @@
+"""Streaming writers of the llama_index stores of a persisted vector index.
+
+StorageContext.persist serializes a docstore and an index struct that hold every node in memory. These
+write the same docstore.json and index_store.json (the formats of SimpleDocumentStore and SimpleIndexStore,
+which load_index_from_storage reads back) one node at a time, for corpora whose nodes do not fit in memory.
+"""
+import json
+import os
+import shutil
+import uuid
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+from llama_index.constants import DATA_KEY, TYPE_KEY
+from llama_index.data_structs import IndexDict
+from llama_index.schema import BaseNode
+from llama_index.storage.docstore.types import DEFAULT_PERSIST_FNAME as DOCSTORE_FNAME
+from llama_index.storage.docstore.utils import doc_to_json
+from llama_index.storage.index_store.types import DEFAULT_PERSIST_FNAME as INDEX_STORE_FNAME
+
+# collections of the default namespace of the stores
+DOCSTORE_DATA_KEY = 'docstore/data'
+DOCSTORE_METADATA_KEY = 'docstore/metadata'
+INDEX_STORE_DATA_KEY = 'index_store/data'
+
+
+class DocstoreWriter:
+    """Writes the docstore.json of the nodes added, like SimpleDocumentStore.add_documents and persist."""
+
+    def __init__(self, persist_dir: Union[str, Path]):
+        self.path = Path(persist_dir) / DOCSTORE_FNAME
+        # the node data are written in place, their metadata to a side file appended at the end
+        self._file = open(f'{self.path}.tmp', 'w')
+        self._metadata_file = open(f'{self.path}.metadata.tmp', 'w')
+        self._file.write(f'{{{json.dumps(DOCSTORE_DATA_KEY)}: {{')
+        self._num_nodes = 0
+
+    def add(self, node: BaseNode) -> None:
+        separator = ', ' if self._num_nodes > 0 else ''
+        node_id = json.dumps(node.node_id)
+        self._file.write(f'{separator}{node_id}: {json.dumps(doc_to_json(node))}')
+        self._metadata_file.write(f'{separator}{node_id}: {json.dumps({"doc_hash": node.hash})}')
+        self._num_nodes += 1
+
+    def close(self) -> None:
+        self._metadata_file.close()
+        self._file.write(f'}}, {json.dumps(DOCSTORE_METADATA_KEY)}: {{')
+        with open(f'{self.path}.metadata.tmp', 'r') as metadata_file:
+            shutil.copyfileobj(metadata_file, self._file)
+        self._file.write('}}')
+        self._file.close()
+        os.remove(f'{self.path}.metadata.tmp')
+        os.replace(f'{self.path}.tmp', self.path)
+
+    def __enter__(self) -> 'DocstoreWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+def write_index_store(persist_dir: Union[str, Path], node_ids: Iterable[str], index_id: Optional[str] = None) -> str:
+    """
+    Writes the index_store.json of an IndexDict whose node i, i.e. faiss id i, is node_ids[i], without the
+    IndexDict of all nodes in memory.
+    :return: the index id
+    """
+    index_id = index_id or str(uuid.uuid4())
+    path = Path(persist_dir) / INDEX_STORE_FNAME
+    # the index struct is stored as a JSON string (IndexDict.to_json) inside the JSON of the index store,
+    # the pieces of it are escaped one by one
+    escape = lambda text: json.dumps(text)[1:-1]
+    with open(f'{path}.tmp', 'w') as f:
+        f.write(f'{{{json.dumps(INDEX_STORE_DATA_KEY)}: {{{json.dumps(index_id)}: '
+                f'{{{json.dumps(TYPE_KEY)}: {json.dumps(IndexDict.get_type())}, {json.dumps(DATA_KEY)}: "')
+        f.write(escape(f'{{"index_id": {json.dumps(index_id)}, "summary": null, "nodes_dict": {{'))
+        for i, node_id in enumerate(node_ids):
+            f.write(escape(f'{", " if i > 0 else ""}"{i}": {json.dumps(node_id)}'))
+        f.write(escape('}, "doc_id_dict": {}, "embeddings_dict": {}}'))
+        f.write('"}}}')
+    os.replace(f'{path}.tmp', path)
+    return index_id
@@ -0,0 +1,169 @@
+"""Compact, memory-mapped side tables of a persisted retrieval index.
+
+A table of strings is stored as `<name>.bytes.npy` (the UTF-8 bytes of all strings, concatenated) and
+`<name>.offsets.npy` (int64, string i is bytes[offsets[i]:offsets[i + 1]]), and is read without
+loading the llama_index stores or building a Python list of all the strings.
+
+The node store keeps what the retrieval scripts need of every indexed node, by faiss id: its text, and
+its image path as an index into a table of the image paths (COCO has five consecutive captions per image).
+
+Both are written one string at a time, appended to raw files that become the .npy files once complete,
+so that writing them does not hold the strings of the whole corpus in memory.
+"""
+import os
+import shutil
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Iterable, NamedTuple, Optional, Union
+
+import numpy as np
+
+NODE_IDS_NAME = 'node_ids'
+NODE_TEXTS_NAME = 'node_texts'
+IMAGE_PATHS_NAME = 'image_paths'
+NODE_IMAGE_IDS_FNAME = 'node_image_ids.npy'
+
+
+def _table_paths(table_dir: Union[str, Path], name: str):
+    return Path(table_dir) / f'{name}.bytes.npy', Path(table_dir) / f'{name}.offsets.npy'
+
+
+def _write_npy_from_raw(raw_path: str, path: Path, dtype: np.dtype, length: int) -> None:
+    """Writes the .npy file of the 1-d array whose data are in raw_path, and removes raw_path."""
+    with open(f'{path}.tmp', 'wb') as f:
+        np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                 'fortran_order': False, 'shape': (length,)})
+        with open(raw_path, 'rb') as raw_file:
+            shutil.copyfileobj(raw_file, f)
+    os.replace(f'{path}.tmp', path)
+    os.remove(raw_path)
+
+
+class PackedStringsWriter:
+    """Writes a table of packed strings one string at a time, see write_packed_strings."""
+
+    def __init__(self, table_dir: Union[str, Path], name: str):
+        self.bytes_path, self.offsets_path = _table_paths(table_dir, name)
+        self._bytes_file = open(f'{self.bytes_path}.raw', 'wb')
+        self._offsets_file = open(f'{self.offsets_path}.raw', 'wb')
+        self._offsets_file.write(np.int64(0).tobytes())
+        self._num_bytes = 0
+        self._num_strings = 0
+
+    def write(self, s: str) -> None:
+        encoded = s.encode('utf-8')
+        self._bytes_file.write(encoded)
+        self._num_bytes += len(encoded)
+        self._offsets_file.write(np.int64(self._num_bytes).tobytes())
+        self._num_strings += 1
+
+    def __len__(self) -> int:
+        return self._num_strings
+
+    def close(self) -> None:
+        self._bytes_file.close()
+        self._offsets_file.close()
+        # the offsets are written last, their presence marks the table as complete
+        _write_npy_from_raw(f'{self.bytes_path}.raw', self.bytes_path, np.uint8, self._num_bytes)
+        _write_npy_from_raw(f'{self.offsets_path}.raw', self.offsets_path, np.int64, self._num_strings + 1)
+
+    def __enter__(self) -> 'PackedStringsWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+def write_packed_strings(table_dir: Union[str, Path], name: str, strings: Iterable[str]) -> None:
+    with PackedStringsWriter(table_dir, name) as writer:
+        for s in strings:
+            writer.write(s)
+
+
+def packed_strings_exist(table_dir: Union[str, Path], name: str) -> bool:
+    return _table_paths(table_dir, name)[1].exists()
+
+
+class PackedStrings(Sequence):
+    """Read-only sequence of strings over a memory-mapped table of write_packed_strings."""
+
+    def __init__(self, table_dir: Union[str, Path], name: str):
+        bytes_path, offsets_path = _table_paths(table_dir, name)
+        self._bytes = np.load(bytes_path, mmap_mode='r')
+        self._offsets = np.load(offsets_path, mmap_mode='r')
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._bytes[self._offsets[index]:self._offsets[index + 1]].tobytes().decode('utf-8')
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+
+class RetrievedCaption(NamedTuple):
+    text: str
+    image: str
+    score: float
+
+
+class NodeStoreWriter:
+    """Writes the node store one node at a time, in faiss id order."""
+
+    def __init__(self, table_dir: Union[str, Path]):
+        self.node_image_ids_path = Path(table_dir) / NODE_IMAGE_IDS_FNAME
+        self._texts = PackedStringsWriter(table_dir, NODE_TEXTS_NAME)
+        self._image_paths = PackedStringsWriter(table_dir, IMAGE_PATHS_NAME)
+        self._node_image_ids_file = open(f'{self.node_image_ids_path}.raw', 'wb')
+        self._last_image: Optional[str] = None
+
+    def add(self, text: str, image: str) -> None:
+        # the captions of an image are consecutive in every corpus, only a change of image adds a path
+        if image != self._last_image:
+            self._image_paths.write(image)
+            self._last_image = image
+        self._texts.write(text)
+        self._node_image_ids_file.write(np.int32(len(self._image_paths) - 1).tobytes())
+
+    def close(self) -> None:
+        self._texts.close()
+        self._image_paths.close()
+        self._node_image_ids_file.close()
+        # written last, its presence marks the node store as complete
+        _write_npy_from_raw(f'{self.node_image_ids_path}.raw', self.node_image_ids_path, np.int32, len(self._texts))
+
+    def __enter__(self) -> 'NodeStoreWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+def write_node_store(table_dir: Union[str, Path], texts: Iterable[str], images: Iterable[str]) -> None:
+    with NodeStoreWriter(table_dir) as writer:
+        for text, image in zip(texts, images):
+            writer.add(text, image)
+
+
+def node_store_exists(table_dir: Union[str, Path]) -> bool:
+    return (Path(table_dir) / NODE_IMAGE_IDS_FNAME).exists()
+
+
+class NodeStore:
+    """Text and image path of the indexed nodes by faiss id, memory-mapped."""
+
+    def __init__(self, table_dir: Union[str, Path]):
+        self.texts = PackedStrings(table_dir, NODE_TEXTS_NAME)
+        self.image_paths = PackedStrings(table_dir, IMAGE_PATHS_NAME)
+        self._node_image_ids = np.load(Path(table_dir) / NODE_IMAGE_IDS_FNAME, mmap_mode='r')
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def get_image(self, faiss_id: int) -> str:
+        return self.image_paths[int(self._node_image_ids[faiss_id])]
+
+    def get_caption(self, faiss_id: int, score: float) -> RetrievedCaption:
+        return RetrievedCaption(text=self.texts[faiss_id], image=self.get_image(faiss_id), score=score)
@@ -0,0 +1,170 @@
+"""Streaming pipeline of concurrent stages connected by bounded queues."""
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+# marks the end of the stream on a queue
+_END = object()
+
+
+class Stage:
+    """
+    One step of a StreamingPipeline. `fn(state, item)` returns the items to pass on to the next stage:
+    none to drop the item, several to fan out. `setup()` is called once per worker thread, before the stream
+    starts, for the state of that worker (e.g. a chat model, whose chat memory can't be shared), or the worker
+    gets None without a setup.
+    """
+
+    def __init__(self,
+                 name: str,
+                 fn: Callable[[Any, Any], Iterable[Any]],
+                 num_workers: int = 1,
+                 setup: Optional[Callable[[], Any]] = None):
+        self.name = name
+        self.fn = fn
+        self.num_workers = num_workers
+        self.setup = setup
+
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.num_in = 0
+        self.num_out = 0
+        self.num_errors = 0
+        self.busy_time = 0.
+        self._lock = threading.Lock()
+
+    def record(self, num_out: int, busy_time: float, error: bool) -> None:
+        with self._lock:
+            self.num_in += 1
+            self.num_out += num_out
+            self.num_errors += int(error)
+            self.busy_time += busy_time
+
+
+class StreamingPipeline:
+    """
+    Runs every stage at the same time: each item moves on to the next stage as soon as it is processed,
+    and the bounded queues between the stages keep a fast stage from running far ahead of a slow one.
+    An item whose stage raises is printed and dropped, like the batch scripts do. The setups of all workers run
+    before the first item is read, so run() raises a failing setup before any work is done. If a worker or the
+    input items raise later, the other workers of the stage keep processing, the stream still ends, and run()
+    raises that exception after it.
+    """
+
+    def __init__(self, stages: List[Stage], queue_size: int = 64, report_interval: Optional[float] = 30.):
+        assert len(stages) > 0
+        self.stages = stages
+        self.queue_size = queue_size
+        self.report_interval = report_interval
+        self.stats = [StageStats(stage.name) for stage in stages]
+        self._queues: List[queue.Queue] = []
+        self._start_time = 0.
+        self._errors: List[BaseException] = []
+
+    def _run_worker(self, stage_index: int, state: Any, remaining_workers: List[int], lock: threading.Lock) -> None:
+        stage, stats = self.stages[stage_index], self.stats[stage_index]
+        input_queue, output_queue = self._queues[stage_index], self._queues[stage_index + 1]
+        is_counted = False
+        try:
+            while True:
+                item = input_queue.get()
+                if item is _END:
+                    break
+                start = time.perf_counter()
+                outputs, error = [], False
+                try:
+                    outputs = list(stage.fn(state, item))
+                except Exception as e:
+                    print(f'[{stage.name}] Exception: {e}')
+                    error = True
+                stats.record(len(outputs), time.perf_counter() - start, error)
+                for output in outputs:
+                    output_queue.put(output)
+        except BaseException as e:
+            print(f'[{stage.name}] Worker failed: {e!r}')
+            self._errors.append(e)
+            with lock:
+                remaining_workers[stage_index] -= 1
+                is_counted = True
+                is_last = remaining_workers[stage_index] == 0
+            # the other workers of the stage keep reading the input; without them, it is still read to its end,
+            # so that the previous stage never blocks on a full queue
+            if is_last:
+                while input_queue.get() is not _END:
+                    pass
+        finally:
+            # the last worker of a stage to finish ends the stream of the next stage
+            if not is_counted:
+                with lock:
+                    remaining_workers[stage_index] -= 1
+                    is_last = remaining_workers[stage_index] == 0
+            if is_last:
+                next_workers = self.stages[stage_index + 1].num_workers if stage_index + 1 < len(self.stages) else 1
+                for _ in range(next_workers):
+                    output_queue.put(_END)
+
+    def _feed(self, items: Iterable[Any]) -> None:
+        try:
+            for item in items:
+                self._queues[0].put(item)
+        except BaseException as e:
+            print(f'[input] Failed: {e!r}')
+            self._errors.append(e)
+        finally:
+            for _ in range(self.stages[0].num_workers):
+                self._queues[0].put(_END)
+
+    def _report(self, done: threading.Event) -> None:
+        while not done.wait(self.report_interval):
+            print(self.format_stats())
+
+    def format_stats(self) -> str:
+        elapsed = max(time.perf_counter() - self._start_time, 1e-9)
+        lines = [f'pipeline stats after {elapsed:.1f}s']
+        for stage_index, (stage, stats) in enumerate(zip(self.stages, self.stats)):
+            utilization = stats.busy_time / (elapsed * stage.num_workers)
+            lines.append(f'  {stats.name}: {stats.num_in} in, {stats.num_out} out, {stats.num_errors} errors, '
+                         f'{stats.num_in / elapsed:.2f} items/s, {utilization:.0%} busy, '
+                         f'queue depth {self._queues[stage_index].qsize()}/{self.queue_size}')
+        return '\n'.join(lines)
+
+    def run(self, items: Iterable[Any]) -> Iterator[Any]:
+        """
+        :return: the outputs of the last stage, in the order they are finished
+        """
+        # the output queue of the last stage is unbounded, so that the pipeline never waits for the caller
+        self._queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages] + [queue.Queue()]
+        self.stats = [StageStats(stage.name) for stage in self.stages]
+        self._start_time = time.perf_counter()
+        self._errors = []
+
+        # a failing setup raises here, before the input is read
+        states = [[stage.setup() if stage.setup is not None else None for _ in range(stage.num_workers)]
+                  for stage in self.stages]
+        lock = threading.Lock()
+        remaining_workers = [stage.num_workers for stage in self.stages]
+        threads = [threading.Thread(target=self._feed, args=(items,), daemon=True)]
+        for stage_index, stage_states in enumerate(states):
+            for state in stage_states:
+                threads.append(threading.Thread(target=self._run_worker,
+                                                args=(stage_index, state, remaining_workers, lock), daemon=True))
+        done = threading.Event()
+        if self.report_interval is not None:
+            threads.append(threading.Thread(target=self._report, args=(done,), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self._queues[-1].get()
+                if item is _END:
+                    break
+                yield item
+        finally:
+            done.set()
+        print(self.format_stats())
+        if len(self._errors) > 0:
+            raise self._errors[0]
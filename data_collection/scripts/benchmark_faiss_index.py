@@ -0,0 +1,125 @@
+import argparse
+import csv
+import time
+from pathlib import Path
+
+import faiss
+import numpy as np
+from tabulate import tabulate
+
+from data_collection.index_builder import (DATATYPES, INDEX_TYPES, create_faiss_index, get_datapath, load_embeddings,
+                                           set_search_params, train_faiss_index)
+
+
+def get_recall(retrieved_ids: np.ndarray, exact_ids: np.ndarray) -> float:
+    """
+    :return: mean fraction of the exact top k that is also in the retrieved top k (recall@k)
+    """
+    return float(np.mean([len(np.intersect1d(retrieved, exact)) / len(exact)
+                          for retrieved, exact in zip(retrieved_ids, exact_ids)]))
+
+
+def add_database(faiss_index, embeddings, query_ids):
+    """
+    Adds the embeddings that are not queries, the runs of rows between the sorted query_ids, as views of embeddings
+    instead of a copy of the corpus; the ids of the index are the positions in the database.
+    """
+    for start, end in zip(np.r_[0, query_ids + 1], np.r_[query_ids, len(embeddings)]):
+        if end > start:
+            faiss_index.add(embeddings[start:end])
+
+
+def measure_search(faiss_index, queries, top_k, num_latency_queries):
+    """
+    :return: ids of the batched search, ms per query of the batched search, median ms of single-query searches
+    """
+    start = time.perf_counter()
+    _, retrieved_ids = faiss_index.search(queries, top_k)
+    batch_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    latencies = []
+    for query in queries[:num_latency_queries]:
+        start = time.perf_counter()
+        faiss_index.search(query[np.newaxis, :], top_k)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return retrieved_ids, batch_ms, float(np.median(latencies))
+
+
+if __name__ == '__main__':
+    # recall vs. latency of the faiss index types on held-out captions, against the exact (flat) index
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datatype', type=str, choices=DATATYPES, required=True)
+    parser.add_argument('--root-dir', type=str, required=True)
+    parser.add_argument('--index-types', type=str, nargs='+', choices=list(INDEX_TYPES), default=list(INDEX_TYPES))
+    parser.add_argument('--num-queries', type=int, default=1000,
+                        help='Number of embedded captions held out of the index and used as queries, '
+                             'at most half of them')
+    parser.add_argument('--num-latency-queries', type=int, default=200,
+                        help='Number of queries searched one at a time for the single-query latency')
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--nlist', type=int, default=1024)
+    parser.add_argument('--pq-m', type=int, default=64)
+    parser.add_argument('--hnsw-m', type=int, default=32)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 8, 32, 128],
+                        help='nprobe values to try for the IVF indexes')
+    parser.add_argument('--ef-search', type=int, nargs='+', default=[16, 64, 256],
+                        help='efSearch values to try for the HNSW index')
+    parser.add_argument('--train-size', type=int, default=100000)
+    parser.add_argument('--output-csv-path', type=str, default=None)
+    args = parser.parse_args()
+
+    # embeddings of prepare_llama_index_for_retrieve.py
+    build_dir = Path(get_datapath(args.datatype, args.root_dir)).parent / f'{args.datatype}_index_build'
+    embeddings = load_embeddings(str(build_dir))
+
+    rng = np.random.default_rng(0)
+    # at most half of the captions are held out of the index
+    num_queries = min(args.num_queries, len(embeddings) // 2)
+    query_ids = np.sort(rng.choice(len(embeddings), num_queries, replace=False))
+    queries = embeddings[query_ids]
+    database_ids = np.delete(np.arange(len(embeddings)), query_ids)
+    train_ids = np.sort(rng.choice(database_ids, min(args.train_size, len(database_ids)), replace=False))
+    train_vectors = embeddings[train_ids]
+    dimension = embeddings.shape[1]
+
+    exact_index = create_faiss_index('flat', dimension)
+    add_database(exact_index, embeddings, query_ids)
+    _, exact_ids = exact_index.search(queries, args.top_k)
+
+    header = ['Index', 'Search params', f'Recall@{args.top_k}', 'Batch ms/query', 'Single query ms',
+              'Size (MB)', 'Build (s)']
+    tabulate_data = []
+    for index_type in args.index_types:
+        start = time.perf_counter()
+        faiss_index = create_faiss_index(index_type, dimension,
+                                         nlist=args.nlist, pq_m=args.pq_m, hnsw_m=args.hnsw_m)
+        train_faiss_index(faiss_index, train_vectors)
+        add_database(faiss_index, embeddings, query_ids)
+        build_seconds = time.perf_counter() - start
+        size_mb = len(faiss.serialize_index(faiss_index)) / 2 ** 20
+
+        if index_type in ['ivf_flat', 'ivf_pq']:
+            search_params = [{'nprobe': nprobe} for nprobe in args.nprobe]
+        elif index_type == 'hnsw':
+            search_params = [{'ef_search': ef_search} for ef_search in args.ef_search]
+        else:
+            search_params = [{}]
+
+        for params in search_params:
+            set_search_params(faiss_index, **params)
+            retrieved_ids, batch_ms, single_ms = measure_search(faiss_index, queries, args.top_k,
+                                                                args.num_latency_queries)
+            tabulate_data.append([index_type, ', '.join(f'{k}={v}' for k, v in params.items()) or '-',
+                                  get_recall(retrieved_ids, exact_ids), batch_ms, single_ms, size_mb, build_seconds])
+
+    print(f'{args.datatype}: {len(database_ids)} indexed captions, {len(queries)} held-out queries')
+    print(tabulate(tabulate_data, headers=header, tablefmt='github', floatfmt='.4f'))
+
+    if args.output_csv_path is not None:
+        with open(args.output_csv_path, 'w') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(header)
+            for row in tabulate_data:
+                writer.writerow(row)
+
+        print('Benchmark results saved to {}'.format(args.output_csv_path))
@@ -1,11 +1,16 @@
 import argparse
 import json
 import os
-import time
 from pathlib import Path
 
 from tqdm import tqdm
 
+from conversation_pool import ConversationPool
+from data_collection.checkpoint import FoldCheckpoint
+from data_collection.confounders import ParseStats, parse_confounders
+from data_collection.dedup import deduplicate, get_duplicate_output
+from response_cache import ResponseCache
+from token_usage import TokenUsage, split_prompt_template
 from utils import OpenaiChatGpt
 
 SYSTEM_PROMPT = """You are a succinct and helpful assistant."""
@@ -52,6 +57,9 @@ Response: It is possible, but not likely to happen because it is not safe to eat
 {information}
 Response:"""
 
+# the few-shot examples are a static prefix of every prompt, sent first so that the prompt cache can reuse it
+USER_PROMPT_PREFIX, USER_PROMPT_SUFFIX = split_prompt_template(USER_PROMPT)
+
 REFINE_PROMPT = """I said you need to disregard considerations of morality, and social commonsense regarding the action.
 Is your response meeting the condition?
 If the answer is yes, please say 'yes'. (e.g., "Yes.")
@@ -64,7 +72,7 @@ def iterative_create_response(data_creater, information):
     responses = []
     for i in range(2):
         if i == 0:
-            context = USER_PROMPT.format(information=information)
+            context = USER_PROMPT_SUFFIX.format(information=information)
             response = data_creater.create_response(context)
         elif i == 1:
             context = REFINE_PROMPT
@@ -72,24 +80,72 @@ def iterative_create_response(data_creater, information):
         else:
             raise NotImplementedError
 
-        time.sleep(1)
         responses.append(response)
     return responses
 
 
+def parse_generated_examples(input_response, parse_stats=None):
+    # JSON of the structured output mode, or the free-form lines "1. Action: ..., Contrastive Image: ..., Reason: ..."
+    result = parse_confounders(input_response)
+    if parse_stats is not None:
+        parse_stats.add(result)
+    return [(record.generated_example, record.reason) for record in result.records]
+
+
+def split_possible_actions(outputs):
+    possible_actions = []
+    impossible_actions = []
+    for output in outputs:
+        response = output['response']
+        try:
+            if 'not possible' in response[1].lower():
+                impossible_actions.append(output)
+            else:
+                possible_actions.append(output)
+        except:
+            continue
+    return possible_actions, impossible_actions
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--fold', type=int, required=True)
     parser.add_argument('--root-dir', type=str, required=True)
+    parser.add_argument('--response-cache', type=str, default=None,
+                        help='Path to a sqlite cache of API responses, reused across re-runs')
+    parser.add_argument('--replay', action='store_true',
+                        help='Only read responses from --response-cache, never call the API')
+    parser.add_argument('--dedup-threshold', type=float, default=0.7,
+                        help='Jaccard similarity (of character shingles) from which two parsed examples are '
+                             'near-duplicates, and only the first one is critiqued')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='Critique every parsed example, even the near-duplicates')
+    parser.add_argument('--num-conversations', type=int, default=8,
+                        help='Number of examples critiqued concurrently, each in its own conversation')
     args = parser.parse_args()
 
-    data_creater = OpenaiChatGpt(engine='gpt-3.5-turbo',
-                                 temperatue=0.1,
-                                 topp=0.95,
-                                 frequency_penalty=0.0,
-                                 presence_penalty=0.0)
+    response_cache = None
+    if args.response_cache is not None:
+        response_cache = ResponseCache(args.response_cache, read_only=args.replay)
+
+    # shared by the models of all conversations
+    token_usage = TokenUsage()
+
+    def get_data_creater():
+        data_creater = OpenaiChatGpt(engine='gpt-3.5-turbo',
+                                     temperatue=0.1,
+                                     topp=0.95,
+                                     frequency_penalty=0.0,
+                                     presence_penalty=0.0,
+                                     response_cache=response_cache)
+        data_creater.set_system_prompt(SYSTEM_PROMPT)
+        data_creater.set_prompt_prefix(USER_PROMPT_PREFIX)
+        data_creater.token_usage = token_usage
+        return data_creater
+
+    # the two turns of an example stay in order in its own conversation, the examples run concurrently
+    conversation_pool = ConversationPool(get_data_creater, num_conversations=args.num_conversations)
     root_dir = args.root_dir
-    data_creater.set_system_prompt(SYSTEM_PROMPT)
 
     input_path = f'{root_dir}/turbo_moral_confounders/dataset_coco_fold{args.fold}.json'
     with open(input_path, 'r') as f:
@@ -98,53 +154,55 @@ if __name__ == '__main__':
     gpt_outputs_dir = f'{root_dir}/turbo_moral_confounders/critique'
     Path(gpt_outputs_dir).mkdir(parents=True, exist_ok=True)
 
+    output_path = os.path.join(gpt_outputs_dir, Path(input_path).name)
+    # every output is appended to a jsonl file right away, so a restarted fold continues where it stopped
+    checkpoint = FoldCheckpoint(output_path)
+
+    examples = []
+    parse_stats = ParseStats()
+    for i, data in enumerate(input_datas):
+        for j, (ex, reason) in enumerate(parse_generated_examples(data['response'][0], parse_stats)):
+            examples.append((f'{i}_{j}', {'image_path': data['image_path'],
+                                          'image_caption': data['caption'],
+                                          'reason': reason,
+                                          'generated_example': ex}))
+
+    # near-duplicate examples of different captions are critiqued (and judged) once, with the first one
+    if args.no_dedup:
+        representatives = list(range(len(examples)))
+    else:
+        representatives = deduplicate([source['generated_example'] for _, source in examples],
+                                      threshold=args.dedup_threshold)
+
+    todo = [k for k, (key, _) in enumerate(examples) if representatives[k] == k and not checkpoint.is_done(key)]
+
+    def critique_example(data_creater, k):
+        return iterative_create_response(data_creater, examples[k][1]['generated_example'])
+
+    responses = conversation_pool.imap(critique_example, todo)
+
     outputs = []
 
-    possible_actions = []
-    impossible_actions = []
+    # the responses come in the order of the examples, so the checkpoint (and the output) keeps that order
+    for k, response in zip(todo, tqdm(responses, total=len(todo))):
+        key, source = examples[k]
+        output = {**source,
+                  'response': response}
+        checkpoint.append(key, output)
+        outputs.append(output)
 
-    for data in tqdm(input_datas):
-        image_path = data['image_path']
-        caption = data['caption']
-        input_response = data['response'][0]
-        input_response = '1. Action: ' + input_response
-        examples = input_response.split('\n')
-        parsed_examples = []
-        for example in examples:
-            try:
-                ex = example.split(', Reason: ')[0]
-                reason = example.split(', Reason: ')[1]
-                ex = ex.split('Action:')[1]
-                ex = 'Action:' + ex
-                ex = ex.replace(', Contrastive Image:', '\nImage:')
-                ex = '\n'.join(ex.split('\n')[::-1])
-                parsed_examples.append((ex, reason))
-            except IndexError:
-                print(f'IndexError: {example}')
-
-        for ex, reason in parsed_examples:
-            response = iterative_create_response(data_creater, ex)
-            time.sleep(1)
-            data_creater.clear_chat_memory()
-            output = {'image_path': image_path,
-                      'image_caption': caption,
-                      'reason': reason,
-                      'generated_example': ex,
-                      'response': response}
-            outputs.append(output)
-
-            try:
-                if 'not possible' in response[1].lower():
-                    impossible_actions.append(output)
-                else:
-                    possible_actions.append(output)
-            except:
-                continue
-
-            if len(outputs) < 30:
-                print(outputs[-1])
+        if len(outputs) < 30:
+            print(outputs[-1])
+
+    # every parsed example has its output, the near-duplicates get the response of their representative
+    outputs_by_key = checkpoint.finalize_by_key()
+    outputs = []
+    for k, (_, source) in enumerate(examples):
+        representative_output = outputs_by_key[examples[representatives[k]][0]]
+        outputs.append(representative_output if representatives[k] == k
+                       else get_duplicate_output(representative_output, source))
+    possible_actions, impossible_actions = split_possible_actions(outputs)
 
-    output_path = os.path.join(gpt_outputs_dir, Path(input_path).name)
     with open(output_path, 'w') as f:
         json.dump(outputs, f, indent=2)
 
@@ -157,5 +215,14 @@ if __name__ == '__main__':
         json.dump(impossible_actions, f, indent=2)
 
     # print stats
+    print(parse_stats.summary('parsed generations'))
+    num_duplicates = len(examples) - len(set(representatives))
+    # two API calls per critique, the response and its refinement
+    print(f'near-duplicates: {num_duplicates} of {len(examples)} parsed examples, '
+          f'{2 * num_duplicates} API calls saved')
     print(f'possible_actions: {len(possible_actions)}')
     print(f'impossible_actions: {len(impossible_actions)}')
+
+    if response_cache is not None:
+        print(response_cache.stats())
+    print(token_usage.summary('critique'))
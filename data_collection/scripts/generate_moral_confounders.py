@@ -1,11 +1,17 @@
 import argparse
 import json
 import os
-import time
 from pathlib import Path
 
 from tqdm import tqdm
 
+from batch_api import BatchChatGpt, FakeBatchServer, OpenaiBatchApi
+from data_collection.checkpoint import FoldCheckpoint
+from data_collection.confounders import RESPONSE_FORMATS, ParseStats, parse_confounders
+from local_model import load_local_chat_model
+from rate_limit import StubOpenaiBackend
+from response_cache import ResponseCache
+from token_usage import split_prompt_template
 from utils import OpenaiChatGpt
 
 SYSTEM_PROMPT = """You are a succinct and helpful assistant."""
@@ -24,13 +30,33 @@ Enumerate actions when the image is given:
 Given Image: {information}
 1. Action:"""
 
+# same task, with the confounders as a JSON object (data_collection.confounders.CONFOUNDERS_SCHEMA)
+STRUCTURED_USER_PROMPT = """I will give you an information about the image. You can't see the image, but you can imagine the image with the information. 
+Enumerate two or three actions that are morally appropriate for the given image, but are morally inappropriate for other contrastive images.
+Respond in JSON, with an object {{"confounders": [{{"action": ..., "contrastive_image": ..., "reason": ...}}]}}.
+
+For example,
+
+Given Image: a collage of people posing with a cake
+{{"confounders": [
+{{"action": "play a party game", "contrastive_image": "a collage of people for business conference", "reason": "playing a party game is morally appropriate for the given image, but is morally inappropriate for an image about serious or formal setting like \\"a collage of people for business conference\\"."}},
+{{"action": "set a fire on the candle", "contrastive_image": "an artwork in a museum", "reason": "setting a fire on the candle is morally appropriate for the given image, but is morally inappropriate for an image about the place where fire is dangerous like \\"an artwork in a museum\\""}},
+{{"action": "cheer with the wine or beer", "contrastive_image": "group of children playing in the part with a ball", "reason": "cheering with the wine or beer is morally appropriate in the image, but is morally inappropriate for an image about children like \\"group of children playing in the park with a ball\\""}}
+]}}
+
+Enumerate actions when the image is given:
+Given Image: {information}"""
+
+# the few-shot examples are a static prefix of every prompt, sent first so that the prompt cache can reuse it
+USER_PROMPT_PREFIX, USER_PROMPT_SUFFIX = split_prompt_template(USER_PROMPT)
+STRUCTURED_USER_PROMPT_PREFIX, STRUCTURED_USER_PROMPT_SUFFIX = split_prompt_template(STRUCTURED_USER_PROMPT)
+
 
-def iterative_create_response(data_creater, caption):
+def iterative_create_response(data_creater, caption, prompt_suffix=USER_PROMPT_SUFFIX):
     responses = []
     for i in range(1):
-        context = USER_PROMPT.format(information=caption)
+        context = prompt_suffix.format(information=caption)
         response = data_creater.create_response(context)
-        time.sleep(1)
         responses.append(response)
     return responses
 
@@ -39,15 +65,59 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--fold', type=int, required=True)
     parser.add_argument('--root-dir', type=str, required=True)
+    parser.add_argument('--response-cache', type=str, default=None,
+                        help='Path to a sqlite cache of API responses, reused across re-runs')
+    parser.add_argument('--replay', action='store_true',
+                        help='Only read responses from --response-cache, never call the API')
+    parser.add_argument('--batch', action='store_true',
+                        help='Submit the prompts of the fold as one job of the OpenAI Batch API instead of one request '
+                             'each; the batch state is kept next to the output, a restarted run polls the same job')
+    parser.add_argument('--batch-poll-interval', type=float, default=60.,
+                        help='Seconds between two status checks of the batch job')
+    parser.add_argument('--fake-batch-server', action='store_true',
+                        help='Offline test of --batch, with a local fake batch server and stub responses')
+    parser.add_argument('--local-model', type=str, default=None,
+                        help='Run a local model on CPU instead of the API: the .npz weights of a GPT-2 checkpoint, '
+                             'or "tiny" for the tiny test model (see local_model.py)')
+    parser.add_argument('--local-batch-size', type=int, default=8,
+                        help='Number of sequences the local model decodes together')
+    parser.add_argument('--local-num-heads', type=int, default=None,
+                        help='Number of attention heads of the --local-model checkpoint, read from its n_head entry '
+                             'or inferred from its hidden size (64 per head, as in all GPT-2 sizes) if not set')
+    parser.add_argument('--structured-output', type=str, choices=list(RESPONSE_FORMATS), default=None,
+                        help='Ask for the confounders as JSON: "json_object" is the JSON mode, "json_schema" makes the '
+                             'response follow data_collection.confounders.CONFOUNDERS_SCHEMA and needs an --engine '
+                             'that supports structured outputs')
+    parser.add_argument('--engine', type=str, default='gpt-3.5-turbo')
     args = parser.parse_args()
 
-    data_creater = OpenaiChatGpt(engine='gpt-3.5-turbo',
-                                 temperatue=0.7,
-                                 topp=0.95,
-                                 frequency_penalty=0.0,
-                                 presence_penalty=0.0)
+    response_cache = None
+    if args.response_cache is not None:
+        response_cache = ResponseCache(args.response_cache, read_only=args.replay)
+
+    if args.local_model is not None:
+        data_creater = load_local_chat_model(args.local_model,
+                                             num_heads=args.local_num_heads,
+                                             temperatue=0.7,
+                                             topp=0.95,
+                                             max_batch_size=args.local_batch_size)
+    else:
+        data_creater = OpenaiChatGpt(engine=args.engine,
+                                     temperatue=0.7,
+                                     topp=0.95,
+                                     frequency_penalty=0.0,
+                                     presence_penalty=0.0,
+                                     backend=StubOpenaiBackend(latency=0.) if args.fake_batch_server else None,
+                                     response_cache=response_cache,
+                                     response_format=RESPONSE_FORMATS.get(args.structured_output))
     root_dir = args.root_dir
     data_creater.set_system_prompt(SYSTEM_PROMPT)
+    if args.structured_output is not None:
+        # the local model has no response format, it only gets the prompt (and its output the fallback parser)
+        prompt_prefix, prompt_suffix = STRUCTURED_USER_PROMPT_PREFIX, STRUCTURED_USER_PROMPT_SUFFIX
+    else:
+        prompt_prefix, prompt_suffix = USER_PROMPT_PREFIX, USER_PROMPT_SUFFIX
+    data_creater.set_prompt_prefix(prompt_prefix)
 
     caption_path = f'{root_dir}/dataset_coco.json'
     with open(caption_path, 'r') as f:
@@ -58,23 +128,60 @@ if __name__ == '__main__':
     gpt_outputs_dir = f'{root_dir}/turbo_moral_confounders/'
     Path(gpt_outputs_dir).mkdir(parents=True, exist_ok=True)
 
-    outputs = []
-    for data in tqdm(caption_data):
+    output_path = os.path.join(gpt_outputs_dir, f'dataset_coco_fold{args.fold}.json')
+    # every output is appended to a jsonl file right away, so a restarted fold continues where it stopped
+    checkpoint = FoldCheckpoint(output_path, num_total=len(caption_data))
+
+    todo = []
+    for i, data in enumerate(caption_data):
+        if checkpoint.is_done(i):
+            continue
         filename = data['filename']
         caption = data['sentences'][0]['raw'].strip()
         image_path = os.path.join(root_dir, 'train2014', filename) if 'train' in filename else \
             os.path.join(root_dir, 'val2014', filename)
         if not os.path.exists(image_path):
             continue
+        todo.append((i, image_path, caption))
+
+    if args.local_model is not None:
+        # dynamic batches over the prompts of the fold, the few-shot prefix of USER_PROMPT is prefilled once
+        local_responses = data_creater.stream_template_based_responses(
+            [prompt_suffix], [{'information': caption} for _, _, caption in todo], ordered=True)
+    elif args.batch or args.fake_batch_server:
+        batch_api = FakeBatchServer() if args.fake_batch_server else OpenaiBatchApi()
+        batch_gpt = BatchChatGpt(data_creater, batch_api, work_dir=output_path.replace('.json', '.batch'),
+                                 poll_interval=args.batch_poll_interval)
+        # same prompt as iterative_create_response
+        batch_responses = batch_gpt.get_responses({str(i): prompt_suffix.format(information=caption)
+                                                   for i, _, caption in todo})
 
-        response = iterative_create_response(data_creater, caption)
-        data_creater.clear_chat_memory()
+    outputs = []
+    for i, image_path, caption in tqdm(todo):
+        if args.local_model is not None:
+            _, response = next(local_responses)
+        elif args.batch or args.fake_batch_server:
+            response = [batch_responses[str(i)]]
+        else:
+            response = iterative_create_response(data_creater, caption, prompt_suffix)
+            data_creater.clear_chat_memory()
         output = {'image_path': image_path, 'caption': caption, 'response': response}
+        checkpoint.append(i, output)
 
         outputs.append(output)
         if len(outputs) < 10:
             print(outputs[-1])
 
-    output_path = os.path.join(gpt_outputs_dir, f'dataset_coco_fold{args.fold}.json')
+    outputs = checkpoint.finalize()
     with open(output_path, 'w') as f:
         json.dump(outputs, f, indent=2)
+
+    # the responses without any well-formed confounder are the ones worth regenerating
+    parse_stats = ParseStats()
+    for output in outputs:
+        parse_stats.add(parse_confounders(output['response'][0]))
+    print(parse_stats.summary('parsed generations'))
+
+    if response_cache is not None:
+        print(response_cache.stats())
+    print(data_creater.token_usage.summary('generate'))
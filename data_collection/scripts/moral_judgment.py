@@ -1,11 +1,16 @@
 import argparse
 import json
 import os
-import time
 from pathlib import Path
 
 from tqdm import tqdm
 
+from batch_api import BatchChatGpt, FakeBatchServer, OpenaiBatchApi
+from data_collection.checkpoint import FoldCheckpoint
+from local_model import load_local_chat_model
+from rate_limit import StubOpenaiBackend
+from response_cache import ResponseCache
+from token_usage import split_prompt_template
 from utils import OpenaiChatGpt
 
 SYSTEM_PROMPT = """You are a succinct and moral assistant."""
@@ -39,34 +44,73 @@ Response: It is morally inappropriate, because the dangerous chemicals might lea
 {information}
 Response:"""
 
+# the few-shot examples are a static prefix of every prompt, sent first so that the prompt cache can reuse it
+USER_PROMPT_PREFIX, USER_PROMPT_SUFFIX = split_prompt_template(USER_PROMPT)
+
 
 def iterative_create_response(data_creater, information):
     responses = []
     for i in range(1):
         if i == 0:
-            context = USER_PROMPT.format(information=information)
+            context = USER_PROMPT_SUFFIX.format(information=information)
             response = data_creater.create_response(context)
         else:
             raise NotImplementedError
 
-        time.sleep(1)
         responses.append(response)
     return responses
 
 
+def is_morally_inappropriate(moral_judgment):
+    return 'morally inappropriate' in moral_judgment and 'not morally inappropriate' not in moral_judgment
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--fold', type=int, required=True)
     parser.add_argument('--root-dir', type=str, required=True)
+    parser.add_argument('--response-cache', type=str, default=None,
+                        help='Path to a sqlite cache of API responses, reused across re-runs')
+    parser.add_argument('--replay', action='store_true',
+                        help='Only read responses from --response-cache, never call the API')
+    parser.add_argument('--batch', action='store_true',
+                        help='Submit the prompts of the fold as one job of the OpenAI Batch API instead of one request '
+                             'each; the batch state is kept next to the output, a restarted run polls the same job')
+    parser.add_argument('--batch-poll-interval', type=float, default=60.,
+                        help='Seconds between two status checks of the batch job')
+    parser.add_argument('--fake-batch-server', action='store_true',
+                        help='Offline test of --batch, with a local fake batch server and stub responses')
+    parser.add_argument('--local-model', type=str, default=None,
+                        help='Run a local model on CPU instead of the API: the .npz weights of a GPT-2 checkpoint, '
+                             'or "tiny" for the tiny test model (see local_model.py)')
+    parser.add_argument('--local-batch-size', type=int, default=8,
+                        help='Number of sequences the local model decodes together')
+    parser.add_argument('--local-num-heads', type=int, default=None,
+                        help='Number of attention heads of the --local-model checkpoint, read from its n_head entry '
+                             'or inferred from its hidden size (64 per head, as in all GPT-2 sizes) if not set')
     args = parser.parse_args()
 
-    data_creater = OpenaiChatGpt(engine='gpt-3.5-turbo',
-                                 temperatue=0.1,
-                                 topp=0.95,
-                                 frequency_penalty=0.0,
-                                 presence_penalty=0.0)
+    response_cache = None
+    if args.response_cache is not None:
+        response_cache = ResponseCache(args.response_cache, read_only=args.replay)
+
+    if args.local_model is not None:
+        data_creater = load_local_chat_model(args.local_model,
+                                             num_heads=args.local_num_heads,
+                                             temperatue=0.1,
+                                             topp=0.95,
+                                             max_batch_size=args.local_batch_size)
+    else:
+        data_creater = OpenaiChatGpt(engine='gpt-3.5-turbo',
+                                     temperatue=0.1,
+                                     topp=0.95,
+                                     frequency_penalty=0.0,
+                                     presence_penalty=0.0,
+                                     backend=StubOpenaiBackend(latency=0.) if args.fake_batch_server else None,
+                                     response_cache=response_cache)
     root_dir = args.root_dir
     data_creater.set_system_prompt(SYSTEM_PROMPT)
+    data_creater.set_prompt_prefix(USER_PROMPT_PREFIX)
 
     input_path = f'{args.root_dir}/turbo_moral_confounders/critique/dataset_coco_fold{args.fold}_possible.json'
     with open(input_path, 'r') as f:
@@ -75,29 +119,65 @@ if __name__ == '__main__':
     gpt_outputs_dir = f'{root_dir}/turbo_moral_confounders/critique/v3'
     Path(gpt_outputs_dir).mkdir(parents=True, exist_ok=True)
 
-    morally_inappropriate = []
-    morally_appropriate = []
-
-    for i, data in tqdm(list(enumerate(input_datas))):
-        generated_example = data['generated_example']
-        response = iterative_create_response(data_creater, generated_example)
-        time.sleep(1)
-        data_creater.clear_chat_memory()
+    output_path = os.path.join(gpt_outputs_dir, Path(input_path).name).replace('.json', '_moral.json')
+    # every judged item is appended to a jsonl file right away, so a restarted fold continues where it stopped
+    # the near-duplicates of critique_moral_confounders.py are judged with their representative
+    judged = [i for i, data in enumerate(input_datas) if 'duplicate_of' not in data]
+    checkpoint = FoldCheckpoint(output_path, num_total=len(judged))
+
+    todo = [i for i in judged if not checkpoint.is_done(i)]
+    if args.local_model is not None:
+        # dynamic batches over the prompts of the fold, the few-shot prefix of USER_PROMPT is prefilled once
+        local_responses = data_creater.stream_template_based_responses(
+            [USER_PROMPT_SUFFIX], [{'information': input_datas[i]['generated_example']} for i in todo], ordered=True)
+    elif args.batch or args.fake_batch_server:
+        batch_api = FakeBatchServer() if args.fake_batch_server else OpenaiBatchApi()
+        batch_gpt = BatchChatGpt(data_creater, batch_api, work_dir=output_path.replace('.json', '.batch'),
+                                 poll_interval=args.batch_poll_interval)
+        # same prompt as iterative_create_response
+        batch_responses = batch_gpt.get_responses(
+            {str(i): USER_PROMPT_SUFFIX.format(information=input_datas[i]['generated_example']) for i in todo})
+
+    for i in tqdm(todo):
+        data = input_datas[i]
+        if args.local_model is not None:
+            _, response = next(local_responses)
+        elif args.batch or args.fake_batch_server:
+            response = [batch_responses[str(i)]]
+        else:
+            response = iterative_create_response(data_creater, data['generated_example'])
+            data_creater.clear_chat_memory()
         input_datas[i]['moral_judgment'] = response[0]
+        checkpoint.append(i, data)
 
-        if 'morally inappropriate' in response[0] and 'not morally inappropriate' not in response[0]:
-            morally_inappropriate.append(data)
+        if is_morally_inappropriate(response[0]):
             print(data['image_caption'])
             print(data['generated_example'])
             print(data['moral_judgment'])
             print('----')
+
+    outputs_by_key = checkpoint.finalize_by_key()
+    representative_keys = {(input_datas[i]['image_caption'], input_datas[i]['generated_example']): str(i)
+                           for i in judged}
+    outputs = []
+    for i, data in enumerate(input_datas):
+        if 'duplicate_of' in data:
+            key = representative_keys[data['duplicate_of']['image_caption'], data['duplicate_of']['generated_example']]
+            outputs.append({**data, 'moral_judgment': outputs_by_key[key]['moral_judgment']})
         else:
-            morally_appropriate.append(data)
+            outputs.append(outputs_by_key[str(i)])
+    input_datas = outputs
+    morally_inappropriate = [data for data in input_datas if is_morally_inappropriate(data['moral_judgment'])]
+    morally_appropriate = [data for data in input_datas if not is_morally_inappropriate(data['moral_judgment'])]
 
-    output_path = os.path.join(gpt_outputs_dir, Path(input_path).name)
-    with open(output_path.replace('.json', '_moral.json'), 'w') as f:
+    with open(output_path, 'w') as f:
         json.dump(input_datas, f, indent=2)
 
     # print stats
     print(f'Number of morally inappropriate: {len(morally_inappropriate)}')
     print(f'Number of morally appropriate: {len(morally_appropriate)}')
+    print(f'API calls saved on near-duplicates: {len(input_datas) - len(judged)}')
+
+    if response_cache is not None:
+        print(response_cache.stats())
+    print(data_creater.token_usage.summary('moral judgment'))
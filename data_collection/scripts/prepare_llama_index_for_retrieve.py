@@ -1,95 +1,76 @@
 import argparse
-import json
 import os
 from pathlib import Path
 
-from llama_index import GPTVectorStoreIndex
-from llama_index.readers.schema.base import ImageDocument
+from llama_index.graph_stores import SimpleGraphStore
+from llama_index.graph_stores.types import DEFAULT_PERSIST_FNAME as GRAPH_STORE_FNAME
+from llama_index.schema import ImageNode
+from llama_index.vector_stores import FaissVectorStore
+from llama_index.vector_stores.types import DEFAULT_PERSIST_FNAME
 from tqdm import tqdm
 
+from data_collection.index_builder import (DATATYPES, EMBEDDERS, INDEX_TYPES, build_shards, get_datapath,
+                                           iter_chunk_records, merge_shards, write_embedder_info)
+from data_collection.llama_index_store import DocstoreWriter, write_index_store
+from data_collection.node_store import NODE_IDS_NAME, NodeStoreWriter, PackedStrings, PackedStringsWriter
+
 if __name__ == '__main__':
     # turn text captions into gpt embeddings, and store them
     parser = argparse.ArgumentParser()
-    parser.add_argument('--datatype', type=str, choices=['sherlock', 'coco', 'narratives'])
+    parser.add_argument('--datatype', type=str, choices=DATATYPES)
     parser.add_argument('--root-dir', type=str, required=True)
+    parser.add_argument('--embedder', type=str, choices=list(EMBEDDERS), default='openai',
+                        help='"hashing" is a local embedder for offline runs and tests')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='Number of captions read and embedded at a time')
+    parser.add_argument('--num-shards', type=int, default=1,
+                        help='Number of shards the captions are split into')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of shards embedded in parallel')
+    parser.add_argument('--index-type', type=str, choices=list(INDEX_TYPES), default='flat',
+                        help='FAISS index type, compare them with scripts/benchmark_faiss_index.py')
+    parser.add_argument('--nlist', type=int, default=1024,
+                        help='Number of IVF cells of ivf_flat and ivf_pq')
+    parser.add_argument('--pq-m', type=int, default=64,
+                        help='Number of sub-quantizers (bytes per vector) of ivf_pq, must divide the embedding size')
+    parser.add_argument('--hnsw-m', type=int, default=32,
+                        help='Number of neighbors per node of hnsw')
+    parser.add_argument('--train-size', type=int, default=100000,
+                        help='Number of sampled embeddings to train the ivf/pq/sq indexes on')
     args = parser.parse_args()
 
-    documents = []
-    if args.datatype == 'sherlock':
-        datapath = f'{args.root_dir}/sherlock_dataset/sherlock_train_v1_1.json'
-        vis_root = args.root_dir
-        with open(datapath, 'r') as f:
-            data = json.load(f)
-            for d in tqdm(data):
-                image_url = d['inputs']['image']['url']
-                input_path_split = image_url.split('/')
-                if input_path_split[-3] == 'vcr1images':
-                    input_path_simple = input_path_split[-3] + "/" + input_path_split[-2] + "/" + input_path_split[-1]
-                    image_path = os.path.join(vis_root, input_path_simple)
-                else:
-                    input_path_simple = input_path_split[-2] + "/" + input_path_split[-1]
-                    image_path = os.path.join(vis_root, "vg/images", input_path_simple)
-
-                if not os.path.exists(image_path):
-                    print(image_path)
-                    continue
-
-                instance_id = d['instance_id']
-                clue = d['inputs']['clue']
-                inference = d['targets']['inference']
-
-                documents.append(
-                    ImageDocument(image=str(image_path),
-                                  text=inference,
-                                  doc_id=instance_id, ))
-    elif args.datatype == 'narratives':
-        datapath = f'{args.root_dir}/openimages_localized_narratives/open_images_train_v6_captions.jsonl'
-        image_dir = f'{args.root_dir}/image-captioning/openimages_v6_images'
-        with open(datapath, 'r') as f:
-            all_lines = f.readlines()
-            for line in tqdm(all_lines):
-                data = json.loads(line.strip())
-                image_id = data['image_id']
-                caption = data['caption']
-
-                image_path = Path(image_dir) / f'{image_id}.jpg'
-                if not image_path.exists():
-                    print(image_path)
-                    continue
-
-                documents.append(
-                    ImageDocument(image=str(image_path),
-                                  text=caption,
-                                  doc_id=image_id, ))
-    elif args.datatype == 'coco':
-        datapath = f'{args.root_dir}/coco/dataset_coco.json'
-        image_dir = f'{args.root_dir}/coco'
-        with open(datapath, 'r') as f:
-            data = json.load(f)
-            images = data['images']
-            for image in tqdm(images):
-                filepath = image['filepath']
-                filename = image['filename']
-                image_path = Path(image_dir) / filepath / filename
-                if not image_path.exists():
-                    print(image_path)
-                    continue
+    datapath = get_datapath(args.datatype, args.root_dir)
+    persist_dir = Path(datapath).parent / f'{args.datatype}_index'
 
-                sentences = image['sentences']
-                for sentence in sentences:
-                    caption = sentence['raw']
-                    img_id = sentence['imgid']
-                    sent_id = sentence['sentid']
-                    doc_id = f'{img_id}_{sent_id}'
-                    documents.append(
-                        ImageDocument(image=str(image_path),
-                                      text=caption,
-                                      doc_id=doc_id, ))
-    else:
-        raise NotImplementedError
+    # embedded chunks are kept in the build dir, so that an interrupted build resumes from the last chunk
+    build_dir = Path(datapath).parent / f'{args.datatype}_index_build'
+    num_embedded = build_shards(args.datatype, args.root_dir, str(build_dir),
+                                num_shards=args.num_shards, workers=args.workers,
+                                chunk_size=args.chunk_size, embedder_name=args.embedder)
+    print(f'Embedded {num_embedded} new chunks in {build_dir}')
 
-    index = GPTVectorStoreIndex.from_documents(documents)
-    persist_dir = Path(datapath).parent / f'{args.datatype}_index'
+    faiss_index = merge_shards(str(build_dir), index_type=args.index_type, train_size=args.train_size,
+                               nlist=args.nlist, pq_m=args.pq_m, hnsw_m=args.hnsw_m)
     persist_dir.mkdir(exist_ok=True, parents=True)
-    index.storage_context.persist(persist_dir=str(persist_dir))
+    FaissVectorStore(faiss_index=faiss_index).persist(persist_path=os.path.join(persist_dir, DEFAULT_PERSIST_FNAME))
+    SimpleGraphStore().persist(persist_path=os.path.join(persist_dir, GRAPH_STORE_FNAME))
+    write_embedder_info(persist_dir, args.embedder, faiss_index.d)
+
+    # the embeddings are already in the faiss index, only the nodes go to the docstore and index struct; they are
+    # streamed chunk by chunk to the docstore, and to the faiss id -> node id table and the node store of
+    # get_retriever(load_mode='mmap' or 'compact')
+    with DocstoreWriter(persist_dir) as docstore_writer, NodeStoreWriter(persist_dir) as node_store_writer, \
+            PackedStringsWriter(persist_dir, NODE_IDS_NAME) as node_ids_writer, tqdm(total=faiss_index.ntotal) as pbar:
+        for records in iter_chunk_records(str(build_dir)):
+            for record in records:
+                node = ImageNode(id_=f'{args.datatype}_{len(node_ids_writer)}',
+                                 text=record['text'],
+                                 image=record['image'],
+                                 metadata={'doc_id': record['doc_id']})
+                docstore_writer.add(node)
+                node_store_writer.add(record['text'], record['image'])
+                node_ids_writer.write(node.node_id)
+            pbar.update(len(records))
+    # the index struct of load_index_from_storage, its faiss id -> node id dict read back from the table
+    write_index_store(persist_dir, PackedStrings(persist_dir, NODE_IDS_NAME))
     print('done')
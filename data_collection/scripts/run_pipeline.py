@@ -0,0 +1,255 @@
+import argparse
+import functools
+import json
+import os
+from pathlib import Path
+
+from tqdm import tqdm
+
+from data_collection.confounders import RESPONSE_FORMATS, ParseStats
+from data_collection.dedup import NearDuplicateIndex, get_duplicate_output
+from data_collection.embedding_cache import QueryEmbeddingCache
+from data_collection.pipeline import Stage, StreamingPipeline
+from data_collection.scripts import critique_moral_confounders as critique
+from data_collection.scripts import generate_moral_confounders as generate
+from data_collection.scripts import moral_judgment as judge
+from data_collection.scripts.run_retrieve_with_llama_index import parse_top_k, retrieve_images
+from data_collection.vector_retriever import MultiIndexRetriever, get_retriever
+from response_cache import ResponseCache
+from token_usage import TokenUsage
+from utils import OpenaiChatGpt
+
+
+def get_chat_model_setup(system_prompt, prompt_prefix, temperatue, response_cache, token_usage, response_format=None):
+    def setup():
+        data_creater = OpenaiChatGpt(engine='gpt-3.5-turbo',
+                                     temperatue=temperatue,
+                                     topp=0.95,
+                                     frequency_penalty=0.0,
+                                     presence_penalty=0.0,
+                                     response_cache=response_cache,
+                                     response_format=response_format)
+        data_creater.set_system_prompt(system_prompt)
+        data_creater.set_prompt_prefix(prompt_prefix)
+        # shared by the workers of the stage
+        data_creater.token_usage = token_usage
+        return data_creater
+
+    return setup
+
+
+def generate_stage(data_creater, data, prompt_suffix=generate.USER_PROMPT_SUFFIX, parse_stats=None):
+    # same as generate_moral_confounders.py, with the (image, action) pairs generated for the input.
+    # A failed input is passed on without pairs, the dedup stage waits for every input in order
+    examples = []
+    try:
+        response = generate.iterative_create_response(data_creater, data['caption'], prompt_suffix)
+        for j, (ex, reason) in enumerate(critique.parse_generated_examples(response[0], parse_stats)):
+            examples.append({'key': (data['index'], j),
+                             'image_path': data['image_path'],
+                             'image_caption': data['caption'],
+                             'reason': reason,
+                             'generated_example': ex})
+    except Exception as e:
+        print(f'[generate] Exception: {e}')
+    data_creater.clear_chat_memory()
+    return [{'seq': data['seq'], 'examples': examples}]
+
+
+class OrderedDedup:
+    """
+    State of the dedup stage. The generated examples are released, and deduplicated, in the order of the inputs,
+    like critique_moral_confounders.py does, whatever order the generate workers finish them in: the first
+    example of a group is the representative that moves on, the others are kept in the duplicates of its key, and
+    get its results after the run.
+    """
+
+    def __init__(self, near_duplicate_index=None):
+        # None releases every example
+        self.near_duplicate_index = near_duplicate_index
+        # duplicates of each representative example, by key
+        self.duplicates = {}
+        self._representative_keys = {}
+        self._pending = {}
+        self._next_seq = 0
+
+    def add(self, seq, examples):
+        """
+        :return: the examples to pass on, of the inputs up to the first one that is not generated yet
+        """
+        self._pending[seq] = examples
+        outputs = []
+        while self._next_seq in self._pending:
+            for data in self._pending.pop(self._next_seq):
+                if self.near_duplicate_index is None:
+                    outputs.append(data)
+                    continue
+                representative = self.near_duplicate_index.add(data['generated_example'])
+                if representative is not None:
+                    self.duplicates.setdefault(self._representative_keys[representative], []).append(
+                        {k: data[k] for k in ['key', 'image_path', 'image_caption', 'reason', 'generated_example']})
+                else:
+                    self._representative_keys[self.near_duplicate_index.num_added - 1] = data['key']
+                    outputs.append(data)
+            self._next_seq += 1
+        return outputs
+
+
+def dedup_stage(state, generated):
+    # the representatives have already moved on to the next stages, their duplicates are added after the run
+    return state.add(generated['seq'], generated['examples'])
+
+
+def critique_stage(data_creater, data):
+    # same as critique_moral_confounders.py, only the possible actions move on
+    data['response'] = critique.iterative_create_response(data_creater, data['generated_example'])
+    data_creater.clear_chat_memory()
+    possible_actions, impossible_actions = critique.split_possible_actions([data])
+    return possible_actions
+
+
+def judge_stage(data_creater, data):
+    # same as moral_judgment.py, only the morally inappropriate actions move on
+    response = judge.iterative_create_response(data_creater, data['generated_example'])
+    data_creater.clear_chat_memory()
+    data['moral_judgment'] = response[0]
+    return [data] if judge.is_morally_inappropriate(data['moral_judgment']) else []
+
+
+def retrieve_stage(retriever, data):
+    # same as run_retrieve_with_llama_index.py
+    return [data] if retrieve_images(retriever, data) is not None else []
+
+
+if __name__ == '__main__':
+    # runs generate -> critique -> moral judgment -> retrieve on a fold in one process,
+    # every item moves to the next stage as soon as it is ready instead of after the whole fold
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fold', type=int, required=True)
+    parser.add_argument('--root-dir', type=str, required=True)
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of concurrent conversations of each GPT stage')
+    parser.add_argument('--queue-size', type=int, default=64,
+                        help='Maximum number of items waiting in front of each stage')
+    parser.add_argument('--report-interval', type=float, default=30.,
+                        help='Seconds between two reports of the per-stage throughput and queue depth')
+    parser.add_argument('--response-cache', type=str, default=None,
+                        help='Path to a sqlite cache of API responses, reused across re-runs')
+    parser.add_argument('--replay', action='store_true',
+                        help='Only read responses from --response-cache, never call the API')
+    parser.add_argument('--nprobe', type=int, default=None,
+                        help='Number of IVF cells searched per query, for ivf_flat/ivf_pq indexes')
+    parser.add_argument('--ef-search', type=int, default=None,
+                        help='HNSW search beam width, for hnsw indexes')
+    parser.add_argument('--load-mode', type=str, choices=['eager', 'mmap', 'compact'], default='eager',
+                        help='"mmap" opens each index on its first query, memory-mapped, and reads the results from '
+                             'the node store instead of the docstore, for a fast startup; "compact" also returns them '
+                             'as lightweight records instead of llama_index nodes')
+    parser.add_argument('--embedding-cache', type=str, default=None,
+                        help='Path to a sqlite cache of query embeddings, reused across re-runs (in memory if not set)')
+    parser.add_argument('--top-k', type=str, nargs='+', default=['10'],
+                        help='Number of retrieved captions per datatype, "K" or e.g. "coco=20 sherlock=5 narratives=5"')
+    parser.add_argument('--fused-top-k', type=int, default=None,
+                        help='Also store the global top k over all datatypes, ranked by cosine similarity '
+                             '(flat, ivf_flat or hnsw indexes only)')
+    parser.add_argument('--dedup-threshold', type=float, default=0.7,
+                        help='Jaccard similarity (of character shingles) from which two generated examples are '
+                             'near-duplicates, and only the first one is critiqued and judged')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='Critique and judge every generated example, even the near-duplicates')
+    parser.add_argument('--structured-output', type=str, choices=list(RESPONSE_FORMATS), default=None,
+                        help='Generate the confounders as JSON, see generate_moral_confounders.py')
+    args = parser.parse_args()
+
+    response_cache = None
+    if args.response_cache is not None:
+        response_cache = ResponseCache(args.response_cache, read_only=args.replay)
+
+    root_dir = args.root_dir
+    caption_path = f'{root_dir}/dataset_coco.json'
+    with open(caption_path, 'r') as f:
+        caption_data = json.load(f)['images']
+
+    caption_data = caption_data[1000 * args.fold: 1000 * (args.fold + 1)]
+
+    inputs = []
+    for i, data in enumerate(caption_data):
+        filename = data['filename']
+        image_path = os.path.join(root_dir, 'train2014', filename) if 'train' in filename else \
+            os.path.join(root_dir, 'val2014', filename)
+        if not os.path.exists(image_path):
+            continue
+        inputs.append({'seq': len(inputs), 'index': i, 'image_path': image_path,
+                       'caption': data['sentences'][0]['raw'].strip()})
+
+    # the retrievers are read-only, all retrieve workers share them
+    # one cache for the retrievers of all datatypes, a description is embedded once
+    embedding_cache = QueryEmbeddingCache(args.embedding_cache)
+    retrievers = get_retriever(root_dir, nprobe=args.nprobe, ef_search=args.ef_search,
+                               load_mode=args.load_mode, embedding_cache=embedding_cache,
+                               similarity_top_k=parse_top_k(args.top_k))
+    # the datatypes of each query are searched concurrently
+    retriever = MultiIndexRetriever(retrievers, fused_top_k=args.fused_top_k)
+
+    near_duplicate_index = None if args.no_dedup else NearDuplicateIndex(threshold=args.dedup_threshold)
+    ordered_dedup = OrderedDedup(near_duplicate_index)
+    token_usages = {'generate': TokenUsage(), 'critique': TokenUsage(), 'moral_judgment': TokenUsage()}
+    parse_stats = ParseStats()
+    if args.structured_output is not None:
+        generate_prompt_prefix, generate_prompt_suffix = \
+            generate.STRUCTURED_USER_PROMPT_PREFIX, generate.STRUCTURED_USER_PROMPT_SUFFIX
+    else:
+        generate_prompt_prefix, generate_prompt_suffix = generate.USER_PROMPT_PREFIX, generate.USER_PROMPT_SUFFIX
+    pipeline = StreamingPipeline([
+        Stage('generate',
+              functools.partial(generate_stage, prompt_suffix=generate_prompt_suffix, parse_stats=parse_stats),
+              num_workers=args.workers,
+              setup=get_chat_model_setup(generate.SYSTEM_PROMPT, generate_prompt_prefix, 0.7,
+                                         response_cache, token_usages['generate'],
+                                         response_format=RESPONSE_FORMATS.get(args.structured_output))),
+        # one worker, which restores the order of the generated examples
+        Stage('dedup' if not args.no_dedup else 'order', dedup_stage, setup=lambda: ordered_dedup),
+        Stage('critique', critique_stage, num_workers=args.workers,
+              setup=get_chat_model_setup(critique.SYSTEM_PROMPT, critique.USER_PROMPT_PREFIX, 0.1,
+                                         response_cache, token_usages['critique'])),
+        Stage('moral_judgment', judge_stage, num_workers=args.workers,
+              setup=get_chat_model_setup(judge.SYSTEM_PROMPT, judge.USER_PROMPT_PREFIX, 0.1,
+                                         response_cache, token_usages['moral_judgment'])),
+        Stage('retrieve', retrieve_stage, setup=lambda: retriever),
+    ], queue_size=args.queue_size, report_interval=args.report_interval)
+
+    selected_examples = []
+    try:
+        for d in tqdm(pipeline.run(inputs)):
+            selected_examples.append(d)
+    finally:
+        # whatever the pipeline produced is written, also if it raises at the end
+        # the near-duplicates of the selected representatives are selected with their results
+        selected_examples.extend([get_duplicate_output(d, source)
+                                  for d in selected_examples for source in ordered_dedup.duplicates.get(d['key'], [])])
+        # same order as the batch scripts, whatever order the workers finished in
+        selected_examples.sort(key=lambda d: d['key'])
+        for d in selected_examples:
+            del d['key']
+
+        gpt_outputs_dir = f'{root_dir}/turbo_moral_confounders/pipeline'
+        Path(gpt_outputs_dir).mkdir(parents=True, exist_ok=True)
+        output_path = os.path.join(gpt_outputs_dir,
+                                   f'dataset_coco_fold{args.fold}_moral_inappropriate_text_retrieval.json')
+        with open(output_path, 'w') as f:
+            json.dump(selected_examples, f, indent=2)
+
+    print(f'Number of selected examples: {len(selected_examples)}')
+    print(parse_stats.summary('parsed generations'))
+    if not args.no_dedup:
+        # two API calls per critique, the response and its refinement, and one more per judged duplicate
+        num_duplicates = near_duplicate_index.num_duplicates
+        print(f'near-duplicates: {num_duplicates} of {near_duplicate_index.num_added} generated examples, '
+              f'at least {2 * num_duplicates} API calls saved')
+    if response_cache is not None:
+        print(response_cache.stats())
+    for name, token_usage in token_usages.items():
+        print(token_usage.summary(name))
+    print(embedding_cache.stats())
+    retriever.close()
+    embedding_cache.close()
@@ -4,12 +4,86 @@ import os
 
 from tqdm import tqdm
 
-from data_collection.vector_retriever import get_retriever
+from data_collection.embedding_cache import QueryEmbeddingCache
+from data_collection.index_builder import DATATYPES
+from data_collection.vector_retriever import MultiIndexRetriever, get_retriever, to_retrieved_caption
+
+
+def parse_image_description(generated_example):
+    """
+    :return: the image description of an "Image: ...\nAction: ..." generated example, otherwise None
+    """
+    image, action = generated_example.split('\n')
+    if not image.startswith('Image: ') or not action.startswith('Action: '):
+        print(generated_example)
+        return None
+    return image[len('Image: '):]
+
+
+def format_retrieved_results(retrieved_results):
+    # llama_index nodes, or the RetrievedCaption records of get_retriever(load_mode='compact')
+    return [to_retrieved_caption(r)._asdict() for r in retrieved_results]
+
+
+def parse_top_k(values):
+    """
+    :param values: ["K"] for all datatypes, or ["DATATYPE=K", ...]
+    :return: similarity_top_k of get_retriever
+    """
+    if len(values) == 1 and '=' not in values[0]:
+        return int(values[0])
+    top_k = {}
+    for value in values:
+        datatype, k = value.split('=')
+        if datatype not in DATATYPES:
+            raise ValueError(f'Unknown datatype {datatype} in --top-k, should be one of {DATATYPES}')
+        top_k[datatype] = int(k)
+    return top_k
+
+
+def add_retrieved_results(retriever: MultiIndexRetriever, d, results):
+    # results of the image description of d, keyed by datatype
+    d['image_retrieval'] = {retriever_name: format_retrieved_results(retrieved_results)
+                            for retriever_name, retrieved_results in results.items()}
+    if retriever.fused_top_k is not None:
+        d['fused_image_retrieval'] = [caption._asdict() for caption in retriever.fuse(results)]
+
+
+def retrieve_images(retriever: MultiIndexRetriever, d):
+    """
+    Adds the images retrieved for the image description of a generated example to d['image_retrieval'],
+    and their fused top k to d['fused_image_retrieval'] if the retriever has a fused_top_k.
+    :return: d, or None if the generated example is not an "Image: ...\nAction: ..." pair
+    """
+    image = parse_image_description(d['generated_example'])
+    if image is None:
+        return None
+
+    add_retrieved_results(retriever, d, retriever.retrieve(image))
+    return d
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--datapath', type=str)
     parser.add_argument('--root-dir', type=str, required=True)
+    parser.add_argument('--batch-size', type=int, default=1024,
+                        help='Number of queries per FAISS search')
+    parser.add_argument('--nprobe', type=int, default=None,
+                        help='Number of IVF cells searched per query, for ivf_flat/ivf_pq indexes')
+    parser.add_argument('--ef-search', type=int, default=None,
+                        help='HNSW search beam width, for hnsw indexes')
+    parser.add_argument('--load-mode', type=str, choices=['eager', 'mmap', 'compact'], default='eager',
+                        help='"mmap" opens each index on its first query, memory-mapped, and reads the results from '
+                             'the node store instead of the docstore, for a fast startup; "compact" also returns them '
+                             'as lightweight records instead of llama_index nodes')
+    parser.add_argument('--embedding-cache', type=str, default=None,
+                        help='Path to a sqlite cache of query embeddings, reused across re-runs (in memory if not set)')
+    parser.add_argument('--top-k', type=str, nargs='+', default=['10'],
+                        help='Number of retrieved captions per datatype, "K" or e.g. "coco=20 sherlock=5 narratives=5"')
+    parser.add_argument('--fused-top-k', type=int, default=None,
+                        help='Also store the global top k over all datatypes, ranked by cosine similarity '
+                             '(flat, ivf_flat or hnsw indexes only)')
     args = parser.parse_args()
 
     datapath = args.datapath
@@ -21,7 +95,13 @@ if __name__ == '__main__':
         print(f'Already exists, {output_path}')
         exit()
 
-    retrievers = get_retriever(args.root_dir)
+    # one cache for the retrievers of all datatypes, a description is embedded once
+    embedding_cache = QueryEmbeddingCache(args.embedding_cache)
+    retrievers = get_retriever(args.root_dir, nprobe=args.nprobe, ef_search=args.ef_search,
+                               load_mode=args.load_mode, embedding_cache=embedding_cache,
+                               similarity_top_k=parse_top_k(args.top_k))
+    # the datatypes are searched concurrently
+    retriever = MultiIndexRetriever(retrievers, fused_top_k=args.fused_top_k)
 
     morally_inappropriate = []
     for d in datas:
@@ -31,36 +111,26 @@ if __name__ == '__main__':
             morally_inappropriate.append(d)
 
     selected_examples = []
-    for d in tqdm(morally_inappropriate):
+    images = []
+    for d in morally_inappropriate:
         try:
-            generated_example = d['generated_example']
-            moral_judgment = d['moral_judgment']
-
-            image, action = generated_example.split('\n')
-            if not image.startswith('Image: ') or not action.startswith('Action: '):
-                print(generated_example)
-                continue
-
-            image = image[len('Image: '):]
-            action = action[len('Action: '):]
-
-            results = {}
-            for retriever_name, retriever in retrievers.items():
-                retrieved_results = retriever.retrieve(image)
-                results[retriever_name] = [
-                    {
-                        'text': r.node.text,
-                        'image': r.node.image,
-                        'score': float(r.score),
-                    }
-                    for r in retrieved_results
-                ]
-
-            d['image_retrieval'] = results
-            selected_examples.append(d)
+            image = parse_image_description(d['generated_example'])
         except Exception as e:
-            print(generated_example)
+            print(d['generated_example'])
             continue
+        if image is not None:
+            selected_examples.append(d)
+            images.append(image)
+
+    # one batched embedding call and a few FAISS searches per datatype, instead of one per example
+    retrieved_results = retriever.retrieve_batch(images, batch_size=args.batch_size)
+    for i, d in enumerate(tqdm(selected_examples)):
+        add_retrieved_results(retriever, d, {retriever_name: results[i]
+                                             for retriever_name, results in retrieved_results.items()})
 
     with open(output_path, 'w') as f:
         json.dump(selected_examples, f, indent=2)
+
+    print(embedding_cache.stats())
+    retriever.close()
+    embedding_cache.close()
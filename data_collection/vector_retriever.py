@@ -1,14 +1,77 @@
 """Base vector store index query."""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, List, NamedTuple, Optional, Union
 
-from llama_index import QueryBundle, StorageContext, load_index_from_storage
+import faiss
+import numpy as np
+from llama_index import GPTVectorStoreIndex, QueryBundle, ServiceContext, StorageContext, load_index_from_storage
 from llama_index.data_structs import NodeWithScore, IndexDict
+from llama_index.embeddings.base import BaseEmbedding
 from llama_index.indices.utils import log_vector_store_query_result
 from llama_index.indices.vector_store import VectorIndexRetriever
+from llama_index.schema import ImageNode
+from llama_index.storage.docstore import SimpleDocumentStore
+from llama_index.storage.index_store import SimpleIndexStore
 from llama_index.token_counter.token_counter import llm_token_counter
 from llama_index.vector_stores import FaissVectorStore
-from llama_index.vector_stores.types import VectorStoreQuery
+from llama_index.vector_stores.types import DEFAULT_PERSIST_FNAME, VectorStoreQuery
+
+from data_collection.embedding_cache import QueryEmbeddingCache, embed_queries
+from data_collection.index_builder import (DATATYPES, HashingEmbedder, get_datapath, has_exact_distances,
+                                           read_embedder_info, set_search_params)
+from data_collection.node_store import (NODE_IDS_NAME, NodeStore, PackedStrings, RetrievedCaption, node_store_exists,
+                                        packed_strings_exist, write_node_store, write_packed_strings)
+
+# memory-map the vectors/codes of the faiss index instead of reading them into memory
+FAISS_MMAP_FLAGS = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+
+class HashingEmbedding(BaseEmbedding):
+    """llama_index embed model of index_builder.HashingEmbedder, for the queries of the indexes built with it."""
+
+    dim: int = 256
+
+    @classmethod
+    def class_name(cls) -> str:
+        return 'HashingEmbedding'
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        return HashingEmbedder(self.dim).embed_texts(texts).tolist()
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._embed([query])[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts)
+
+
+def get_embed_model(persist_dir: str, faiss_index: faiss.Index):
+    """The embed model of the queries of a persisted index: that of the embedder it was built with."""
+    embedder_info = read_embedder_info(persist_dir)
+    if embedder_info['dim'] != faiss_index.d:
+        raise ValueError(f'The index in {persist_dir} has {faiss_index.d}-d vectors, '
+                         f'but its {embedder_info["embedder"]} embedder {embedder_info["dim"]}-d ones')
+    if embedder_info['embedder'] == 'hashing':
+        # the model name keys the query embeddings of the QueryEmbeddingCache
+        return HashingEmbedding(dim=embedder_info['dim'], model_name=f'hashing-{embedder_info["dim"]}')
+    return ServiceContext.from_defaults().embed_model
+
+
+def embed_query_strs(embed_model, query_strs: List[str],
+                     embedding_cache: Optional[QueryEmbeddingCache] = None) -> np.ndarray:
+    """Query embeddings of the query strings, through the shared cache if there is one."""
+    if embedding_cache is not None:
+        return embedding_cache.get_embeddings(embed_model, query_strs)
+    return embed_queries(embed_model, query_strs)
 
 
 class FaissVectorIndexRetriever(VectorIndexRetriever):
@@ -26,15 +89,23 @@ class FaissVectorIndexRetriever(VectorIndexRetriever):
         vector_store_kwargs (dict): Additional vector store specific kwargs to pass
             through to the vector store at query time.
 
+    Set `embedding_cache` to share query embeddings with the retrievers of the other datasets.
+
     """
 
+    embedding_cache: Optional[QueryEmbeddingCache] = None
+
     @llm_token_counter("retrieve")
     def _retrieve(
             self,
             query_bundle: QueryBundle,
     ) -> List[NodeWithScore]:
         if self._vector_store.is_embedding_query:
-            if query_bundle.embedding is None:
+            if query_bundle.embedding is None and self.embedding_cache is not None:
+                query_bundle.embedding = self.embedding_cache.get_embeddings(
+                    self._service_context.embed_model, query_bundle.embedding_strs
+                ).mean(axis=0).tolist()
+            elif query_bundle.embedding is None:
                 query_bundle.embedding = (
                     self._service_context.embed_model.get_agg_embedding_from_queries(
                         query_bundle.embedding_strs
@@ -73,34 +144,316 @@ class FaissVectorIndexRetriever(VectorIndexRetriever):
             score: Optional[float] = None
             if query_result.similarities is not None:
                 score = query_result.similarities[ind]
-            node_with_scores.append(NodeWithScore(node, score=score))
+            node_with_scores.append(NodeWithScore(node=node, score=score))
 
         return node_with_scores
 
+    def retrieve_batch(self, query_strs: List[str], batch_size: int = 1024) -> List[List[NodeWithScore]]:
+        """Retrieve the top k nodes of many queries at once.
+
+        The distinct query strings are embedded together (see embedding_cache.embed_queries), and every
+        `batch_size` queries run as one FAISS search over a matrix of query vectors; the nodes of
+        a whole batch are fetched from the docstore together.
+
+        Returns:
+            List[List[NodeWithScore]]: the results of each query, same as `retrieve(query_str)`.
+
+        """
+        unique_query_strs = list(dict.fromkeys(query_strs))
+        embeddings = embed_query_strs(self._service_context.embed_model, unique_query_strs, self.embedding_cache)
+        query_positions = {query_str: i for i, query_str in enumerate(unique_query_strs)}
+
+        faiss_index = self._vector_store.client
+        unique_results: List[List[NodeWithScore]] = []
+        for start in range(0, len(unique_query_strs), batch_size):
+            dists, indices = faiss_index.search(embeddings[start:start + batch_size], self._similarity_top_k)
+            # faiss pads the results with -1 when there are fewer than k vectors
+            node_ids = [self._doc_ids[int(idx)] for idx in indices.ravel() if idx >= 0]
+            nodes = dict(zip(node_ids, self._docstore.get_nodes(node_ids)))
+            for query_dists, query_indices in zip(dists, indices):
+                unique_results.append([
+                    NodeWithScore(node=nodes[self._doc_ids[int(idx)]], score=float(dist))
+                    for dist, idx in zip(query_dists, query_indices) if idx >= 0
+                ])
+
+        return [unique_results[query_positions[query_str]] for query_str in query_strs]
+
+
+class CompactFaissRetriever:
+    """Retriever over a faiss index and its NodeStore.
+
+    Results are lightweight (text, image, score) RetrievedCaption records, read from the memory-mapped
+    node store by faiss id, without deserializing llama_index nodes from the docstore.
+
+    """
+
+    def __init__(self, faiss_index: faiss.Index, node_store: NodeStore, embed_model, similarity_top_k: int = 10,
+                 embedding_cache: Optional[QueryEmbeddingCache] = None):
+        self.faiss_index = faiss_index
+        self.node_store = node_store
+        self.embed_model = embed_model
+        self.similarity_top_k = similarity_top_k
+        self.embedding_cache = embedding_cache
+
+    def _search(self, embeddings: np.ndarray) -> List[List[RetrievedCaption]]:
+        dists, indices = self.faiss_index.search(embeddings, self.similarity_top_k)
+        # faiss pads the results with -1 when there are fewer than k vectors
+        return [[self.node_store.get_caption(int(idx), float(dist))
+                 for dist, idx in zip(query_dists, query_indices) if idx >= 0]
+                for query_dists, query_indices in zip(dists, indices)]
+
+    def retrieve(self, query_str: str) -> List[RetrievedCaption]:
+        if self.embedding_cache is not None:
+            return self._search(self.embedding_cache.get_embeddings(self.embed_model, [query_str]))[0]
+        embedding = self.embed_model.get_agg_embedding_from_queries([query_str])
+        return self._search(np.array([embedding], dtype="float32"))[0]
+
+    def retrieve_batch(self, query_strs: List[str], batch_size: int = 1024) -> List[List[RetrievedCaption]]:
+        """Same batching as FaissVectorIndexRetriever.retrieve_batch."""
+        unique_query_strs = list(dict.fromkeys(query_strs))
+        embeddings = embed_query_strs(self.embed_model, unique_query_strs, self.embedding_cache)
+        query_positions = {query_str: i for i, query_str in enumerate(unique_query_strs)}
+
+        unique_results: List[List[RetrievedCaption]] = []
+        for start in range(0, len(unique_query_strs), batch_size):
+            unique_results.extend(self._search(embeddings[start:start + batch_size]))
+        return [unique_results[query_positions[query_str]] for query_str in query_strs]
+
+
+def to_retrieved_caption(result: Union[NodeWithScore, RetrievedCaption]) -> RetrievedCaption:
+    if isinstance(result, RetrievedCaption):
+        return result
+    return RetrievedCaption(text=result.node.text, image=result.node.image, score=float(result.score))
+
+
+def get_node_ids(persist_dir: str) -> PackedStrings:
+    """The faiss id -> node id table of a persisted index, compiled from its index store on first use."""
+    if not packed_strings_exist(persist_dir, NODE_IDS_NAME):
+        index_struct = SimpleIndexStore.from_persist_dir(persist_dir).index_structs()[0]
+        assert isinstance(index_struct, IndexDict)
+        nodes_dict = index_struct.nodes_dict
+        write_packed_strings(persist_dir, NODE_IDS_NAME, (nodes_dict[str(i)] for i in range(len(nodes_dict))))
+    return PackedStrings(persist_dir, NODE_IDS_NAME)
+
+
+def get_node_store(persist_dir: str) -> NodeStore:
+    """The node store of a persisted index, compiled from its docstore on first use."""
+    if not node_store_exists(persist_dir):
+        node_ids = get_node_ids(persist_dir)
+        nodes = SimpleDocumentStore.from_persist_dir(persist_dir).get_nodes(list(node_ids))
+        write_node_store(persist_dir, (node.text for node in nodes), (node.image for node in nodes))
+    return NodeStore(persist_dir)
+
+
+class NodeStoreDocstore:
+    """
+    Docstore of load_mmap_retriever. FaissVectorIndexRetriever only calls get_nodes, here with faiss ids (the
+    doc ids of the retriever are range(n)), and the nodes are rebuilt from the memory-mapped node store instead
+    of the SimpleDocumentStore of the whole corpus. They have the node id, text and image of the docstore nodes,
+    but not their metadata.
+    """
 
-def get_retriever(root_dir):
-    datatypes = ['sherlock', 'coco', 'narratives']
+    def __init__(self, node_ids: PackedStrings, node_store: NodeStore):
+        self.node_ids = node_ids
+        self.node_store = node_store
+
+    def get_nodes(self, faiss_ids: List[int], raise_error: bool = True) -> List[ImageNode]:
+        return [ImageNode(id_=self.node_ids[int(faiss_id)], text=self.node_store.texts[int(faiss_id)],
+                          image=self.node_store.get_image(int(faiss_id)))
+                for faiss_id in faiss_ids]
+
+
+def load_compact_retriever(persist_dir: str, similarity_top_k: int = 10,
+                           nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                           embedding_cache: Optional[QueryEmbeddingCache] = None) -> CompactFaissRetriever:
+    faiss_index = faiss.read_index(os.path.join(persist_dir, DEFAULT_PERSIST_FNAME), FAISS_MMAP_FLAGS)
+    set_search_params(faiss_index, nprobe=nprobe, ef_search=ef_search)
+    return CompactFaissRetriever(faiss_index, get_node_store(persist_dir), get_embed_model(persist_dir, faiss_index),
+                                 similarity_top_k=similarity_top_k, embedding_cache=embedding_cache)
+
+
+def load_mmap_retriever(persist_dir: str, similarity_top_k: int = 10,
+                        nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                        embedding_cache: Optional[QueryEmbeddingCache] = None) -> FaissVectorIndexRetriever:
+    """
+    Loads a retriever without the index struct and the docstore: the faiss index is memory-mapped, and the
+    nodes of the results are read by faiss id from the node id table and the node store (NodeStoreDocstore),
+    so that none of them is held as Python objects.
+    """
+    faiss_index = faiss.read_index(os.path.join(persist_dir, DEFAULT_PERSIST_FNAME), FAISS_MMAP_FLAGS)
+    set_search_params(faiss_index, nprobe=nprobe, ef_search=ef_search)
+    node_ids = get_node_ids(persist_dir)
+    storage_context = StorageContext.from_defaults(vector_store=FaissVectorStore(faiss_index=faiss_index),
+                                                   docstore=NodeStoreDocstore(node_ids, get_node_store(persist_dir)))
+    service_context = ServiceContext.from_defaults(embed_model=get_embed_model(persist_dir, faiss_index))
+    # FaissVectorIndexRetriever maps faiss ids through doc_ids, here to themselves; the (empty) index struct is unused
+    index = GPTVectorStoreIndex(index_struct=IndexDict(), storage_context=storage_context,
+                                service_context=service_context)
+    retriever = FaissVectorIndexRetriever(index, doc_ids=range(len(node_ids)), similarity_top_k=similarity_top_k)
+    retriever.embedding_cache = embedding_cache
+    return retriever
+
+
+class LazyFaissRetriever:
+    """
+    Retriever of a persisted index that is only loaded on the first query, with load_mmap_retriever,
+    or with load_compact_retriever if compact.
+    """
+
+    def __init__(self, persist_dir: str, similarity_top_k: int = 10,
+                 nprobe: Optional[int] = None, ef_search: Optional[int] = None, compact: bool = False,
+                 embedding_cache: Optional[QueryEmbeddingCache] = None):
+        self.persist_dir = persist_dir
+        self.compact = compact
+        self.embedding_cache = embedding_cache
+        self.similarity_top_k = similarity_top_k
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self._retriever: Optional[Union[FaissVectorIndexRetriever, CompactFaissRetriever]] = None
+        self._lock = threading.Lock()
+
+    def get_retriever(self) -> Union[FaissVectorIndexRetriever, CompactFaissRetriever]:
+        with self._lock:
+            if self._retriever is None:
+                load_retriever = load_compact_retriever if self.compact else load_mmap_retriever
+                self._retriever = load_retriever(self.persist_dir, self.similarity_top_k,
+                                                 nprobe=self.nprobe, ef_search=self.ef_search,
+                                                 embedding_cache=self.embedding_cache)
+            return self._retriever
+
+    def retrieve(self, query_str: str) -> List[Union[NodeWithScore, RetrievedCaption]]:
+        return self.get_retriever().retrieve(query_str)
+
+    def retrieve_batch(self, query_strs: List[str],
+                       batch_size: int = 1024) -> List[List[Union[NodeWithScore, RetrievedCaption]]]:
+        return self.get_retriever().retrieve_batch(query_strs, batch_size=batch_size)
+
+
+def get_faiss_index(
+        retriever: Union[FaissVectorIndexRetriever, CompactFaissRetriever, LazyFaissRetriever]) -> faiss.Index:
+    if isinstance(retriever, LazyFaissRetriever):
+        retriever = retriever.get_retriever()
+    if isinstance(retriever, CompactFaissRetriever):
+        return retriever.faiss_index
+    return retriever._vector_store.client
+
+
+def retrieve_batch(retrievers: Dict[str, Union[FaissVectorIndexRetriever, LazyFaissRetriever]],
+                   query_strs: List[str],
+                   batch_size: int = 1024) -> Dict[str, List[List[Union[NodeWithScore, RetrievedCaption]]]]:
+    """Batched retrieval with every retriever of `get_retriever`, keyed by datatype."""
+    return {name: retriever.retrieve_batch(query_strs, batch_size=batch_size)
+            for name, retriever in retrievers.items()}
+
+
+class FusedCaption(NamedTuple):
+    datatype: str
+    text: str
+    image: str
+    score: float
+
+
+def l2_to_cosine(distance: float) -> float:
+    # faiss returns squared L2 distances, and the embeddings are unit-norm: |a - b|^2 = 2 - 2 cos(a, b).
+    # Only for exact distances, see has_exact_distances
+    return 1. - distance / 2.
+
+
+class MultiIndexRetriever:
+    """
+    Searches the retrievers of get_retriever concurrently, one thread per datatype (faiss releases the GIL
+    during a search), so that the latency of a query is that of the slowest index, not the sum of all of them.
+
+    With fused_top_k, fuse() merges the results of all datatypes into a global top k. The L2 distances are
+    normalized to cosine similarities, comparable across the indexes since all of them use the same embeddings.
+    That holds for exact distances only: the PQ/SQ indexes (ivf_pq, sq_fp16, sq_int8) are biased differently
+    by their quantization, and fuse() refuses their results.
+    """
+
+    def __init__(self, retrievers: Dict[str, Union[FaissVectorIndexRetriever, LazyFaissRetriever]],
+                 fused_top_k: Optional[int] = None):
+        self.retrievers = retrievers
+        self.fused_top_k = fused_top_k
+        self._executor = ThreadPoolExecutor(max_workers=max(len(retrievers), 1), thread_name_prefix='retrieve')
+        # datatype -> has_exact_distances of its index
+        self._exact_distances: Dict[str, bool] = {}
+
+    def _has_exact_distances(self, name: str) -> bool:
+        if name not in self._exact_distances:
+            self._exact_distances[name] = has_exact_distances(get_faiss_index(self.retrievers[name]))
+        return self._exact_distances[name]
+
+    def _fan_out(self, method_name: str, *args, **kwargs) -> dict:
+        futures = {name: self._executor.submit(getattr(retriever, method_name), *args, **kwargs)
+                   for name, retriever in self.retrievers.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+    def retrieve(self, query_str: str) -> Dict[str, List[Union[NodeWithScore, RetrievedCaption]]]:
+        return self._fan_out('retrieve', query_str)
+
+    def retrieve_batch(self, query_strs: List[str],
+                       batch_size: int = 1024) -> Dict[str, List[List[Union[NodeWithScore, RetrievedCaption]]]]:
+        return self._fan_out('retrieve_batch', query_strs, batch_size=batch_size)
+
+    def fuse(self, results: Dict[str, List[Union[NodeWithScore, RetrievedCaption]]]) -> List[FusedCaption]:
+        """
+        :param results: results of a single query, keyed by datatype
+        :return: the fused_top_k results of all datatypes with the highest cosine similarity, all of them if not set
+        """
+        approximate = [name for name in results if not self._has_exact_distances(name)]
+        if len(approximate) > 0:
+            raise ValueError(f'The indexes of {", ".join(approximate)} are quantized, their approximate distances '
+                             f'are not comparable across indexes. Fuse only flat, ivf_flat or hnsw indexes.')
+        fused = [FusedCaption(datatype=name, text=caption.text, image=caption.image,
+                              score=l2_to_cosine(caption.score))
+                 for name, retrieved_results in results.items()
+                 for caption in map(to_retrieved_caption, retrieved_results)]
+        fused.sort(key=lambda caption: caption.score, reverse=True)
+        return fused[:self.fused_top_k]
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+
+def get_retriever(root_dir, nprobe=None, ef_search=None, load_mode='eager', embedding_cache=None,
+                  similarity_top_k=10):
+    """
+    nprobe (IVF indexes) and ef_search (HNSW indexes) trade recall for latency at query time,
+    see scripts/benchmark_faiss_index.py; they are ignored for the other index types.
+    With load_mode='mmap', each index is opened on its first query, memory-mapped (see LazyFaissRetriever),
+    and the nodes of the results are read from its node store instead of the docstore.
+    load_mode='compact' is the same, but the retrievers return RetrievedCaption records instead of llama_index nodes.
+    All retrievers share the QueryEmbeddingCache embedding_cache, so each distinct query is embedded once.
+    similarity_top_k is the number of results per query for all datatypes, or a dict of datatype -> k (default 10).
+    """
     retrievers = {}
-    for datatype in datatypes:
-        if datatype == 'sherlock':
-            datapath = f'{root_dir}/sherlock_dataset/sherlock_train_v1_1.json'
-        elif datatype == 'narratives':
-            datapath = f'{root_dir}/openimages_localized_narratives/open_images_train_v6_captions.jsonl'
-        elif datatype == 'coco':
-            datapath = f'{root_dir}/coco/dataset_coco.json'
-        else:
-            raise NotImplementedError
+    for datatype in DATATYPES:
+        datapath = get_datapath(datatype, root_dir)
+        persist_dir = str(Path(datapath).parent / f'{datatype}_index')
+        top_k = similarity_top_k.get(datatype, 10) if isinstance(similarity_top_k, dict) else similarity_top_k
 
-        try:
-            persist_dir = str(Path(datapath).parent / f'{datatype}_index')
+        if load_mode in ['mmap', 'compact']:
+            if not os.path.exists(os.path.join(persist_dir, DEFAULT_PERSIST_FNAME)):
+                print(f'Failed to load {datatype} retriever, no index in {persist_dir}')
+                continue
+            retrievers[datatype] = LazyFaissRetriever(persist_dir, similarity_top_k=top_k,
+                                                      nprobe=nprobe, ef_search=ef_search,
+                                                      compact=load_mode == 'compact',
+                                                      embedding_cache=embedding_cache)
+            continue
 
+        try:
             vector_store = FaissVectorStore.from_persist_dir(persist_dir=persist_dir)
+            set_search_params(vector_store.client, nprobe=nprobe, ef_search=ef_search)
             storage_context = StorageContext.from_defaults(vector_store=vector_store, persist_dir=persist_dir)
-            index = load_index_from_storage(storage_context=storage_context)
+            embed_model = get_embed_model(persist_dir, vector_store.client)
+            service_context = ServiceContext.from_defaults(embed_model=embed_model)
+            index = load_index_from_storage(storage_context=storage_context, service_context=service_context)
 
             retriever = FaissVectorIndexRetriever(index,
                                                   doc_ids=list(index.index_struct.nodes_dict.values()),
-                                                  similarity_top_k=10)
+                                                  similarity_top_k=top_k)
+            retriever.embedding_cache = embedding_cache
             retrievers[datatype] = retriever
         except Exception as e:
             print(f'Failed to load {datatype} retriever, {e}')
@@ -1,7 +1,10 @@
 import argparse
 import csv
+import multiprocessing
+import multiprocessing.pool
 from collections import defaultdict
-from typing import List, Dict, Union, Any
+from contextlib import contextmanager
+from typing import List, Dict, Union, Any, Optional, Tuple, Mapping, Iterator, Set
 
 import jsonlines
 import numpy as np
@@ -10,17 +13,33 @@ from pycocoevalcap.meteor.meteor import Meteor
 from rouge_score import rouge_scorer
 from tabulate import tabulate
 
+from reference_index import CompiledReferences, file_sha256, load_compiled_reference_data
+from score_store import ScoreStore
+from vectorized_metrics import VectorizedMetricBackend
+
+# number of METEOR SCORE requests written to the Java process before reading their replies
+METEOR_PIPELINE_CHUNK_SIZE = 256
+# number of questions (per worker) scored between two commits to the score store
+SCORE_STORE_CHUNK_SIZE = 1000
+# BLEU/ROUGE backends of ModelEvaulator
+METRIC_BACKENDS = ['pycocoevalcap', 'vectorized']
+
 
 class ModelEvaulator:
 
-    def __init__(self, metrics=None):
+    def __init__(self, metrics=None, backend: str = 'pycocoevalcap'):
         """
             :param: reference: a list of annotated data
             :param: predictions: a dictionary with id as key and prediction as value
                             prediction can be either
                             - a list of strings
                             - a list of dictionaries with quetion and answer as keys
+            :param: backend: 'pycocoevalcap' or 'vectorized', which computes BLEU and ROUGE of
+                            evaluate_batch over token-id arrays (see vectorized_metrics.py)
         """
+        if backend not in METRIC_BACKENDS:
+            # before the METEOR Java process is started
+            raise ValueError(f'Unknown metric backend: {backend}, expected one of {", ".join(METRIC_BACKENDS)}')
         METRICS_ANSWER = ["answer"]
         METRICS_EXPLANATION = ["bleu1", "bleu2", "bleu3", "bleu4",
                                "rouge1", "rouge2", "rougeL", "meteor"]
@@ -31,27 +50,33 @@ class ModelEvaulator:
         self.meteor = Meteor()
         self.bleu = Bleu(4)
         self.rouge_scorer = rouge_scorer.RougeScorer(['rouge1', 'rouge2', 'rougeL'], use_stemmer=True)
+        self.backend = backend
+        if backend == 'vectorized':
+            self.vectorized_backend = VectorizedMetricBackend()
 
-    def evaluate(self,
-                 prediction_judgment: int,
-                 prediction_explanation: str,
-                 reference_answer_judgment: List[int],
-                 reference_answer_explanation: List[str]) -> Dict[str, float]:
+    def use_compiled_references(self, compiled_references: CompiledReferences) -> None:
+        """
+            Reuses the tokens stored in the reference cache instead of re-tokenizing/stemming the references.
+        """
+        if self.backend == 'vectorized':
+            for explanation, bleu_tokens, rouge_tokens in compiled_references.iter_tokens():
+                self.vectorized_backend.add_pretokenized(explanation, bleu_tokens, rouge_tokens)
+
+    def _align_explanations(self,
+                            prediction_judgment: int,
+                            prediction_explanation: str,
+                            reference_answer_judgment: List[int],
+                            reference_answer_explanation: List[str]) -> Tuple[str, List[str]]:
         aligned_answer_explanations = []
         prediction_explanation = prediction_explanation.lower().strip()
         for id, ans in enumerate(reference_answer_judgment):
             if ans == prediction_judgment:
                 aligned_answer_explanations.append(reference_answer_explanation[id].lower().strip())
+        return prediction_explanation, aligned_answer_explanations
 
-        if len(aligned_answer_explanations) == 0:
-            return {metric: 0. for metric in self.metrics}
-
-        # bleu
-        bleu_scores = self.bleu.compute_score({0: aligned_answer_explanations},
-                                              {0: [prediction_explanation]},
-                                              verbose=0)[0]
-        meteor_scores = self.meteor.compute_score({0: aligned_answer_explanations},
-                                                  {0: [prediction_explanation]})[0]
+    def _compute_rouge_scores(self,
+                              aligned_answer_explanations: List[str],
+                              prediction_explanation: str) -> Dict[str, float]:
         _rouge_scores = [self.rouge_scorer.score(aligned_answer_explanation, prediction_explanation)
                          for aligned_answer_explanation in aligned_answer_explanations]
         rouge_scores = {}
@@ -59,7 +84,41 @@ class ModelEvaulator:
             rouge_scores[rouge_metric] = sum(
                 [rouge_score[rouge_metric].fmeasure for rouge_score in _rouge_scores]) / len(
                 _rouge_scores)
+        return rouge_scores
 
+    def _compute_meteor_segment_scores(self,
+                                       gts: Dict[int, List[str]],
+                                       res: Dict[int, List[str]]) -> List[float]:
+        """
+            Same protocol as Meteor.compute_score, but the SCORE requests are written in chunks
+            before reading their replies, and a single EVAL line covers the whole batch.
+        """
+        meteor_p = self.meteor.meteor_p
+        segment_ids = list(gts.keys())
+        stats = []
+        with self.meteor.lock:
+            for start in range(0, len(segment_ids), METEOR_PIPELINE_CHUNK_SIZE):
+                chunk = segment_ids[start:start + METEOR_PIPELINE_CHUNK_SIZE]
+                for segment_id in chunk:
+                    hypothesis = res[segment_id][0].replace('|||', '').replace('  ', ' ')
+                    score_line = ' ||| '.join(('SCORE', ' ||| '.join(gts[segment_id]), hypothesis))
+                    meteor_p.stdin.write('{}\n'.format(score_line).encode())
+                meteor_p.stdin.flush()
+                for _ in chunk:
+                    stats.append(meteor_p.stdout.readline().decode().strip())
+
+            eval_line = ' ||| '.join(['EVAL'] + stats)
+            meteor_p.stdin.write('{}\n'.format(eval_line).encode())
+            meteor_p.stdin.flush()
+            scores = [float(meteor_p.stdout.readline().strip()) for _ in segment_ids]
+            # aggregated score over the batch, not used
+            meteor_p.stdout.readline()
+        return scores
+
+    def _output_scores(self,
+                       bleu_scores: List[float],
+                       meteor_scores: float,
+                       rouge_scores: Dict[str, float]) -> Dict[str, float]:
         output_scores = {}
         for metric in self.metrics:
             if 'bleu' in metric:
@@ -74,6 +133,67 @@ class ModelEvaulator:
         output_scores["answer"] = 100.0
         return output_scores
 
+    def evaluate(self,
+                 prediction_judgment: int,
+                 prediction_explanation: str,
+                 reference_answer_judgment: List[int],
+                 reference_answer_explanation: List[str]) -> Dict[str, float]:
+        prediction_explanation, aligned_answer_explanations = self._align_explanations(
+            prediction_judgment, prediction_explanation, reference_answer_judgment, reference_answer_explanation)
+
+        if len(aligned_answer_explanations) == 0:
+            return {metric: 0. for metric in self.metrics}
+
+        # bleu
+        bleu_scores = self.bleu.compute_score({0: aligned_answer_explanations},
+                                              {0: [prediction_explanation]},
+                                              verbose=0)[0]
+        meteor_scores = self.meteor.compute_score({0: aligned_answer_explanations},
+                                                  {0: [prediction_explanation]})[0]
+        rouge_scores = self._compute_rouge_scores(aligned_answer_explanations, prediction_explanation)
+
+        return self._output_scores(bleu_scores, meteor_scores, rouge_scores)
+
+    def evaluate_batch(self,
+                       questions: List[Tuple[int, str, List[int], List[str]]]) -> List[Dict[str, float]]:
+        """
+            Scores many questions with one bulk BLEU call and one bulk METEOR call.
+            :param: questions: a list of (prediction_judgment, prediction_explanation,
+                               reference_answer_judgment, reference_answer_explanation)
+            :return: the scores of each question, in the same order as the input
+        """
+        output_scores = [{metric: 0. for metric in self.metrics} for _ in questions]
+
+        gts, res = {}, {}
+        for index, question in enumerate(questions):
+            prediction_explanation, aligned_answer_explanations = self._align_explanations(*question)
+            if len(aligned_answer_explanations) > 0:
+                gts[index] = aligned_answer_explanations
+                res[index] = [prediction_explanation]
+
+        if len(gts) == 0:
+            return output_scores
+
+        # per-segment scores come back in the order of gts.keys()
+        meteor_segment_scores = self._compute_meteor_segment_scores(gts, res)
+        if self.backend == 'vectorized':
+            bleu_segment_scores = self.vectorized_backend.compute_bleu(gts, res).T
+            rouge_segment_scores = self.vectorized_backend.compute_rouge(gts, res)
+        else:
+            bleu_segment_scores = self.bleu.compute_score(gts, res, verbose=0)[1]
+            rouge_segment_scores = None
+
+        for segment_id, index in enumerate(gts.keys()):
+            bleu_scores = [float(bleu_n_scores[segment_id]) for bleu_n_scores in bleu_segment_scores]
+            if rouge_segment_scores is not None:
+                rouge_scores = {rouge_metric: float(rouge_segment_scores[rouge_metric][segment_id])
+                                for rouge_metric in rouge_segment_scores}
+            else:
+                rouge_scores = self._compute_rouge_scores(gts[index], res[index][0])
+            output_scores[index] = self._output_scores(bleu_scores, meteor_segment_scores[segment_id], rouge_scores)
+
+        return output_scores
+
 
 def load_prediction_data(prediction_path: str) -> Dict[int, Dict[str, Union[int, str]]]:
     """
@@ -88,6 +208,22 @@ def load_prediction_data(prediction_path: str) -> Dict[int, Dict[str, Union[int,
     return prediction_per_question
 
 
+def iter_prediction_chunks(prediction_path: str, chunk_size: int) -> Iterator[List[Dict[str, Union[int, str]]]]:
+    """
+    Lazily reads the prediction file (same format as load_prediction_data) in chunks of chunk_size lines.
+    Unlike load_prediction_data, every line is kept, including several samples of the same question.
+    """
+    with jsonlines.open(prediction_path) as f:
+        chunk = []
+        for p in f.iter():
+            chunk.append(p)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+
 def load_reference_data(reference_path: str) -> Dict[int, Dict[str, Any]]:
     """
     Example of single instance:
@@ -116,58 +252,270 @@ HA_LABELS = ['WR.', 'OK.', 'IMP.']
 MA_LABELS = ['WR. or IMP.', 'WR. or OK.', 'OK. or IMP.']
 
 
+def get_reference_digest(reference_path: str, reference_per_question: Mapping[int, Dict[str, Any]]) -> str:
+    """
+    :return: file_sha256 of the reference file; the cache directory of compiled references is named after it,
+             the file is then not hashed again
+    """
+    if isinstance(reference_per_question, CompiledReferences):
+        return reference_per_question.cache_dir.name
+    return file_sha256(reference_path)
+
+
+def get_agreement_label(dataset_type: str, reference_answer_judgment: List[int]) -> Optional[str]:
+    # get tag from reference_answer_judgment
+    reference_answer_judgment_set = set(reference_answer_judgment)
+
+    if len(reference_answer_judgment_set) == 1:
+        assert dataset_type == 'high_agreement', 'Check if the reference data is correct'
+        if 0 in reference_answer_judgment_set:
+            label = 'WR.'
+        elif 1 in reference_answer_judgment_set:
+            label = 'OK.'
+        elif 2 in reference_answer_judgment_set:
+            label = 'IMP.'
+        else:
+            raise NotImplementedError
+        return label
+
+    elif len(reference_answer_judgment_set) == 2:
+        assert dataset_type == 'mid_agreement', 'Check if the reference data is correct'
+        if 0 in reference_answer_judgment_set and 1 in reference_answer_judgment_set:
+            label = 'WR. or OK.'
+        elif 0 in reference_answer_judgment_set and 2 in reference_answer_judgment_set:
+            label = 'WR. or IMP.'
+        elif 1 in reference_answer_judgment_set and 2 in reference_answer_judgment_set:
+            label = 'OK. or IMP.'
+        else:
+            raise NotImplementedError
+        return label
+
+    return None
+
+
+def get_reference_label(dataset_type: str, reference: Dict[str, Any]) -> Optional[str]:
+    if 'agreement_label' in reference:
+        # precomputed by the reference cache
+        label = reference['agreement_label']
+        assert label is None or (label in HA_LABELS) == (dataset_type == 'high_agreement'), \
+            'Check if the reference data is correct'
+        return label
+    return get_agreement_label(dataset_type, reference['answer_judgment'])
+
+
+def evaluate_questions(model_evaluator: ModelEvaulator,
+                       dataset_type: str,
+                       pairs: List[Tuple[Dict[str, Union[int, str]], Dict[str, Any]]]
+                       ) -> List[Tuple[Optional[str], Dict[str, float]]]:
+    questions = []
+    labels = []
+    for prediction, reference in pairs:
+        prediction_judgment: int = prediction['answer_judgment']
+        prediction_explanation: str = prediction['answer_explanation'].strip()
+
+        reference_answer_judgment: List[int] = reference['answer_judgment']
+        reference_answer_explanation: List[str] = reference['answer_explanation']
+
+        questions.append((prediction_judgment,
+                          prediction_explanation,
+                          reference_answer_judgment,
+                          reference_answer_explanation))
+        labels.append(get_reference_label(dataset_type, reference))
+
+    results = model_evaluator.evaluate_batch(questions)
+    return list(zip(labels, results))
+
+
+# Each worker process keeps its own evaluator (and METEOR subprocess), created once by the pool initializer.
+_worker_evaluator: Optional[ModelEvaulator] = None
+
+
+def _init_evaluation_worker(metrics: List[str], backend: str, reference_cache_dir: Optional[str]) -> None:
+    global _worker_evaluator
+    _worker_evaluator = ModelEvaulator(metrics, backend=backend)
+    if reference_cache_dir is not None:
+        _worker_evaluator.use_compiled_references(CompiledReferences(reference_cache_dir))
+
+
+def _evaluate_shard(dataset_type: str,
+                    shard: List[Tuple[Dict[str, Union[int, str]], Dict[str, Any]]]
+                    ) -> List[Tuple[Optional[str], Dict[str, float]]]:
+    return evaluate_questions(_worker_evaluator, dataset_type, shard)
+
+
+def create_evaluation_pool(metrics: List[str], workers: int,
+                           backend: str = 'pycocoevalcap',
+                           reference_cache_dir: Optional[str] = None) -> multiprocessing.pool.Pool:
+    return multiprocessing.Pool(processes=workers,
+                                initializer=_init_evaluation_worker,
+                                initargs=(metrics, backend, reference_cache_dir))
+
+
+@contextmanager
+def _evaluation_pool(model_evaluator: ModelEvaulator,
+                     reference_per_question: Mapping[int, Dict[str, Any]],
+                     workers: int,
+                     pool: Optional[multiprocessing.pool.Pool]) -> Iterator[Optional[multiprocessing.pool.Pool]]:
+    if pool is not None or workers <= 1:
+        yield pool
+        return
+
+    reference_cache_dir = None
+    if isinstance(reference_per_question, CompiledReferences):
+        reference_cache_dir = str(reference_per_question.cache_dir)
+    pool = create_evaluation_pool(model_evaluator.metrics, workers, model_evaluator.backend,
+                                  reference_cache_dir)
+    try:
+        yield pool
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _evaluate_pairs(model_evaluator: ModelEvaulator,
+                    dataset_type: str,
+                    pairs: List[Tuple[Dict[str, Union[int, str]], Dict[str, Any]]],
+                    pool: Optional[multiprocessing.pool.Pool],
+                    workers: int) -> List[Tuple[Optional[str], Dict[str, float]]]:
+    if pool is None:
+        return evaluate_questions(model_evaluator, dataset_type, pairs)
+
+    # contiguous shards, so that concatenating them keeps the serial order
+    num_shards = max(1, min(len(pairs), workers * 4))
+    shard_size = (len(pairs) + num_shards - 1) // num_shards
+    shards = [pairs[i:i + shard_size] for i in range(0, len(pairs), shard_size)]
+    shard_results = pool.starmap(_evaluate_shard, [(dataset_type, shard) for shard in shards])
+    return [labeled_result for shard_result in shard_results for labeled_result in shard_result]
+
+
+def _evaluate_pairs_with_store(model_evaluator: ModelEvaulator,
+                               dataset_type: str,
+                               pairs: List[Tuple[Dict[str, Union[int, str]], Dict[str, Any]]],
+                               pool: Optional[multiprocessing.pool.Pool],
+                               workers: int,
+                               score_store: Optional[ScoreStore]) -> List[Tuple[Optional[str], Dict[str, float]]]:
+    if score_store is None:
+        return _evaluate_pairs(model_evaluator, dataset_type, pairs, pool, workers)
+
+    keys = [ScoreStore.get_key(prediction['question_id'],
+                               prediction['answer_judgment'],
+                               prediction['answer_explanation'].strip())
+            for prediction, _ in pairs]
+    labeled_results = [(get_reference_label(dataset_type, reference), result)
+                       for (_, reference), result in zip(pairs, score_store.get_many(keys))]
+
+    # score the missing ones chunk by chunk, storing each chunk so that an interrupted run can resume
+    missing = [i for i, (_, result) in enumerate(labeled_results) if result is None]
+    chunk_size = SCORE_STORE_CHUNK_SIZE * workers
+    for start in range(0, len(missing), chunk_size):
+        chunk = missing[start:start + chunk_size]
+        chunk_results = _evaluate_pairs(model_evaluator, dataset_type, [pairs[i] for i in chunk], pool, workers)
+        score_store.put_many([(keys[i], result) for i, (_, result) in zip(chunk, chunk_results)])
+        for i, labeled_result in zip(chunk, chunk_results):
+            labeled_results[i] = labeled_result
+
+    return labeled_results
+
+
 def run_evaluation(model_evaluator: ModelEvaulator,
                    dataset_type: str,
                    prediction_per_question: Dict[int, Dict[str, Union[int, str]]],
-                   reference_per_question: Dict[int, Dict[str, Any]]) -> Dict[str, List[Dict[str, float]]]:
+                   reference_per_question: Mapping[int, Dict[str, Any]],
+                   workers: int = 1,
+                   pool: Optional[multiprocessing.pool.Pool] = None,
+                   score_store: Optional[ScoreStore] = None) -> Dict[str, List[Dict[str, float]]]:
+    """
+        :param: workers: number of processes to shard the questions across (1 means serial)
+        :param: pool: an existing pool from create_evaluation_pool, reused instead of starting a new one
+        :param: score_store: per-question scores from earlier runs; only new or changed predictions are scored
+    """
     evaluation_results = defaultdict(list)
 
+    pairs = []
     for question_id in prediction_per_question:
         assert question_id in reference_per_question, f'{question_id} not in reference_per_question'
-        prediction_judgment: int = prediction_per_question[question_id]['answer_judgment']
-        prediction_explanation: str = prediction_per_question[question_id]['answer_explanation'].strip()
-
-        reference_answer_judgment: List[int] = reference_per_question[question_id]['answer_judgment']
-        reference_answer_explanation: List[str] = reference_per_question[question_id]['answer_explanation'].strip()
-
-        result = model_evaluator.evaluate(prediction_judgment,
-                                          prediction_explanation,
-                                          reference_answer_judgment,
-                                          reference_answer_explanation)
-
-        # get tag from reference_answer_judgment
-        reference_answer_judgment_set = set(reference_answer_judgment)
-
-        if len(reference_answer_judgment_set) == 1:
-            assert dataset_type == 'high_agreement', 'Check if the reference data is correct'
-            if 0 in reference_answer_judgment_set:
-                label = 'WR.'
-            elif 1 in reference_answer_judgment_set:
-                label = 'OK.'
-            elif 2 in reference_answer_judgment_set:
-                label = 'IMP.'
-            else:
-                raise NotImplementedError
-            evaluation_results[label].append(result)
+        pairs.append((prediction_per_question[question_id], reference_per_question[question_id]))
 
-        elif len(reference_answer_judgment_set) == 2:
-            assert dataset_type == 'mid_agreement', 'Check if the reference data is correct'
-            if 0 in reference_answer_judgment_set and 1 in reference_answer_judgment_set:
-                label = 'WR. or OK.'
-            elif 0 in reference_answer_judgment_set and 2 in reference_answer_judgment_set:
-                label = 'WR. or IMP.'
-            elif 1 in reference_answer_judgment_set and 2 in reference_answer_judgment_set:
-                label = 'OK. or IMP.'
-            else:
-                raise NotImplementedError
+    with _evaluation_pool(model_evaluator, reference_per_question, workers, pool) as pool:
+        labeled_results = _evaluate_pairs_with_store(model_evaluator, dataset_type, pairs, pool, max(workers, 1),
+                                                     score_store)
+
+    for label, result in labeled_results:
+        if label is not None:
             evaluation_results[label].append(result)
 
     return evaluation_results
 
 
-def display_evaluation_results(model_evaluator: ModelEvaulator,
-                               dataset_type: str,
-                               evaluation_results: Dict[str, List[Dict[str, float]]]):
+class LabelAggregate:
+    """
+        Running count and per-metric sums of the results of one label, used instead of a list of results
+        when streaming, so that memory does not grow with the prediction file.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sums = defaultdict(float)
+
+    def add(self, result: Dict[str, float]) -> None:
+        self.count += 1
+        for metric, score in result.items():
+            self.sums[metric] += score
+
+    def mean(self, metric: str) -> float:
+        if self.count == 0:
+            return float('nan')
+        return self.sums[metric] / self.count
+
+    def __len__(self) -> int:
+        return self.count
+
+
+def run_streaming_evaluation(model_evaluator: ModelEvaulator,
+                             dataset_type: str,
+                             prediction_path: str,
+                             reference_per_question: Mapping[int, Dict[str, Any]],
+                             chunk_size: int = 1000,
+                             workers: int = 1,
+                             pool: Optional[multiprocessing.pool.Pool] = None,
+                             score_store: Optional[ScoreStore] = None
+                             ) -> Tuple[Dict[str, LabelAggregate], Set[int]]:
+    """
+        Reads the predictions lazily and folds the scores into running per-label aggregates.
+        Every prediction line is scored, so several samples of a question all count towards its label.
+        :return: the aggregates per label, and the question ids seen in the prediction file
+    """
+    evaluation_results = defaultdict(LabelAggregate)
+    seen_question_ids = set()
+
+    workers = max(workers, 1)
+    with _evaluation_pool(model_evaluator, reference_per_question, workers, pool) as pool:
+        for chunk in iter_prediction_chunks(prediction_path, chunk_size * workers):
+            pairs = []
+            for prediction in chunk:
+                question_id = prediction['question_id']
+                assert question_id in reference_per_question, f'{question_id} not in reference_per_question'
+                seen_question_ids.add(question_id)
+                pairs.append((prediction, reference_per_question[question_id]))
+
+            for label, result in _evaluate_pairs_with_store(model_evaluator, dataset_type, pairs, pool, workers,
+                                                            score_store):
+                if label is not None:
+                    evaluation_results[label].add(result)
+
+    return evaluation_results, seen_question_ids
+
+
+def _mean_metric(results: Union[List[Dict[str, float]], LabelAggregate], metric: str) -> float:
+    if isinstance(results, LabelAggregate):
+        return results.mean(metric)
+    return np.mean([r[metric] for r in results])
+
+
+def build_evaluation_table(model_evaluator: ModelEvaulator,
+                           dataset_type: str,
+                           evaluation_results: Dict[str, Union[List[Dict[str, float]], LabelAggregate]]
+                           ) -> Tuple[List[List[Any]], List[str]]:
     metrics = model_evaluator.metrics
 
     tabulate_data = []
@@ -194,55 +542,110 @@ def display_evaluation_results(model_evaluator: ModelEvaulator,
         row = [metric]
         if dataset_type == 'high_agreement':
             for label in HA_LABELS:
-                row.append(np.mean([r[metric] for r in evaluation_results[label]]))
+                row.append(_mean_metric(evaluation_results[label], metric))
             # take average
-            row.append(np.mean([np.mean([r[metric] for r in evaluation_results[label]]) for label in HA_LABELS]))
+            row.append(np.mean([_mean_metric(evaluation_results[label], metric) for label in HA_LABELS]))
         elif dataset_type == 'mid_agreement':
             for label in MA_LABELS:
-                row.append(np.mean([r[metric] for r in evaluation_results[label]]))
+                row.append(_mean_metric(evaluation_results[label], metric))
             # take average
-            row.append(np.mean([np.mean([r[metric] for r in evaluation_results[label]]) for label in MA_LABELS]))
+            row.append(np.mean([_mean_metric(evaluation_results[label], metric) for label in MA_LABELS]))
         tabulate_data.append(row)
 
+    return tabulate_data, header
+
+
+def print_evaluation_table(tabulate_data: List[List[Any]], header: List[str]) -> None:
     print("===== RESULT (with Github format) =====")
     print(tabulate(tabulate_data, headers=header, tablefmt='github', floatfmt=".1f"))
     print('\n\n')
     print("===== RESULT (with Latex format) =====")
     print(tabulate(tabulate_data, headers=header, tablefmt='latex', floatfmt=".1f"))
+
+
+def display_evaluation_results(model_evaluator: ModelEvaulator,
+                               dataset_type: str,
+                               evaluation_results: Dict[str, Union[List[Dict[str, float]], LabelAggregate]]):
+    tabulate_data, header = build_evaluation_table(model_evaluator, dataset_type, evaluation_results)
+    print_evaluation_table(tabulate_data, header)
     return tabulate_data, header
 
 
-parser = argparse.ArgumentParser(description='Moral Judgment Evaluation')
-parser.add_argument('--reference-path', type=str, required=True,
-                    help='Path to the reference (normlens) jsonl file')
-parser.add_argument('--prediction-path', type=str, required=True,
-                    help='Path to the (model) prediction file')
-parser.add_argument('--dataset-type', type=str, choices=['high_agreement', 'mid_agreement'], required=True,
-                    help='Type of the dataset')
-parser.add_argument('--output-csv-path', type=str, default=None,
-                    help='Path to the output csv file')
-args = parser.parse_args()
-
-prediction_per_question = load_prediction_data(args.prediction_path)
-reference_per_question = load_reference_data(args.reference_path)
-assert len(prediction_per_question) == len(reference_per_question), \
-    f'len(prediction_per_question) != len(reference_per_question), '\
-    f'{len(prediction_per_question)} != {len(reference_per_question)}'
-
-moral_evaluator = ModelEvaulator(["answer", "bleu2", "rougeL", "meteor"])
-
-# run evaluation
-evaluation_results = run_evaluation(moral_evaluator, args.dataset_type, prediction_per_question, reference_per_question)
-
-# display evaluation results
-tabulate_data, header = display_evaluation_results(moral_evaluator, args.dataset_type, evaluation_results)
-
-# save the evaluation results
-if args.output_csv_path is not None:
-    csv_path = args.output_csv_path
-    with open(csv_path, 'w') as csvfile:
-        writer = csv.writer(csvfile)
-        for row in tabulate_data:
-            writer.writerow(row)
-
-    print('Evaluation results saved to {}'.format(csv_path))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Moral Judgment Evaluation')
+    parser.add_argument('--reference-path', type=str, required=True,
+                        help='Path to the reference (normlens) jsonl file')
+    parser.add_argument('--prediction-path', type=str, required=True,
+                        help='Path to the (model) prediction file')
+    parser.add_argument('--dataset-type', type=str, choices=['high_agreement', 'mid_agreement'], required=True,
+                        help='Type of the dataset')
+    parser.add_argument('--output-csv-path', type=str, default=None,
+                        help='Path to the output csv file')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes to score the questions with')
+    parser.add_argument('--metric-backend', type=str, choices=METRIC_BACKENDS,
+                        default='pycocoevalcap',
+                        help='Backend for BLEU/ROUGE, the vectorized one scores the whole file over NumPy arrays')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Read the predictions lazily in chunks and keep running per-label aggregates; '
+                             'every line is scored, including several samples of the same question')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='Number of prediction lines scored at once (per worker) in streaming mode')
+    parser.add_argument('--score-store', type=str, default=None,
+                        help='Path to a sqlite file with per-question scores; re-runs only score new or changed '
+                             'predictions, and an interrupted run resumes where it stopped')
+    parser.add_argument('--reference-cache', action='store_true',
+                        help='Load the references from a compiled, memory-mapped cache next to the jsonl file '
+                             '(compiled on first use, see reference_index.py)')
+    args = parser.parse_args()
+
+    if args.reference_cache:
+        reference_per_question = load_compiled_reference_data(args.reference_path)
+    else:
+        reference_per_question = load_reference_data(args.reference_path)
+
+    moral_evaluator = ModelEvaulator(["answer", "bleu2", "rougeL", "meteor"], backend=args.metric_backend)
+    if args.reference_cache:
+        moral_evaluator.use_compiled_references(reference_per_question)
+    score_store = None
+    if args.score_store is not None:
+        score_store = ScoreStore(args.score_store, moral_evaluator.metrics, args.metric_backend,
+                                 get_reference_digest(args.reference_path, reference_per_question))
+
+    # run evaluation
+    if args.streaming:
+        evaluation_results, seen_question_ids = run_streaming_evaluation(moral_evaluator, args.dataset_type,
+                                                                         args.prediction_path, reference_per_question,
+                                                                         chunk_size=args.chunk_size,
+                                                                         workers=args.workers,
+                                                                         score_store=score_store)
+        assert len(seen_question_ids) == len(reference_per_question), \
+            f'len(seen_question_ids) != len(reference_per_question), '\
+            f'{len(seen_question_ids)} != {len(reference_per_question)}'
+    else:
+        prediction_per_question = load_prediction_data(args.prediction_path)
+        assert len(prediction_per_question) == len(reference_per_question), \
+            f'len(prediction_per_question) != len(reference_per_question), '\
+            f'{len(prediction_per_question)} != {len(reference_per_question)}'
+
+        evaluation_results = run_evaluation(moral_evaluator, args.dataset_type,
+                                            prediction_per_question, reference_per_question,
+                                            workers=args.workers,
+                                            score_store=score_store)
+
+    if score_store is not None:
+        print(f'Score store: {score_store.hits} cached, {score_store.misses} scored')
+        score_store.close()
+
+    # display evaluation results
+    tabulate_data, header = display_evaluation_results(moral_evaluator, args.dataset_type, evaluation_results)
+
+    # save the evaluation results
+    if args.output_csv_path is not None:
+        csv_path = args.output_csv_path
+        with open(csv_path, 'w') as csvfile:
+            writer = csv.writer(csvfile)
+            for row in tabulate_data:
+                writer.writerow(row)
+
+        print('Evaluation results saved to {}'.format(csv_path))
@@ -0,0 +1,116 @@
+import argparse
+import csv
+import glob
+import os
+from pathlib import Path
+from typing import List, Dict, Any, Tuple
+
+from evaluation import (METRIC_BACKENDS, ModelEvaulator, build_evaluation_table, create_evaluation_pool,
+                        get_reference_digest, load_compiled_reference_data, load_prediction_data, load_reference_data,
+                        print_evaluation_table, run_evaluation)
+from score_store import ScoreStore
+
+
+def find_prediction_paths(predictions: str) -> List[str]:
+    """
+        :param: predictions: a directory of jsonl prediction files, or a glob pattern
+    """
+    if os.path.isdir(predictions):
+        return sorted(str(path) for path in Path(predictions).glob('*.jsonl'))
+    return sorted(glob.glob(predictions))
+
+
+def build_leaderboard_table(model_tables: List[Tuple[str, List[List[Any]], List[str]]]
+                            ) -> Tuple[List[List[Any]], List[str]]:
+    """
+        Stacks the tables of build_evaluation_table, one row block per model.
+    """
+    tabulate_data = []
+    header = []
+    for model_name, model_tabulate_data, model_header in model_tables:
+        header = ['Model', 'Metric'] + model_header
+        for row in model_tabulate_data:
+            tabulate_data.append([model_name] + row)
+    return tabulate_data, header
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Moral Judgment Leaderboard')
+    parser.add_argument('--reference-path', type=str, required=True,
+                        help='Path to the reference (normlens) jsonl file')
+    parser.add_argument('--predictions', type=str, required=True,
+                        help='Directory of (model) prediction jsonl files, or a glob pattern, e.g. "preds/*.jsonl"')
+    parser.add_argument('--dataset-type', type=str, choices=['high_agreement', 'mid_agreement'], required=True,
+                        help='Type of the dataset')
+    parser.add_argument('--output-csv-path', type=str, default=None,
+                        help='Path to the output csv file')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes to score the questions with, shared by all models')
+    parser.add_argument('--metric-backend', type=str, choices=METRIC_BACKENDS,
+                        default='pycocoevalcap',
+                        help='Backend for BLEU/ROUGE, the vectorized one scores the whole file over NumPy arrays')
+    parser.add_argument('--score-store', type=str, default=None,
+                        help='Path to a sqlite file with per-question scores, shared by all models')
+    parser.add_argument('--reference-cache', action='store_true',
+                        help='Load the references from a compiled, memory-mapped cache next to the jsonl file')
+    args = parser.parse_args()
+
+    prediction_paths = find_prediction_paths(args.predictions)
+    assert len(prediction_paths) > 0, f'No prediction files found for {args.predictions}'
+
+    # references, the evaluator (METEOR JVM, RougeScorer) and the worker pool are set up once for all models
+    if args.reference_cache:
+        reference_per_question = load_compiled_reference_data(args.reference_path)
+    else:
+        reference_per_question = load_reference_data(args.reference_path)
+
+    moral_evaluator = ModelEvaulator(["answer", "bleu2", "rougeL", "meteor"], backend=args.metric_backend)
+    if args.reference_cache:
+        moral_evaluator.use_compiled_references(reference_per_question)
+    score_store = None
+    if args.score_store is not None:
+        score_store = ScoreStore(args.score_store, moral_evaluator.metrics, args.metric_backend,
+                                 get_reference_digest(args.reference_path, reference_per_question))
+
+    pool = None
+    if args.workers > 1:
+        reference_cache_dir = str(reference_per_question.cache_dir) if args.reference_cache else None
+        pool = create_evaluation_pool(moral_evaluator.metrics, args.workers, args.metric_backend, reference_cache_dir)
+
+    model_tables = []
+    try:
+        for prediction_path in prediction_paths:
+            model_name = Path(prediction_path).stem
+            prediction_per_question = load_prediction_data(prediction_path)
+            if len(prediction_per_question) != len(reference_per_question):
+                print(f'Skipping {model_name}: len(prediction_per_question) != len(reference_per_question), '
+                      f'{len(prediction_per_question)} != {len(reference_per_question)}')
+                continue
+
+            evaluation_results: Dict[str, List[Dict[str, float]]] = run_evaluation(
+                moral_evaluator, args.dataset_type, prediction_per_question, reference_per_question,
+                workers=args.workers, pool=pool, score_store=score_store)
+            model_tables.append((model_name,) + build_evaluation_table(moral_evaluator, args.dataset_type,
+                                                                       evaluation_results))
+            print(f'Evaluated {model_name}')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if score_store is not None:
+            score_store.close()
+
+    # display evaluation results
+    tabulate_data, header = build_leaderboard_table(model_tables)
+    print_evaluation_table(tabulate_data, header)
+
+    # save the evaluation results
+    if args.output_csv_path is not None:
+        csv_path = args.output_csv_path
+        with open(csv_path, 'w') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(header)
+            for row in tabulate_data:
+                writer.writerow(row)
+
+        print('Evaluation results saved to {}'.format(csv_path))
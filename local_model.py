@@ -0,0 +1,484 @@
+"""Local inference backend of ChatLanguageModel, on CPU with numpy.
+
+NumpyGPT2 runs a GPT-2 decoder (learned position embeddings, pre-LayerNorm blocks, output embedding tied to the
+input one) from the weights of a GPT-2 checkpoint saved as .npz, or the tiny random model of get_tiny_test_model.
+
+LocalChatModel generates the responses of many conversations with dynamic (continuous) batching: up to
+max_batch_size sequences decode together, each in a slot of a shared KV cache, and a finished sequence
+hands its slot to the next waiting prompt right away instead of waiting for the whole batch. The keys and values
+of the prompt prefix shared by the conversations (system prompt and few-shot examples of USER_PROMPT) are computed
+once and copied into the slots, so only the rest of each prompt is prefilled.
+"""
+import argparse
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import tiktoken
+
+from token_usage import MAX_TOKENS
+from utils import ChatLanguageModel
+
+# a response ends at the end-of-text token, or when the model starts the next message of the chat
+STOP_STRINGS = ['\nUser:', '\nSystem:']
+# every token is at least one byte, so a stop string that a new token completes is within this many last tokens
+STOP_WINDOW = max(len(stop_string.encode('utf-8')) for stop_string in STOP_STRINGS)
+# head size of all the GPT-2 checkpoints (gpt2 to gpt2-xl)
+GPT2_HEAD_DIM = 64
+# the KV cache of LocalChatModel grows by multiples of this many positions
+KV_CACHE_BLOCK_SIZE = 128
+
+
+class ByteTokenizer:
+    """UTF-8 bytes as tokens, and 256 as end of text; the tokenizer of the tiny test model."""
+    eos_token_id = 256
+    vocab_size = 257
+
+    def encode(self, text: str) -> List[int]:
+        return list(text.encode('utf-8'))
+
+    def decode(self, token_ids: Iterable[int]) -> str:
+        return bytes(token_id for token_id in token_ids if token_id < 256).decode('utf-8', errors='ignore')
+
+
+class TiktokenTokenizer:
+    """BPE tokenizer of the GPT-2 checkpoints."""
+
+    def __init__(self, encoding_name: str = 'gpt2'):
+        self.encoding = tiktoken.get_encoding(encoding_name)
+        self.eos_token_id = self.encoding.eot_token
+
+    def encode(self, text: str) -> List[int]:
+        return self.encoding.encode_ordinary(text)
+
+    def decode(self, token_ids: Iterable[int]) -> str:
+        return self.encoding.decode([token_id for token_id in token_ids if token_id != self.eos_token_id])
+
+
+class KVCache:
+    """Keys and values of num_slots sequences of up to capacity tokens, and the number of tokens of each slot."""
+
+    def __init__(self, num_layers: int, num_slots: int, num_heads: int, capacity: int, head_dim: int):
+        self.capacity = capacity
+        self.k = np.zeros((num_layers, num_slots, num_heads, capacity, head_dim), dtype=np.float32)
+        self.v = np.zeros((num_layers, num_slots, num_heads, capacity, head_dim), dtype=np.float32)
+        self.lengths = np.zeros(num_slots, dtype=np.int64)
+
+    def reserve(self, capacity: int) -> None:
+        """
+        Grows the cache to capacity tokens per slot, keeping the keys and values of the slots.
+        """
+        if capacity <= self.capacity:
+            return
+        k, v = self.k, self.v
+        self.k = np.zeros(k.shape[:3] + (capacity, k.shape[4]), dtype=np.float32)
+        self.v = np.zeros(v.shape[:3] + (capacity, v.shape[4]), dtype=np.float32)
+        self.k[:, :, :, :self.capacity] = k
+        self.v[:, :, :, :self.capacity] = v
+        self.capacity = capacity
+
+
+def _layer_norm(x: np.ndarray, weight: np.ndarray, bias: np.ndarray, eps: float = 1e-5) -> np.ndarray:
+    mean = x.mean(axis=-1, keepdims=True)
+    var = x.var(axis=-1, keepdims=True)
+    return (x - mean) / np.sqrt(var + eps) * weight + bias
+
+
+def _gelu(x: np.ndarray) -> np.ndarray:
+    return 0.5 * x * (1. + np.tanh(np.sqrt(2. / np.pi) * (x + 0.044715 * x ** 3)))
+
+
+def _softmax(x: np.ndarray) -> np.ndarray:
+    x = np.exp(x - x.max(axis=-1, keepdims=True))
+    return x / x.sum(axis=-1, keepdims=True)
+
+
+class NumpyGPT2:
+    """
+    :param weights: state dict of a GPT-2 transformer ("wte.weight", "h.0.attn.c_attn.weight", ..., "ln_f.bias"),
+                    with the (in, out) Conv1D weight layout of the GPT-2 checkpoints
+    """
+
+    def __init__(self, weights: Dict[str, np.ndarray], num_heads: int):
+        self.weights = {name: np.asarray(weight, dtype=np.float32) for name, weight in weights.items()}
+        self.num_heads = num_heads
+        self.num_layers = 1 + max(int(name.split('.')[1]) for name in weights if name.startswith('h.'))
+        self.vocab_size, self.hidden_size = self.weights['wte.weight'].shape
+        self.max_positions = self.weights['wpe.weight'].shape[0]
+        self.head_dim = self.hidden_size // num_heads
+
+    @classmethod
+    def from_npz(cls, path: str, num_heads: Optional[int] = None) -> 'NumpyGPT2':
+        """
+        :param path: .npz of the state dict of a GPT-2 checkpoint, e.g. saved with np.savez(path, n_head=12, **{
+                     k: v.numpy() for k, v in GPT2LMHeadModel.from_pretrained('gpt2').state_dict().items()})
+        :param num_heads: number of attention heads, by default the n_head array of the .npz if it has one,
+                          otherwise that of the GPT-2 checkpoints (hidden size / 64)
+        """
+        with np.load(path) as f:
+            weights = {name[len('transformer.'):] if name.startswith('transformer.') else name: f[name]
+                       for name in f.files if not name.startswith('lm_head.') and name != 'n_head'}
+            if num_heads is None and 'n_head' in f.files:
+                num_heads = int(f['n_head'])
+        if num_heads is None:
+            num_heads = weights['wte.weight'].shape[1] // GPT2_HEAD_DIM
+        if weights['wte.weight'].shape[1] % num_heads != 0:
+            raise ValueError(f'The hidden size {weights["wte.weight"].shape[1]} of {path} is not a multiple of '
+                             f'{num_heads} heads')
+        return cls(weights, num_heads)
+
+    def new_kv_cache(self, num_slots: int, capacity: Optional[int] = None) -> KVCache:
+        capacity = self.max_positions if capacity is None else min(capacity, self.max_positions)
+        return KVCache(self.num_layers, num_slots, self.num_heads, capacity, self.head_dim)
+
+    def forward(self, token_ids: np.ndarray, kv_cache: KVCache, slots: np.ndarray) -> np.ndarray:
+        """
+        Runs token_ids (batch, num_tokens) after the tokens already in the slots of kv_cache, adds their keys and
+        values to the cache and advances the lengths of the slots.
+        :return: logits of the last token of every row, (batch, vocab_size)
+        """
+        w = self.weights
+        batch_size, num_tokens = token_ids.shape
+        positions = kv_cache.lengths[slots][:, np.newaxis] + np.arange(num_tokens)[np.newaxis, :]
+        num_keys = int(positions.max()) + 1
+        # a token attends to the tokens of its slot up to its own position
+        mask = np.arange(num_keys)[np.newaxis, np.newaxis, np.newaxis, :] <= positions[:, np.newaxis, :, np.newaxis]
+
+        x = w['wte.weight'][token_ids] + w['wpe.weight'][positions]
+        for layer in range(self.num_layers):
+            prefix = f'h.{layer}.'
+            h = _layer_norm(x, w[prefix + 'ln_1.weight'], w[prefix + 'ln_1.bias'])
+            qkv = h @ w[prefix + 'attn.c_attn.weight'] + w[prefix + 'attn.c_attn.bias']
+            q, k, v = (t.reshape(batch_size, num_tokens, self.num_heads, self.head_dim)
+                       for t in np.split(qkv, 3, axis=-1))
+            kv_cache.k[layer][slots[:, np.newaxis], :, positions] = k
+            kv_cache.v[layer][slots[:, np.newaxis], :, positions] = v
+
+            keys = kv_cache.k[layer][slots, :, :num_keys]
+            values = kv_cache.v[layer][slots, :, :num_keys]
+            scores = q.transpose(0, 2, 1, 3) @ keys.transpose(0, 1, 3, 2) / np.sqrt(self.head_dim)
+            attention = _softmax(np.where(mask, scores, -np.inf)) @ values
+            attention = attention.transpose(0, 2, 1, 3).reshape(batch_size, num_tokens, self.hidden_size)
+            x = x + attention @ w[prefix + 'attn.c_proj.weight'] + w[prefix + 'attn.c_proj.bias']
+
+            h = _layer_norm(x, w[prefix + 'ln_2.weight'], w[prefix + 'ln_2.bias'])
+            h = _gelu(h @ w[prefix + 'mlp.c_fc.weight'] + w[prefix + 'mlp.c_fc.bias'])
+            x = x + h @ w[prefix + 'mlp.c_proj.weight'] + w[prefix + 'mlp.c_proj.bias']
+
+        kv_cache.lengths[slots] += num_tokens
+        x = _layer_norm(x[:, -1], w['ln_f.weight'], w['ln_f.bias'])
+        return x @ w['wte.weight'].T
+
+
+def get_tiny_test_model(seed: int = 0, num_layers: int = 2, hidden_size: int = 64, num_heads: int = 4,
+                        max_positions: int = 4096, init_std: float = 0.02) -> NumpyGPT2:
+    """
+    Randomly initialized GPT-2 over the bytes of ByteTokenizer, to test LocalChatModel on CPU in seconds.
+    :param init_std: of the weights; with the 0.02 of GPT-2, the greedy responses hardly depend on the prompt
+    """
+    rng = np.random.default_rng(seed)
+
+    def normal(*shape):
+        return rng.normal(0., init_std, size=shape).astype(np.float32)
+
+    weights = {'wte.weight': normal(ByteTokenizer.vocab_size, hidden_size),
+               'wpe.weight': normal(max_positions, hidden_size),
+               'ln_f.weight': np.ones(hidden_size, dtype=np.float32),
+               'ln_f.bias': np.zeros(hidden_size, dtype=np.float32)}
+    for layer in range(num_layers):
+        prefix = f'h.{layer}.'
+        for name, (in_size, out_size) in [('attn.c_attn', (hidden_size, 3 * hidden_size)),
+                                          ('attn.c_proj', (hidden_size, hidden_size)),
+                                          ('mlp.c_fc', (hidden_size, 4 * hidden_size)),
+                                          ('mlp.c_proj', (4 * hidden_size, hidden_size))]:
+            weights[prefix + name + '.weight'] = normal(in_size, out_size)
+            weights[prefix + name + '.bias'] = np.zeros(out_size, dtype=np.float32)
+        for name in ['ln_1', 'ln_2']:
+            weights[prefix + name + '.weight'] = np.ones(hidden_size, dtype=np.float32)
+            weights[prefix + name + '.bias'] = np.zeros(hidden_size, dtype=np.float32)
+    return NumpyGPT2(weights, num_heads)
+
+
+class _Sequence:
+    def __init__(self, key: Any, slot: int, logits: np.ndarray):
+        self.key = key
+        self.slot = slot
+        self.logits = logits
+        self.token_ids: List[int] = []
+
+
+class LocalChatModel(ChatLanguageModel):
+    """
+    ChatLanguageModel over a NumpyGPT2, with the chat messages rendered as "Role: content" lines.
+    get_template_based_responses / stream_template_based_responses run the conversations of many inputs
+    concurrently, see the module docstring; create_response runs a single one, like OpenaiChatGpt.
+
+    The KV cache holds max_batch_size slots of the longest prompt so far plus max_new_tokens, rounded up to
+    KV_CACHE_BLOCK_SIZE positions, and at most the max_positions of the model: 8 * num_layers * hidden_size bytes
+    (float32 keys and values) per position and slot, e.g. 72 KB for gpt2, about 600 MB for 8 slots of its 1024
+    positions.
+    """
+
+    def __init__(self, model: NumpyGPT2, tokenizer: Any, engine: str = 'local', device: str = 'cpu',
+                 temperatue=0.1, topp=0.95, frequency_penalty=0.0, presence_penalty=0.0, max_batch_size: int = 8,
+                 max_new_tokens: int = MAX_TOKENS, prefix_cache_size: int = 4, min_prefix_length: int = 32,
+                 seed: int = 0):
+        """
+            :param: device: only 'cpu'
+            :param: prefix_cache_size: number of shared prompt prefixes whose keys and values are kept
+            :param: min_prefix_length: shorter common prefixes of the prompts are not cached
+        """
+        if device not in ['', 'cpu']:
+            raise ValueError(f'Unsupported device {device}, the local model runs on cpu')
+        if max_new_tokens >= model.max_positions:
+            raise ValueError(f'max_new_tokens ({max_new_tokens}) leaves no room for the prompt in the '
+                             f'{model.max_positions} positions of the model')
+        super().__init__(engine, 'cpu', temperatue, topp, frequency_penalty, presence_penalty)
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.prefix_cache_size = prefix_cache_size
+        self.min_prefix_length = min_prefix_length
+        # grown by _start to the prompts
+        self.kv_cache = model.new_kv_cache(max_batch_size, capacity=0)
+        self.rng = np.random.default_rng(seed)
+        self._prefix_cache: OrderedDict = OrderedDict()
+        self._head_token_ids: Dict[str, List[int]] = {}
+
+    def _format_prompt(self, chat_memory: List[Dict[str, Any]], content: str) -> str:
+        messages = self._build_chat_messages(chat_memory, content)
+        return ''.join(f'{message["role"].capitalize()}: {message["content"]}\n' for message in messages) \
+            + 'Assistant:'
+
+    def _get_head(self) -> str:
+        """
+        :return: static head of every prompt, the system prompt and the prompt prefix
+        """
+        head = '' if self.system_prompt is None else f'System: {self.system_prompt}\n'
+        if self.prompt_prefix is not None:
+            head += f'User: {self.prompt_prefix}'
+        return head
+
+    def _get_head_token_ids(self) -> List[int]:
+        head = self._get_head()
+        if head not in self._head_token_ids:
+            self._head_token_ids[head] = self.tokenizer.encode(head) if len(head) > 0 else []
+        return self._head_token_ids[head]
+
+    def _starts_with_head(self, prompt: List[int]) -> bool:
+        head_token_ids = self._get_head_token_ids()
+        return 0 < len(head_token_ids) < len(prompt) and prompt[:len(head_token_ids)] == head_token_ids
+
+    def _encode_prompt(self, chat_memory: List[Dict[str, Any]], content: str) -> List[int]:
+        text = self._format_prompt(chat_memory, content)
+        head = self._get_head()
+        if len(head) > 0 and text.startswith(head):
+            # the head is encoded on its own, so that its tokens (and their cached keys and values) are the same
+            # in every prompt, whatever text follows it
+            token_ids = self._get_head_token_ids() + self.tokenizer.encode(text[len(head):])
+        else:
+            token_ids = self.tokenizer.encode(text)
+        max_prompt_length = self.model.max_positions - self.max_new_tokens
+        if len(token_ids) > max_prompt_length:
+            logging.warning(f'Prompt of {len(token_ids)} tokens is truncated to its last {max_prompt_length} tokens.')
+            token_ids = token_ids[-max_prompt_length:]
+        return token_ids
+
+    def _cache_prefix(self, prompts: List[List[int]]) -> None:
+        # common prefix of the prompts, one token shorter than the shortest so that every prompt has a token to run
+        prefix_length = min(len(prompt) for prompt in prompts) - 1
+        for prompt in prompts[1:]:
+            mismatches = np.flatnonzero(np.array(prompt[:prefix_length]) != np.array(prompts[0][:prefix_length]))
+            if len(mismatches) > 0:
+                prefix_length = int(mismatches[0])
+        self._cache_prefix_tokens(tuple(prompts[0][:prefix_length]))
+
+    def _cache_prefix_tokens(self, prefix: Tuple[int, ...]) -> None:
+        if len(prefix) < self.min_prefix_length or prefix in self._prefix_cache:
+            return
+
+        kv_cache = self.model.new_kv_cache(1, len(prefix))
+        self.model.forward(np.array([prefix]), kv_cache, np.array([0]))
+        self._prefix_cache[prefix] = (kv_cache.k[:, 0], kv_cache.v[:, 0])
+        while len(self._prefix_cache) > self.prefix_cache_size:
+            self._prefix_cache.popitem(last=False)
+
+    def _start(self, slot: int, prompt: List[int]) -> np.ndarray:
+        capacity = -(-(len(prompt) + self.max_new_tokens) // KV_CACHE_BLOCK_SIZE) * KV_CACHE_BLOCK_SIZE
+        self.kv_cache.reserve(min(capacity, self.model.max_positions))
+
+        # longest cached prefix of the prompt
+        prefix_length = 0
+        for prefix in self._prefix_cache:
+            if prefix_length < len(prefix) < len(prompt) and tuple(prompt[:len(prefix)]) == prefix:
+                prefix_length = len(prefix)
+        if prefix_length > 0:
+            prefix = tuple(prompt[:prefix_length])
+            self._prefix_cache.move_to_end(prefix)
+            prefix_k, prefix_v = self._prefix_cache[prefix]
+            self.kv_cache.k[:, slot, :, :prefix_length] = prefix_k
+            self.kv_cache.v[:, slot, :, :prefix_length] = prefix_v
+
+        self.kv_cache.lengths[slot] = prefix_length
+        self.token_usage.add(prompt_tokens=len(prompt),
+                             prefix_tokens=len(self._get_head_token_ids()) if self._starts_with_head(prompt) else 0,
+                             cached_tokens=prefix_length)
+        return self.model.forward(np.array([prompt[prefix_length:]]), self.kv_cache, np.array([slot]))[0]
+
+    def _sample(self, sequences: List[_Sequence]) -> List[int]:
+        logits = np.stack([sequence.logits for sequence in sequences]).astype(np.float64)
+        for row, sequence in enumerate(sequences):
+            if len(sequence.token_ids) > 0:
+                counts = np.bincount(sequence.token_ids, minlength=logits.shape[1])
+                logits[row] -= self.frequency_penalty * counts + self.presence_penalty * (counts > 0)
+        if self.temperature <= 0:
+            return logits.argmax(axis=-1).tolist()
+
+        probs = _softmax(logits / self.temperature)
+        token_ids = []
+        for row_probs in probs:
+            # nucleus sampling: the most probable tokens, up to a total probability of topp
+            order = np.argsort(-row_probs)
+            sorted_probs = row_probs[order]
+            num_kept = int(np.searchsorted(np.cumsum(sorted_probs), self.topp)) + 1
+            kept_probs = sorted_probs[:num_kept] / sorted_probs[:num_kept].sum()
+            token_ids.append(int(order[self.rng.choice(num_kept, p=kept_probs)]))
+        return token_ids
+
+    def _get_response(self, sequence: _Sequence) -> Optional[str]:
+        """
+        :return: the response if the sequence is done, otherwise None
+        """
+        if sequence.token_ids[-1] == self.tokenizer.eos_token_id:
+            return self.tokenizer.decode(sequence.token_ids).strip()
+        # the earlier tokens were checked at the earlier steps, only the tail is decoded at every step
+        tail = self.tokenizer.decode(sequence.token_ids[-STOP_WINDOW:])
+        if any(stop_string in tail for stop_string in STOP_STRINGS):
+            text = self.tokenizer.decode(sequence.token_ids)
+            return text[:min(text.index(stop_string) for stop_string in STOP_STRINGS if stop_string in text)].strip()
+        if len(sequence.token_ids) >= self.max_new_tokens or \
+                self.kv_cache.lengths[sequence.slot] >= self.model.max_positions:
+            return self.tokenizer.decode(sequence.token_ids).strip()
+        return None
+
+    def _generate(self, waiting: Deque[Tuple[Any, List[int]]]) -> Iterator[Tuple[Any, str]]:
+        """
+        Generates the responses of the (key, prompt token ids) of waiting, max_batch_size at a time, and yields
+        (key, response) as soon as a response is done. The caller may add prompts to waiting in between.
+        """
+        free_slots = list(range(self.max_batch_size - 1, -1, -1))
+        active: List[_Sequence] = []
+        while len(waiting) > 0 or len(active) > 0:
+            while len(waiting) > 0 and len(free_slots) > 0:
+                key, prompt = waiting.popleft()
+                slot = free_slots.pop()
+                active.append(_Sequence(key, slot, self._start(slot, prompt)))
+
+            for sequence, token_id in zip(active, self._sample(active)):
+                sequence.token_ids.append(token_id)
+
+            running = []
+            for sequence in active:
+                response = self._get_response(sequence)
+                if response is None:
+                    running.append(sequence)
+                else:
+                    free_slots.append(sequence.slot)
+                    self.token_usage.add(completion_tokens=len(sequence.token_ids), num_requests=0)
+                    yield sequence.key, response
+            active = running
+
+            if len(active) > 0:
+                logits = self.model.forward(np.array([[sequence.token_ids[-1]] for sequence in active]),
+                                            self.kv_cache, np.array([sequence.slot for sequence in active]))
+                for sequence, sequence_logits in zip(active, logits):
+                    sequence.logits = sequence_logits
+
+    def create_response(self, content: str) -> Optional[str]:
+        prompt = self._encode_prompt(self.chat_memory, content)
+        if self._starts_with_head(prompt):
+            # reused by the next conversations of this model
+            self._cache_prefix_tokens(tuple(self._get_head_token_ids()))
+        (_, response), = self._generate(deque([(None, prompt)]))
+        self.chat_memory.append({'role': 'user', 'content': content})
+        self.chat_memory.append({'role': 'assistant', 'content': response})
+        return response
+
+    def stream_template_based_responses(self,
+                                        conversation_template: List[str],
+                                        input_informations: List[Dict[str, Any]],
+                                        ordered: bool = False) -> Iterator[Tuple[int, List[Optional[str]]]]:
+        """
+        Runs the conversation of every input information concurrently; the next turn of a conversation is
+        queued as soon as its previous one is done.
+        :return: (index of the input information, responses of all turns), as soon as a conversation is done,
+                 or in the order of the input informations if ordered
+        """
+        if len(input_informations) == 0:
+            return
+        chat_memories = [[] for _ in input_informations]
+        all_responses = [[] for _ in input_informations]
+        prompts = [self._encode_prompt([], conversation_template[0].format(**input_information))
+                   for input_information in input_informations]
+        self._cache_prefix(prompts)
+
+        waiting = deque(enumerate(prompts))
+        done = {}
+        next_index = 0
+        for i, response in self._generate(waiting):
+            num_turn = len(all_responses[i])
+            chat_memories[i].append({'role': 'user',
+                                     'content': conversation_template[num_turn].format(**input_informations[i])})
+            chat_memories[i].append({'role': 'assistant', 'content': response})
+            all_responses[i].append(response)
+            if num_turn + 1 < len(conversation_template):
+                content = conversation_template[num_turn + 1].format(**input_informations[i])
+                waiting.append((i, self._encode_prompt(chat_memories[i], content)))
+            elif not ordered:
+                yield i, all_responses[i]
+            else:
+                done[i] = all_responses[i]
+                while next_index in done:
+                    yield next_index, done.pop(next_index)
+                    next_index += 1
+
+    def get_template_based_responses(self,
+                                     conversation_template: List[str],
+                                     input_informations: List[Dict[str, Any]]) -> List[List[Optional[str]]]:
+        return [responses for _, responses in
+                self.stream_template_based_responses(conversation_template, input_informations, ordered=True)]
+
+
+def load_local_chat_model(name_or_path: str, num_heads: Optional[int] = None, **kwargs) -> LocalChatModel:
+    """
+    :param name_or_path: "tiny" for the tiny test model, or the .npz weights of a GPT-2 checkpoint (NumpyGPT2.from_npz)
+    :param num_heads: of the checkpoint, read from it (or inferred from its hidden size) by default
+    :param kwargs: of LocalChatModel
+    """
+    if name_or_path == 'tiny':
+        return LocalChatModel(get_tiny_test_model(), ByteTokenizer(), engine='tiny', **kwargs)
+    return LocalChatModel(NumpyGPT2.from_npz(name_or_path, num_heads=num_heads), TiktokenTokenizer(),
+                          engine=name_or_path, **kwargs)
+
+
+if __name__ == '__main__':
+    # throughput of the tiny test model, dynamic batching vs. one conversation at a time
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-inputs', type=int, default=32)
+    parser.add_argument('--max-batch-size', type=int, default=8)
+    parser.add_argument('--max-new-tokens', type=int, default=32)
+    args = parser.parse_args()
+
+    few_shot_prefix = 'Image: A funeral procession\nAction: Sing a birthday song\nResponse: It is possible.\n\n' * 8
+    template = ['Image: {information}\nAction: Dance\nResponse:', 'Is your response succinct?']
+    input_informations = [{'information': f'a photo number {i}'} for i in range(args.num_inputs)]
+    for max_batch_size in [1, args.max_batch_size]:
+        local_model = load_local_chat_model('tiny', max_batch_size=max_batch_size, max_new_tokens=args.max_new_tokens)
+        local_model.set_prompt_prefix(few_shot_prefix)
+        start = time.perf_counter()
+        local_model.get_template_based_responses(template, input_informations)
+        print(f'max_batch_size={max_batch_size}: {time.perf_counter() - start:.2f}s, '
+              f'{local_model.token_usage.summary("local model")}')
@@ -0,0 +1,198 @@
+"""Client-side rate limiting and retries of the API requests, and an offline stand-in for the API."""
+import asyncio
+import random
+import threading
+import time
+from typing import Optional, Dict, Any, Awaitable, Callable
+
+import openai
+
+from response_cache import ResponseCacheMiss
+from token_usage import MAX_TOKENS, count_chat_tokens, count_text_tokens
+
+MAX_RETRIES = 10
+
+
+class RateLimiter:
+    """
+    Token buckets for requests per minute and tokens per minute, plus exponential backoff with jitter.
+    A single limiter is shared by every model of a process that uses the same engine (see get_rate_limiter),
+    and a rate limit error makes all of them pause, not only the request that hit it.
+    """
+
+    def __init__(self,
+                 requests_per_minute: float = 3500,
+                 tokens_per_minute: float = 90000,
+                 base_backoff: float = 1.0,
+                 max_backoff: float = 60.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._available_requests = float(requests_per_minute)
+        self._available_tokens = float(tokens_per_minute)
+        self._last_refill = clock()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._last_refill
+        self._available_requests = min(self.requests_per_minute,
+                                       self._available_requests + elapsed * self.requests_per_minute / 60.)
+        self._available_tokens = min(self.tokens_per_minute,
+                                     self._available_tokens + elapsed * self.tokens_per_minute / 60.)
+        self._last_refill = now
+
+    def try_acquire(self, num_tokens: int) -> float:
+        """
+        Reserves one request and num_tokens tokens if both budgets allow it.
+        :return: 0 if reserved, otherwise the number of seconds to wait before trying again
+        """
+        # a single request larger than the whole budget would never fit
+        num_tokens = min(num_tokens, self.tokens_per_minute)
+        with self._lock:
+            now = self.clock()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+            if self._available_requests >= 1 and self._available_tokens >= num_tokens:
+                self._available_requests -= 1
+                self._available_tokens -= num_tokens
+                return 0.
+            wait_requests = (1 - self._available_requests) * 60. / self.requests_per_minute
+            wait_tokens = (num_tokens - self._available_tokens) * 60. / self.tokens_per_minute
+            return max(wait_requests, wait_tokens, 0.)
+
+    def acquire(self, num_tokens: int) -> None:
+        while True:
+            wait = self.try_acquire(num_tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, num_tokens: int) -> None:
+        while True:
+            wait = self.try_acquire(num_tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def get_backoff(self, attempt: int, rate_limited: bool = False) -> float:
+        """
+        :return: the delay before retry number `attempt` (0-based), exponential with full jitter.
+                 After a rate limit error, every request sharing this limiter waits at least that long.
+        """
+        delay = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+        if rate_limited:
+            with self._lock:
+                self._paused_until = max(self._paused_until, self.clock() + delay)
+        return delay
+
+
+_RATE_LIMITERS: Dict[str, RateLimiter] = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def get_rate_limiter(engine: str, **kwargs) -> RateLimiter:
+    """
+    Returns the process-wide limiter of an engine; kwargs (budgets, backoff) only apply when it is created.
+    """
+    with _RATE_LIMITERS_LOCK:
+        if engine not in _RATE_LIMITERS:
+            _RATE_LIMITERS[engine] = RateLimiter(**kwargs)
+        return _RATE_LIMITERS[engine]
+
+
+def _get_retry_backoff(error: Exception, attempt: int, rate_limiter: RateLimiter) -> float:
+    """
+    :return: seconds to wait before retrying the request that raised error; a replay miss is raised, not retried
+    """
+    if isinstance(error, ResponseCacheMiss):
+        raise error
+    if isinstance(error, openai.error.RateLimitError):
+        print(f"Reach rate limit: {error}")
+        return rate_limiter.get_backoff(attempt, rate_limited=True)
+    print(f"Exception: {error}")
+    return rate_limiter.get_backoff(attempt)
+
+
+def call_with_retry(request: Callable[[], Optional[str]],
+                    rate_limiter: RateLimiter) -> Optional[str]:
+    # Retry logic --- 10 times
+    for attempt in range(MAX_RETRIES):
+        try:
+            return request()
+        except Exception as e:
+            time.sleep(_get_retry_backoff(e, attempt, rate_limiter))
+
+    return None
+
+
+async def call_with_retry_async(request: Callable[[], Awaitable[Optional[str]]],
+                                rate_limiter: RateLimiter) -> Optional[str]:
+    """Same retries as call_with_retry, the backoff sleeps do not block the event loop."""
+    for attempt in range(MAX_RETRIES):
+        try:
+            return await request()
+        except Exception as e:
+            await asyncio.sleep(_get_retry_backoff(e, attempt, rate_limiter))
+
+    return None
+
+
+class StubOpenaiBackend:
+    """
+    Offline stand-in for openai.ChatCompletion / openai.Completion, to measure throughput without the API.
+    Each request takes `latency` seconds, and requests beyond the server-side limits raise RateLimitError.
+    """
+
+    def __init__(self, latency: float = 0.5, requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None, response: str = 'It is possible.'):
+        self.latency = latency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.response = response
+        self.num_requests = 0
+        self.num_rate_limited = 0
+        self._lock = threading.Lock()
+        self._history = []
+
+    def _admit(self, num_tokens: int) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._history = [(t, n) for t, n in self._history if now - t < 60.]
+            if (self.requests_per_minute is not None and len(self._history) + 1 > self.requests_per_minute) or \
+                    (self.tokens_per_minute is not None and
+                     sum(n for _, n in self._history) + num_tokens > self.tokens_per_minute):
+                self.num_rate_limited += 1
+                raise openai.error.RateLimitError('Stub rate limit reached')
+            self._history.append((now, num_tokens))
+            self.num_requests += 1
+
+    def _num_tokens(self, kwargs: Dict[str, Any]) -> int:
+        engine = kwargs.get('model') or kwargs.get('engine')
+        if 'messages' in kwargs:
+            num_tokens = count_chat_tokens(kwargs['messages'], engine)
+        else:
+            num_tokens = count_text_tokens(kwargs['prompt'], engine)
+        return num_tokens + kwargs.get('max_tokens', MAX_TOKENS)
+
+    def _response(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        engine = kwargs.get('model') or kwargs.get('engine')
+        if 'messages' in kwargs:
+            usage = {'prompt_tokens': count_chat_tokens(kwargs['messages'], engine),
+                     'completion_tokens': count_text_tokens(self.response, engine)}
+            return {'choices': [{'message': {'role': 'assistant', 'content': self.response}}], 'usage': usage}
+        return {'choices': [{'text': self.response}]}
+
+    def create(self, **kwargs) -> Dict[str, Any]:
+        self._admit(self._num_tokens(kwargs))
+        time.sleep(self.latency)
+        return self._response(kwargs)
+
+    async def acreate(self, **kwargs) -> Dict[str, Any]:
+        self._admit(self._num_tokens(kwargs))
+        await asyncio.sleep(self.latency)
+        return self._response(kwargs)
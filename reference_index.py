@@ -0,0 +1,182 @@
+"""Precompiled, memory-mapped cache of a NormLens reference jsonl file.
+
+The compile step normalizes the explanations (lower/strip), groups them by judgment, records the
+agreement label and stores the BLEU/ROUGE tokens of every explanation, as flat .npy arrays in
+`<reference stem>.index/<sha256 of the file>/` next to the jsonl file.
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+from collections.abc import Mapping
+from pathlib import Path
+from typing import List, Dict, Any, Iterator, Tuple
+
+import jsonlines
+import numpy as np
+from rouge_score import tokenizers
+
+# same labels as evaluation.get_agreement_label, keyed by the set of reference judgments
+AGREEMENT_LABELS = ['WR.', 'OK.', 'IMP.', 'WR. or OK.', 'WR. or IMP.', 'OK. or IMP.']
+_JUDGMENT_SET_LABELS = {(0,): 'WR.', (1,): 'OK.', (2,): 'IMP.',
+                        (0, 1): 'WR. or OK.', (0, 2): 'WR. or IMP.', (1, 2): 'OK. or IMP.'}
+
+ARRAY_NAMES = ['question_ids', 'sorted_order', 'label_codes',
+               'explanation_offsets', 'judgments', 'explanation_bytes', 'explanation_byte_offsets',
+               'bleu_token_offsets', 'bleu_token_ids', 'rouge_token_offsets', 'rouge_token_ids',
+               'vocab_bytes', 'vocab_byte_offsets']
+
+
+def file_sha256(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def get_cache_dir(reference_path: str) -> Path:
+    reference_path = Path(reference_path)
+    return reference_path.parent / f'{reference_path.stem}.index' / file_sha256(str(reference_path))
+
+
+def _pack_strings(strings: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _unpack_string(packed: np.ndarray, offsets: np.ndarray, index: int) -> str:
+    return packed[offsets[index]:offsets[index + 1]].tobytes().decode('utf-8')
+
+
+def compile_reference_data(reference_path: str) -> Path:
+    """
+        Compiles the reference file into its cache directory, unless a cache for the same file hash exists.
+        :return: the cache directory
+    """
+    cache_dir = get_cache_dir(reference_path)
+    if cache_dir.exists():
+        return cache_dir
+
+    rouge_tokenizer = tokenizers.DefaultTokenizer(use_stemmer=True)
+    vocab: Dict[str, int] = {}
+
+    question_ids, label_codes, explanation_counts = [], [], []
+    judgments, explanations, bleu_tokens, rouge_tokens = [], [], [], []
+    with jsonlines.open(reference_path) as reader:
+        for r in reader:
+            question_ids.append(r['question_id'])
+            judgment_set = tuple(sorted(set(r['answer_judgment'])))
+            label = _JUDGMENT_SET_LABELS.get(judgment_set)
+            if label is None and len(judgment_set) in (1, 2):
+                # unknown judgments, which get_agreement_label refuses as well
+                raise NotImplementedError(f'question {r["question_id"]}: answer judgments {judgment_set}')
+            label_codes.append(AGREEMENT_LABELS.index(label) if label is not None else -1)
+
+            # group by judgment, keeping the original order inside each group
+            grouped = sorted(zip(r['answer_judgment'], r['answer_explanation']), key=lambda x: x[0])
+            explanation_counts.append(len(grouped))
+            for judgment, explanation in grouped:
+                explanation = explanation.lower().strip()
+                judgments.append(judgment)
+                explanations.append(explanation)
+                bleu_tokens.append([vocab.setdefault(t, len(vocab)) for t in explanation.split()])
+                rouge_tokens.append([vocab.setdefault(t, len(vocab))
+                                     for t in rouge_tokenizer.tokenize(explanation)])
+
+    arrays = {'question_ids': np.array(question_ids, dtype=np.int64),
+              'label_codes': np.array(label_codes, dtype=np.int8),
+              'judgments': np.array(judgments, dtype=np.int8)}
+    arrays['sorted_order'] = np.argsort(arrays['question_ids'], kind='stable')
+    arrays['explanation_offsets'] = np.r_[0, np.cumsum(explanation_counts)].astype(np.int64)
+    arrays['explanation_bytes'], arrays['explanation_byte_offsets'] = _pack_strings(explanations)
+    for name, tokens in [('bleu', bleu_tokens), ('rouge', rouge_tokens)]:
+        arrays[f'{name}_token_offsets'] = np.r_[0, np.cumsum([len(t) for t in tokens])].astype(np.int64)
+        arrays[f'{name}_token_ids'] = np.array([t for ts in tokens for t in ts], dtype=np.int64)
+    arrays['vocab_bytes'], arrays['vocab_byte_offsets'] = _pack_strings(list(vocab.keys()))
+
+    # write to a temporary directory first, so that an interrupted compile never leaves a partial cache
+    cache_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(dir=cache_dir.parent))
+    try:
+        for name in ARRAY_NAMES:
+            np.save(tmp_dir / f'{name}.npy', arrays[name])
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not cache_dir.exists():
+            raise
+    return cache_dir
+
+
+class CompiledReferences(Mapping):
+    """
+        Read-only mapping from question_id to a reference record, backed by memory-mapped arrays.
+        Records have the same keys as load_reference_data, plus 'agreement_label';
+        explanations are already lowercased/stripped and grouped by judgment.
+    """
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = Path(cache_dir)
+        self._arrays = {name: np.load(self.cache_dir / f'{name}.npy', mmap_mode='r') for name in ARRAY_NAMES}
+        self._sorted_ids = self._arrays['question_ids'][self._arrays['sorted_order']]
+
+    def _row(self, question_id: int) -> int:
+        position = int(np.searchsorted(self._sorted_ids, question_id))
+        if position == len(self._sorted_ids) or self._sorted_ids[position] != question_id:
+            raise KeyError(question_id)
+        return int(self._arrays['sorted_order'][position])
+
+    def __getitem__(self, question_id: int) -> Dict[str, Any]:
+        arrays = self._arrays
+        row = self._row(question_id)
+        start, end = arrays['explanation_offsets'][row], arrays['explanation_offsets'][row + 1]
+        label_code = int(arrays['label_codes'][row])
+        return {'question_id': int(arrays['question_ids'][row]),
+                'answer_judgment': [int(j) for j in arrays['judgments'][start:end]],
+                'answer_explanation': [_unpack_string(arrays['explanation_bytes'],
+                                                      arrays['explanation_byte_offsets'], i)
+                                       for i in range(start, end)],
+                'agreement_label': AGREEMENT_LABELS[label_code] if label_code >= 0 else None}
+
+    def __contains__(self, question_id) -> bool:
+        try:
+            self._row(question_id)
+        except (KeyError, TypeError):
+            return False
+        return True
+
+    def __iter__(self) -> Iterator[int]:
+        return (int(question_id) for question_id in self._arrays['question_ids'])
+
+    def __len__(self) -> int:
+        return len(self._arrays['question_ids'])
+
+    def iter_tokens(self) -> Iterator[Tuple[str, List[str], List[str]]]:
+        """
+            Yields (normalized explanation, BLEU tokens, stemmed ROUGE tokens) for every explanation.
+        """
+        arrays = self._arrays
+        vocab = [_unpack_string(arrays['vocab_bytes'], arrays['vocab_byte_offsets'], i)
+                 for i in range(len(arrays['vocab_byte_offsets']) - 1)]
+        for i in range(len(arrays['explanation_byte_offsets']) - 1):
+            explanation = _unpack_string(arrays['explanation_bytes'], arrays['explanation_byte_offsets'], i)
+            bleu = arrays['bleu_token_ids'][arrays['bleu_token_offsets'][i]:arrays['bleu_token_offsets'][i + 1]]
+            rouge = arrays['rouge_token_ids'][arrays['rouge_token_offsets'][i]:arrays['rouge_token_offsets'][i + 1]]
+            yield explanation, [vocab[t] for t in bleu], [vocab[t] for t in rouge]
+
+
+def load_compiled_reference_data(reference_path: str) -> CompiledReferences:
+    return CompiledReferences(compile_reference_data(reference_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile a NormLens reference file into a memory-mapped cache')
+    parser.add_argument('--reference-path', type=str, required=True,
+                        help='Path to the reference (normlens) jsonl file')
+    args = parser.parse_args()
+
+    print('Compiled reference cache: {}'.format(compile_reference_data(args.reference_path)))
@@ -0,0 +1,122 @@
+"""Persistent, content-addressed cache of API responses."""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Dict, Any
+
+
+class ResponseCacheMiss(KeyError):
+    pass
+
+
+class ResponseCache:
+    """
+    Content-addressed cache of API responses in SQLite, keyed by a hash of the full request
+    (engine, messages or prompt, sampling parameters). The least recently used responses are evicted
+    once the stored responses exceed max_size_bytes; the access times of the hits are kept in memory and written
+    with the next put (or every flush_accesses hits), so a hit costs no write. In read_only (replay) mode the
+    database is opened read-only, and must exist; nothing is written, and a miss raises ResponseCacheMiss instead
+    of calling the API.
+    """
+
+    def __init__(self, path: str, max_size_bytes: int = 1 << 30, read_only: bool = False, flush_accesses: int = 1000):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.read_only = read_only
+        self.flush_accesses = flush_accesses
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # last access time of the hits since the last write, by key
+        self._accesses: Dict[str, float] = {}
+        if read_only:
+            # fail here rather than on every request, where the retries of call_with_retry would hide the error
+            if not os.path.exists(path):
+                raise FileNotFoundError(f'No response cache to replay at {path}')
+            self._conn = sqlite3.connect(f'{Path(path).absolute().as_uri()}?mode=ro', uri=True,
+                                         check_same_thread=False)
+            if self._conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'responses'"
+                                  ).fetchone() is None:
+                self._conn.close()
+                raise ValueError(f'{path} is not a response cache, it has no responses table')
+            return
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                           'key TEXT PRIMARY KEY, '
+                           'response TEXT NOT NULL, '
+                           'size INTEGER NOT NULL, '
+                           'last_access REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+        self._conn.commit()
+        # size of the stored responses, kept up to date by put and _evict
+        self._total_size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def get_key(request: Dict[str, Any]) -> str:
+        return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, request: Dict[str, Any]) -> Optional[str]:
+        key = self.get_key(request)
+        with self._lock:
+            row = self._conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self.hits += 1
+                if not self.read_only:
+                    self._accesses[key] = time.time()
+                    if len(self._accesses) >= self.flush_accesses:
+                        self._write_accesses()
+                        self._conn.commit()
+                return row[0]
+            self.misses += 1
+        if self.read_only:
+            raise ResponseCacheMiss(f'No cached response for request {key}')
+        return None
+
+    def put(self, request: Dict[str, Any], response: Optional[str]) -> None:
+        # None is a failed request (or a completion without content), it is retried rather than replayed
+        if self.read_only or response is None:
+            return
+        key = self.get_key(request)
+        size = len(response.encode('utf-8'))
+        with self._lock:
+            row = self._conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                               (key, response, size, time.time()))
+            self._accesses.pop(key, None)
+            self._total_size += size - (row[0] if row is not None else 0)
+            # the least recently used responses are evicted by their up-to-date access times
+            self._write_accesses()
+            self._evict()
+            self._conn.commit()
+
+    def _write_accesses(self) -> None:
+        self._conn.executemany('UPDATE responses SET last_access = ? WHERE key = ?',
+                               [(last_access, key) for key, last_access in self._accesses.items()])
+        self._accesses = {}
+
+    def _evict(self) -> None:
+        if self._total_size <= self.max_size_bytes:
+            return
+        evicted_keys = []
+        for key, size in self._conn.execute('SELECT key, size FROM responses ORDER BY last_access'):
+            if self._total_size <= self.max_size_bytes:
+                break
+            evicted_keys.append((key,))
+            self._total_size -= size
+        self._conn.executemany('DELETE FROM responses WHERE key = ?', evicted_keys)
+        self.evictions += len(evicted_keys)
+
+    def stats(self) -> str:
+        return f'response cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions'
+
+    def close(self) -> None:
+        with self._lock:
+            if not self.read_only and len(self._accesses) > 0:
+                self._write_accesses()
+                self._conn.commit()
+            self._conn.close()
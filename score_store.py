@@ -0,0 +1,69 @@
+"""Persistent per-question score store, so that re-runs only score new or changed predictions."""
+import hashlib
+import json
+import sqlite3
+from typing import List, Dict, Tuple, Optional
+
+ScoreKey = Tuple[int, str, int]
+# number of question ids of one SELECT of get_many, below the default limit of 999 SQLite variables
+GET_MANY_BATCH_SIZE = 500
+
+
+class ScoreStore:
+    """
+        SQLite table of scores keyed by (question_id, hash of the prediction text, predicted judgment, scorer).
+        The scorer is the metric set, the BLEU/ROUGE backend and the digest of the reference file, so that the
+        scores of other references or of the other backend are never reused.
+        Every put_many is committed right away, so an interrupted evaluation keeps what it has scored so far.
+    """
+
+    def __init__(self, path: str, metrics: List[str], backend: str, reference_digest: str):
+        """
+            :param: backend: metric backend of ModelEvaulator
+            :param: reference_digest: reference_index.file_sha256 of the reference file
+        """
+        self.path = path
+        self.metrics_key = f'{",".join(sorted(metrics))}|{backend}|{reference_digest}'
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS scores ('
+                           'question_id INTEGER NOT NULL, '
+                           'prediction_hash TEXT NOT NULL, '
+                           'judgment INTEGER NOT NULL, '
+                           'metrics_key TEXT NOT NULL, '
+                           'scores TEXT NOT NULL, '
+                           'PRIMARY KEY (question_id, prediction_hash, judgment, metrics_key))')
+        self._conn.commit()
+
+    @staticmethod
+    def get_key(question_id: int, prediction_judgment: int, prediction_explanation: str) -> ScoreKey:
+        prediction_hash = hashlib.sha1(prediction_explanation.encode('utf-8')).hexdigest()
+        return question_id, prediction_hash, prediction_judgment
+
+    def get_many(self, keys: List[ScoreKey]) -> List[Optional[Dict[str, float]]]:
+        # the rows of the scorer for the questions of keys, a few per question, looked up by the primary key
+        rows = {}
+        question_ids = sorted({question_id for question_id, _, _ in keys})
+        for start in range(0, len(question_ids), GET_MANY_BATCH_SIZE):
+            batch = question_ids[start:start + GET_MANY_BATCH_SIZE]
+            for question_id, prediction_hash, judgment, scores in self._conn.execute(
+                    f'SELECT question_id, prediction_hash, judgment, scores FROM scores '
+                    f'WHERE question_id IN ({", ".join("?" * len(batch))}) AND metrics_key = ?',
+                    (*batch, self.metrics_key)):
+                rows[question_id, prediction_hash, judgment] = scores
+        results = [json.loads(rows[key]) if key in rows else None for key in keys]
+        num_hits = sum(result is not None for result in results)
+        self.hits += num_hits
+        self.misses += len(results) - num_hits
+        return results
+
+    def put_many(self, items: List[Tuple[ScoreKey, Dict[str, float]]]) -> None:
+        self._conn.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)',
+                               [(question_id, prediction_hash, judgment, self.metrics_key, json.dumps(scores))
+                                for (question_id, prediction_hash, judgment), scores in items])
+        self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
@@ -0,0 +1,103 @@
+"""A small fold through BatchChatGpt on FakeBatchServer: submit, poll, and join the responses by custom id."""
+import json
+import os
+from typing import Any, Dict
+
+from batch_api import BatchChatGpt, FakeBatchServer
+from rate_limit import StubOpenaiBackend
+from utils import OpenaiChatGpt
+
+CONTENTS = {str(i): f'Image: a photo number {i}\nAction: Dance\nResponse:' for i in range(7)}
+
+
+class EchoBackend(StubOpenaiBackend):
+    """Answers every request with its last user message, after a tag telling where it was answered."""
+
+    def __init__(self, tag: str):
+        super().__init__(latency=0.)
+        self.tag = tag
+
+    def _response(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        response = super()._response(kwargs)
+        response['choices'][0]['message']['content'] = f'{self.tag}: {kwargs["messages"][-1]["content"]}'
+        return response
+
+
+class RecordingBatchServer(FakeBatchServer):
+    """Writes the output lines in reverse order, and keeps the custom ids of the input of every batch."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.input_custom_ids = {}
+
+    def create_batch(self, input_file_id: str, **kwargs) -> Dict[str, Any]:
+        batch = super().create_batch(input_file_id, **kwargs)
+        self.input_custom_ids[batch['id']] = [json.loads(line)['custom_id']
+                                              for line in self._files[input_file_id].splitlines()]
+        return batch
+
+    def _process(self, batch: Dict[str, Any]) -> None:
+        super()._process(batch)
+        output = self._files[batch['output_file_id']].splitlines(keepends=True)
+        self._files[batch['output_file_id']] = b''.join(reversed(output))
+
+
+class ExpiringBatchServer(RecordingBatchServer):
+    """The first batch expires with the responses of the first half of its requests, the others are missing."""
+
+    def _process(self, batch: Dict[str, Any]) -> None:
+        if batch['id'] != 'batch-0':
+            return super()._process(batch)
+        input_file_id = batch['input_file_id']
+        lines = self._files[input_file_id].splitlines(keepends=True)
+        self._files[input_file_id] = b''.join(lines[:len(lines) // 2])
+        super()._process(batch)
+        self._files[input_file_id] = b''.join(lines)
+        batch['status'] = 'expired'
+
+
+def _get_model() -> OpenaiChatGpt:
+    model = OpenaiChatGpt(engine='gpt-3.5-turbo', backend=EchoBackend('interactive'))
+    model.set_system_prompt('You are a succinct and moral assistant.')
+    return model
+
+
+def test_failed_requests_are_sent_interactively(tmp_path):
+    server = RecordingBatchServer(chat_completion=EchoBackend('batch'), failing_custom_ids=['1', '4'])
+    model = _get_model()
+    batch_gpt = BatchChatGpt(model, server, work_dir=str(tmp_path), poll_interval=0., max_batch_requests=3)
+    responses = batch_gpt.get_responses(CONTENTS)
+
+    # the output files are reversed, the responses are joined back by custom id, in the order of the prompts
+    assert list(responses) == list(CONTENTS)
+    for custom_id, content in CONTENTS.items():
+        tag = 'interactive' if custom_id in ['1', '4'] else 'batch'
+        assert responses[custom_id] == f'{tag}: {content}'
+    # three chunks of at most 3 requests, all completed: the failed requests are not resubmitted
+    assert sorted(server.input_custom_ids.values()) == [['0', '1', '2'], ['3', '4', '5'], ['6']]
+    assert model.chat_completion.num_requests == 2
+    assert model.token_usage.num_requests == len(CONTENTS)
+
+
+def test_missing_responses_of_an_expired_batch_are_resubmitted(tmp_path):
+    server = ExpiringBatchServer(chat_completion=EchoBackend('batch'))
+    model = _get_model()
+    batch_gpt = BatchChatGpt(model, server, work_dir=str(tmp_path), poll_interval=0.)
+    responses = batch_gpt.get_responses(CONTENTS)
+
+    assert list(responses) == list(CONTENTS)
+    assert all(responses[custom_id] == f'batch: {content}' for custom_id, content in CONTENTS.items())
+    assert server.input_custom_ids == {'batch-0': list(CONTENTS), 'batch-1': ['3', '4', '5', '6']}
+    assert model.chat_completion.num_requests == 0
+    with open(os.path.join(str(tmp_path), 'batch_0000.json'), 'r') as f:
+        assert json.load(f)['batch_ids'] == ['batch-0', 'batch-1']
+
+
+def test_restarted_fold_polls_the_submitted_batch(tmp_path):
+    server = RecordingBatchServer(chat_completion=EchoBackend('batch'))
+    responses = BatchChatGpt(_get_model(), server, work_dir=str(tmp_path), poll_interval=0.).get_responses(CONTENTS)
+    restarted_responses = BatchChatGpt(_get_model(), server, work_dir=str(tmp_path),
+                                       poll_interval=0.).get_responses(CONTENTS)
+
+    assert restarted_responses == responses
+    assert list(server.input_custom_ids) == ['batch-0']
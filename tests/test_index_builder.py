@@ -0,0 +1,74 @@
+"""Sharded, resumable index builds of a small offline corpus, with the hashing embedder."""
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from data_collection.index_builder import build_shards, iter_chunk_records, load_embeddings, merge_shards
+
+CHUNK_SIZE = 4
+
+
+@pytest.fixture
+def root_dir(tmp_path):
+    # coco captions, 3 per image, of 7 images: 21 captions in 6 chunks, the last one partial
+    root_dir = tmp_path / 'root'
+    (root_dir / 'coco' / 'val2014').mkdir(parents=True)
+    images = []
+    for imgid in range(7):
+        filename = f'COCO_val2014_{imgid:012d}.jpg'
+        (root_dir / 'coco' / 'val2014' / filename).touch()
+        images.append({'filepath': 'val2014', 'filename': filename,
+                       'sentences': [{'imgid': imgid, 'sentid': 3 * imgid + i,
+                                      'raw': f'A dog number {imgid} playing with ball {i} in the park.'}
+                                     for i in range(3)]})
+    with open(root_dir / 'coco' / 'dataset_coco.json', 'w') as f:
+        json.dump({'images': images}, f)
+    return str(root_dir)
+
+
+def _build(root_dir, output_dir, num_shards, workers):
+    return build_shards('coco', root_dir, str(output_dir), num_shards=num_shards, workers=workers,
+                        chunk_size=CHUNK_SIZE, embedder_name='hashing')
+
+
+def _get_vectors(output_dir):
+    faiss_index = merge_shards(str(output_dir))
+    return faiss_index.reconstruct_n(0, faiss_index.ntotal)
+
+
+def test_sharded_build_matches_single_shard_build(root_dir, tmp_path):
+    assert _build(root_dir, tmp_path / 'single', num_shards=1, workers=1) == 6
+    assert _build(root_dir, tmp_path / 'sharded', num_shards=2, workers=2) == 6
+
+    assert list(iter_chunk_records(str(tmp_path / 'sharded'))) == list(iter_chunk_records(str(tmp_path / 'single')))
+    single_vectors = _get_vectors(tmp_path / 'single')
+    assert single_vectors.shape == (21, 256)
+    np.testing.assert_array_equal(_get_vectors(tmp_path / 'sharded'), single_vectors)
+    np.testing.assert_array_equal(load_embeddings(str(tmp_path / 'sharded')), single_vectors)
+
+
+def test_build_resumes_the_missing_chunks(root_dir, tmp_path):
+    output_dir = tmp_path / 'sharded'
+    _build(root_dir, output_dir, num_shards=2, workers=2)
+    vectors = _get_vectors(output_dir)
+
+    # a chunk of shard 1 was never embedded, e.g. its worker was killed
+    embeddings_path = Path(output_dir) / 'chunks' / 'chunk_000003.npy'
+    embeddings_path.unlink()
+    embedded_paths = sorted(Path(output_dir).glob('chunks/*.npy'))
+    mtimes = [path.stat().st_mtime_ns for path in embedded_paths]
+
+    assert _build(root_dir, output_dir, num_shards=2, workers=2) == 1
+    assert embeddings_path.exists()
+    # the other chunks are not embedded again
+    assert [path.stat().st_mtime_ns for path in embedded_paths] == mtimes
+    np.testing.assert_array_equal(_get_vectors(output_dir), vectors)
+    assert _build(root_dir, output_dir, num_shards=2, workers=2) == 0
+
+
+def test_resumed_build_with_other_settings_is_refused(root_dir, tmp_path):
+    _build(root_dir, tmp_path / 'sharded', num_shards=2, workers=2)
+    with pytest.raises(ValueError):
+        _build(root_dir, tmp_path / 'sharded', num_shards=3, workers=2)
@@ -0,0 +1,76 @@
+"""Greedy decoding of LocalChatModel is the same with dynamic batching and the prefix cache as without them."""
+import numpy as np
+import pytest
+
+from local_model import GPT2_HEAD_DIM, ByteTokenizer, LocalChatModel, NumpyGPT2, _Sequence, get_tiny_test_model
+
+FEW_SHOT_PREFIX = 'Image: A funeral procession\nAction: Sing a birthday song\nResponse: It is possible.\n\n' * 4
+TEMPLATE = ['Image: {information}\nAction: Dance\nResponse:', 'Is your response succinct?']
+INPUT_INFORMATIONS = [{'information': f'a photo number {i}'} for i in range(6)]
+
+
+def _get_model(max_batch_size: int, prefix_cache_size: int, max_new_tokens: int = 16) -> LocalChatModel:
+    # larger weights than GPT-2, so that the responses differ between the prompts
+    model = LocalChatModel(get_tiny_test_model(init_std=0.5), ByteTokenizer(), temperatue=0.,
+                           max_batch_size=max_batch_size, max_new_tokens=max_new_tokens,
+                           prefix_cache_size=prefix_cache_size)
+    model.set_system_prompt('You are a helpful assistant.')
+    model.set_prompt_prefix(FEW_SHOT_PREFIX)
+    return model
+
+
+def test_batched_greedy_responses_match_unbatched():
+    batched_model = _get_model(max_batch_size=4, prefix_cache_size=4)
+    batched = batched_model.get_template_based_responses(TEMPLATE, INPUT_INFORMATIONS)
+    assert batched_model.token_usage.cached_tokens > 0
+
+    unbatched_model = _get_model(max_batch_size=1, prefix_cache_size=0)
+    unbatched = unbatched_model.get_template_based_responses(TEMPLATE, INPUT_INFORMATIONS)
+    assert unbatched_model.token_usage.cached_tokens == 0
+
+    single_model = _get_model(max_batch_size=1, prefix_cache_size=0)
+    single = []
+    for input_information in INPUT_INFORMATIONS:
+        single.append([single_model.create_response(turn.format(**input_information)) for turn in TEMPLATE])
+        single_model.clear_chat_memory()
+
+    assert all(len(responses) == len(TEMPLATE) for responses in batched)
+    assert len({tuple(responses) for responses in batched}) > 1
+    assert batched == unbatched == single
+
+
+def test_response_ends_at_stop_string():
+    model = _get_model(max_batch_size=1, prefix_cache_size=0, max_new_tokens=64)
+    sequence = _Sequence(None, 0, np.zeros(ByteTokenizer.vocab_size))
+    for token_id in ByteTokenizer().encode('It is possible.\nUser: and'):
+        sequence.token_ids.append(token_id)
+        response = model._get_response(sequence)
+        if response is not None:
+            break
+    assert response == 'It is possible.'
+    assert ByteTokenizer().decode(sequence.token_ids).endswith('\nUser:')
+
+
+def test_num_heads_of_checkpoint(tmp_path):
+    weights = get_tiny_test_model(hidden_size=2 * GPT2_HEAD_DIM).weights
+    np.savez(tmp_path / 'inferred.npz', **weights)
+    assert NumpyGPT2.from_npz(str(tmp_path / 'inferred.npz')).num_heads == 2
+    np.savez(tmp_path / 'stored.npz', n_head=8, **weights)
+    assert NumpyGPT2.from_npz(str(tmp_path / 'stored.npz')).num_heads == 8
+    assert NumpyGPT2.from_npz(str(tmp_path / 'stored.npz'), num_heads=4).num_heads == 4
+
+
+def test_kv_cache_grows_to_the_prompts():
+    with pytest.raises(ValueError):
+        LocalChatModel(get_tiny_test_model(max_positions=256), ByteTokenizer(), max_new_tokens=256)
+
+    model = LocalChatModel(get_tiny_test_model(max_positions=256), ByteTokenizer(), temperatue=0.,
+                           max_batch_size=2, max_new_tokens=16)
+    assert model.kv_cache.capacity == 0
+    model.create_response('Image: a photo\nAction: Dance\nResponse:')
+    assert model.kv_cache.capacity == 128
+    model.clear_chat_memory()
+    # the prompt is truncated to its last 240 tokens, the cache grows to the positions of the model
+    response = model.create_response('Image: a photo\nAction: Dance\nResponse:' * 20)
+    assert response is not None
+    assert model.kv_cache.capacity == 256
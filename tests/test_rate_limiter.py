@@ -0,0 +1,79 @@
+"""Budgets and backoff of the shared RateLimiter, offline against StubOpenaiBackend."""
+import pytest
+
+import rate_limit
+from rate_limit import RateLimiter, StubOpenaiBackend
+from utils import OpenaiChatGpt
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_requests_per_minute_budget():
+    clock = FakeClock()
+    rate_limiter = RateLimiter(requests_per_minute=2, tokens_per_minute=1000, clock=clock)
+    assert rate_limiter.try_acquire(10) == 0.
+    assert rate_limiter.try_acquire(10) == 0.
+    # one request comes back every 30 seconds
+    assert rate_limiter.try_acquire(10) == pytest.approx(30.)
+    clock.now = 15.
+    assert rate_limiter.try_acquire(10) == pytest.approx(15.)
+    clock.now = 30.
+    assert rate_limiter.try_acquire(10) == 0.
+
+
+def test_tokens_per_minute_budget():
+    clock = FakeClock()
+    rate_limiter = RateLimiter(requests_per_minute=1000, tokens_per_minute=100, clock=clock)
+    assert rate_limiter.try_acquire(60) == 0.
+    # 20 tokens short, at 100 tokens per minute
+    assert rate_limiter.try_acquire(60) == pytest.approx(12.)
+    clock.now = 12.
+    assert rate_limiter.try_acquire(60) == 0.
+    # a request larger than the whole budget waits for a full bucket instead of forever
+    clock.now = 72.
+    assert rate_limiter.try_acquire(1000) == 0.
+
+
+def test_retries_back_off_on_rate_limit_error(monkeypatch):
+    clock = FakeClock()
+    rate_limiter = RateLimiter(requests_per_minute=1000, tokens_per_minute=10 ** 6, base_backoff=1., max_backoff=4.,
+                               clock=clock)
+    backend = StubOpenaiBackend(latency=0., requests_per_minute=1)
+    model = OpenaiChatGpt(engine='gpt-3.5-turbo', backend=backend, rate_limiter=rate_limiter)
+
+    delays = []
+
+    def sleep(seconds):
+        # the stub sleeps its latency of 0 seconds on every request
+        if seconds > 0:
+            delays.append(seconds)
+        clock.now += seconds
+        # the server-side window of the stub opens again after two rate limit errors
+        if backend.num_rate_limited == 2:
+            backend._history = []
+
+    monkeypatch.setattr(rate_limit.time, 'sleep', sleep)
+    # the longest delay of the full jitter
+    monkeypatch.setattr(rate_limit.random, 'uniform', lambda low, high: high)
+
+    assert model.create_response('first') == backend.response
+    assert delays == []
+    model.clear_chat_memory()
+    assert model.create_response('second') == backend.response
+    assert backend.num_rate_limited == 2
+    assert backend.num_requests == 2
+    # exponential backoff of base_backoff * 2 ** attempt; the pause that each error sets on the shared limiter
+    # ends with the backoff, the next request does not wait more
+    assert delays == [1., 2.]
+    assert model.token_usage.num_requests == 2
+
+
+def test_rate_limiter_is_shared_by_engine():
+    assert rate_limit.get_rate_limiter('test-engine') is rate_limit.get_rate_limiter('test-engine')
+    assert rate_limit.get_rate_limiter('test-engine') is not rate_limit.get_rate_limiter('other-test-engine')
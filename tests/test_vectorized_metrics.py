@@ -0,0 +1,46 @@
+"""Parity of the vectorized BLEU/ROUGE backend with pycocoevalcap's Bleu(4) and rouge_score, without METEOR."""
+import numpy as np
+import pytest
+from pycocoevalcap.bleu.bleu import Bleu
+from rouge_score import rouge_scorer
+
+from vectorized_metrics import ROUGE_TYPES, VectorizedMetricBackend
+
+# aligned references and prediction of each segment, lowercased and stripped like ModelEvaulator._align_explanations
+GTS = {
+    0: ['it is wrong to read a book while driving because you need to watch the road.',
+        'reading while driving is dangerous.'],
+    1: ['it is okay to play a party game at a birthday party.'],
+    2: ['you should not sing a birthday song at a funeral, it is disrespectful.',
+        'singing a birthday song at a funeral is rude to the mourners.',
+        'a funeral is a sad event, so it is inappropriate to sing.'],
+    3: ['feeding wild animals can be dangerous.'],
+    4: ['the the the cat sat on the mat'],
+    5: ['running in a library disturbs other readers.'],
+}
+RES = {
+    0: ['reading a book while driving is wrong because the driver must watch the road.'],
+    1: ['playing a game at a party is fine.'],
+    2: ['it is disrespectful to sing a birthday song at a funeral.'],
+    3: ['it is not safe.'],
+    4: ['the cat the cat on the mat mat'],
+    5: ['running'],
+}
+
+
+def test_bleu_matches_pycocoevalcap():
+    _, expected = Bleu(4).compute_score(GTS, RES, verbose=0)
+    actual = VectorizedMetricBackend().compute_bleu(GTS, RES)
+    assert actual.shape == (len(GTS), 4)
+    np.testing.assert_allclose(actual.T, np.array(expected), rtol=0, atol=1e-9)
+
+
+def test_rouge_matches_rouge_score():
+    scorer = rouge_scorer.RougeScorer(ROUGE_TYPES, use_stemmer=True)
+    actual = VectorizedMetricBackend().compute_rouge(GTS, RES)
+    for segment_id, segment in enumerate(GTS):
+        scores = [scorer.score(reference, RES[segment][0]) for reference in GTS[segment]]
+        for rouge_type in ROUGE_TYPES:
+            expected = sum(score[rouge_type].fmeasure for score in scores) / len(scores)
+            assert actual[rouge_type][segment_id] == pytest.approx(expected, abs=1e-9)
+
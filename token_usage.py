@@ -0,0 +1,100 @@
+"""Token counting of the API requests, and the prompt and completion tokens of each stage."""
+import functools
+import logging
+import re
+import threading
+from typing import Optional, Dict, Any, List, Tuple
+
+import tiktoken
+
+# max_tokens of the completion requests
+MAX_TOKENS = 256
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(engine: str) -> Optional[tiktoken.Encoding]:
+    try:
+        try:
+            return tiktoken.encoding_for_model(engine)
+        except KeyError:
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        # tiktoken downloads its BPE files on first use, which fails offline
+        logging.warning(f'Cannot load the tiktoken encoding of {engine}, token counts are estimated: {e}')
+        return None
+
+
+def count_text_tokens(text: str, engine: str) -> int:
+    encoding = _get_encoding(engine)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+
+def count_chat_tokens(messages: List[Dict[str, Any]], engine: str) -> int:
+    # same approximation as the OpenAI cookbook: ~3 tokens of overhead per message, 3 for the reply priming
+    return sum(3 + count_text_tokens(message['content'], engine) for message in messages) + 3
+
+
+def split_prompt_template(template: str) -> Tuple[str, str]:
+    """
+    :return: the static prefix of a str.format template, its text before the first replacement field,
+             and the template of the rest, e.g. the few-shot examples of a prompt and its last lines
+    """
+    match = re.search(r'(?<!{){(?!{)', template)
+    if match is None:
+        return template.replace('{{', '{').replace('}}', '}'), ''
+    prefix = template[:match.start()].replace('{{', '{').replace('}}', '}')
+    return prefix, template[match.start():]
+
+
+def get_usage(response: Dict[str, Any], prompt_tokens: int, completion: str, engine: str) -> Tuple[int, int, int]:
+    """
+    :return: prompt, completion and cached prompt tokens of a chat completion, as reported in its usage,
+             otherwise counted with tiktoken (and no cached tokens)
+    """
+    usage = response.get('usage') or {}
+    cached_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+    return (usage.get('prompt_tokens', prompt_tokens),
+            usage.get('completion_tokens', count_text_tokens(completion or '', engine)),
+            cached_tokens)
+
+
+class TokenUsage:
+    """
+    Prompt and completion tokens of the requests of a stage, shared by its models and threads.
+    prefix_tokens are the prompt tokens of the static head of the requests (system prompt and prompt prefix),
+    which every request resends, and cached_tokens the prompt tokens served by a prompt cache: the one of the API
+    when it reports them, or the prefix KV cache of a local model. Requests answered by the ResponseCache
+    are only counted, they cost no tokens.
+    """
+
+    def __init__(self):
+        self.num_requests = 0
+        self.num_response_cache_hits = 0
+        self.prompt_tokens = 0
+        self.prefix_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self._lock = threading.Lock()
+
+    def add(self, prompt_tokens: int = 0, completion_tokens: int = 0, prefix_tokens: int = 0, cached_tokens: int = 0,
+            num_requests: int = 1) -> None:
+        with self._lock:
+            self.num_requests += num_requests
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.prefix_tokens += prefix_tokens
+            self.cached_tokens += cached_tokens
+
+    def add_response_cache_hit(self) -> None:
+        with self._lock:
+            self.num_response_cache_hits += 1
+
+    def summary(self, name: str) -> str:
+        with self._lock:
+            prefix_share = self.prefix_tokens / max(self.prompt_tokens, 1)
+            cached_share = self.cached_tokens / max(self.prompt_tokens, 1)
+            return (f'{name}: {self.num_requests} requests, {self.num_response_cache_hits} response cache hits, '
+                    f'{self.prompt_tokens} prompt tokens ({self.prefix_tokens} = {prefix_share:.0%} of static prefix, '
+                    f'{self.cached_tokens} = {cached_share:.0%} cached), {self.completion_tokens} completion tokens')
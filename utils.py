@@ -1,11 +1,15 @@
+import asyncio
 import logging
 import os
-import time
 from abc import ABC, abstractmethod
 from typing import Optional, Dict, Any, List
 
 import openai
 
+from rate_limit import RateLimiter, StubOpenaiBackend, call_with_retry, call_with_retry_async, get_rate_limiter
+from response_cache import ResponseCache
+from token_usage import MAX_TOKENS, TokenUsage, count_chat_tokens, count_text_tokens, get_usage
+
 
 class ChatLanguageModel(ABC):
     def __init__(self,
@@ -23,10 +27,52 @@ class ChatLanguageModel(ABC):
         self.presence_penalty = presence_penalty
         self.chat_memory = []
         self.system_prompt = None
+        self.prompt_prefix = None
+        self.token_usage = TokenUsage()
+        self._prefix_tokens = {}
 
     def set_system_prompt(self, prompt: str) -> None:
         self.system_prompt = prompt
 
+    def set_prompt_prefix(self, prefix: Optional[str]) -> None:
+        """
+        :param prefix: static text put before the first user message of every conversation, e.g. the few-shot
+                       examples of split_prompt_template. It comes right after the system prompt, so that all
+                       requests start with the same tokens and the prompt cache of the API (or the KV cache of
+                       a local model) can reuse them.
+        """
+        self.prompt_prefix = prefix
+
+    def clear_chat_memory(self) -> None:
+        self.chat_memory = []
+
+    def _build_chat_messages(self, chat_memory: List[Dict[str, Any]], context: str) -> List[Dict[str, Any]]:
+        messages = chat_memory + [{'role': 'user', 'content': context}]
+        if self.prompt_prefix is not None:
+            # chat memory keeps the contents without the prefix, it is added to the first user message every turn
+            messages = [{**messages[0], 'content': self.prompt_prefix + messages[0]['content']}] + messages[1:]
+        if self.system_prompt is not None:
+            messages = [{'role': 'system', 'content': self.system_prompt}] + messages
+        return messages
+
+    def get_prefix_tokens(self) -> int:
+        """
+        :return: number of prompt tokens of the system prompt and prompt prefix, resent by every request
+        """
+        key = (self.system_prompt, self.prompt_prefix)
+        if key not in self._prefix_tokens:
+            num_tokens = 0
+            if self.system_prompt is not None:
+                num_tokens += 3 + count_text_tokens(self.system_prompt, self.engine)
+            if self.prompt_prefix is not None:
+                num_tokens += count_text_tokens(self.prompt_prefix, self.engine)
+            self._prefix_tokens[key] = num_tokens
+        return self._prefix_tokens[key]
+
+    def _add_usage(self, response: Dict[str, Any], prompt_tokens: int, completion: Optional[str]) -> None:
+        prompt_tokens, completion_tokens, cached_tokens = get_usage(response, prompt_tokens, completion, self.engine)
+        self.token_usage.add(prompt_tokens, completion_tokens, self.get_prefix_tokens(), cached_tokens)
+
     @abstractmethod
     def get_template_based_responses(self,
                                      conversation_template: List[str],
@@ -34,57 +80,86 @@ class ChatLanguageModel(ABC):
         raise NotImplementedError
 
 
-class OpenaiChatGpt(ChatLanguageModel):
+class BaseOpenaiChatGpt(ChatLanguageModel, ABC):
+    """Requests, response cache and token usage of the chat completions, shared by the sync and async models."""
+
     def __init__(self, engine: str, device: str = "", temperatue=0.1, topp=0.95, frequency_penalty=0.0,
-                 presence_penalty=0.0):
-        openai.api_key = os.environ["OPENAI_API_KEY"]
+                 presence_penalty=0.0, rate_limiter: Optional[RateLimiter] = None,
+                 backend: Optional[StubOpenaiBackend] = None, response_cache: Optional[ResponseCache] = None,
+                 response_format: Optional[Dict[str, Any]] = None):
+        """
+            :param: rate_limiter: defaults to the limiter shared by every model of the same engine
+            :param: backend: replaces openai.ChatCompletion, e.g. a StubOpenaiBackend for offline runs
+            :param: response_cache: answers repeated requests without calling the API
+            :param: response_format: of the requests, e.g. {'type': 'json_object'} for JSON mode
+        """
+        if backend is None:
+            openai.api_key = os.environ["OPENAI_API_KEY"]
         super().__init__(engine, device, temperatue, topp, frequency_penalty, presence_penalty)
+        self.rate_limiter = rate_limiter if rate_limiter is not None else get_rate_limiter(engine)
+        self.chat_completion = backend if backend is not None else openai.ChatCompletion
+        self.response_cache = response_cache
+        self.response_format = response_format
 
-    def _get_chat_messages(self, context: str) -> List[Dict[str, Any]]:
-        if self.system_prompt is None:
-            return self.chat_memory + [{'role': 'user', 'content': context}]
-        else:
-            return [{'role': 'system', 'content': self.system_prompt}] \
-                + self.chat_memory + [{'role': 'user', 'content': context}]
-
-    def clear_chat_memory(self) -> None:
-        self.chat_memory = []
-
-    def create_response(self, content: str) -> Optional[str]:
-        # Retry logic --- 10 times
-        for _ in range(10):
-            try:
-                messages = self._get_chat_messages(content)
-                response = self._create_response_chat(messages)
-                self.chat_memory.append({'role': 'user', 'content': content})
-                self.chat_memory.append({'role': 'assistant', 'content': response})
-
-            except openai.error.RateLimitError as e:
-                print(f"Reach rate limit: {e}")
-                time.sleep(30)
-                continue
-            except Exception as e:
-                print(f"Exception: {e}")
-                time.sleep(30)
-                continue
-            return response
-
-        return None
-
-    def _create_response_chat(self, messages: List[Dict[str, Any]]) -> Optional[str]:
-        response = openai.ChatCompletion.create(
+    def _get_chat_request(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        request = dict(
             model=self.engine,
             messages=messages,
             temperature=self.temperature,
-            max_tokens=256,
+            max_tokens=MAX_TOKENS,
             top_p=self.topp,
             frequency_penalty=self.frequency_penalty,
             presence_penalty=self.presence_penalty,
         )
+        if self.response_format is not None:
+            # only when set, the requests (and response cache keys) without it stay the same
+            request['response_format'] = self.response_format
+        return request
+
+    def _get_cached_response(self, request: Dict[str, Any]) -> Optional[str]:
+        if self.response_cache is None:
+            return None
+        cached_response = self.response_cache.get(request)
+        if cached_response is not None:
+            self.token_usage.add_response_cache_hit()
+        return cached_response
+
+    def _get_completion(self, request: Dict[str, Any], response: Optional[Dict[str, Any]],
+                        prompt_tokens: int) -> Optional[str]:
+        """
+        :return: the completion of the API response to request, recorded in the token usage and response cache
+        """
         if response is None:
             return None
 
-        return response['choices'][0]['message']['content']
+        completion = response['choices'][0]['message']['content']
+        self._add_usage(response, prompt_tokens, completion)
+        if self.response_cache is not None:
+            self.response_cache.put(request, completion)
+        return completion
+
+
+class OpenaiChatGpt(BaseOpenaiChatGpt):
+    def _get_chat_messages(self, context: str) -> List[Dict[str, Any]]:
+        return self._build_chat_messages(self.chat_memory, context)
+
+    def create_response(self, content: str) -> Optional[str]:
+        messages = self._get_chat_messages(content)
+        response = call_with_retry(lambda: self._create_response_chat(messages), self.rate_limiter)
+        if response is not None:
+            self.chat_memory.append({'role': 'user', 'content': content})
+            self.chat_memory.append({'role': 'assistant', 'content': response})
+        return response
+
+    def _create_response_chat(self, messages: List[Dict[str, Any]]) -> Optional[str]:
+        request = self._get_chat_request(messages)
+        cached_response = self._get_cached_response(request)
+        if cached_response is not None:
+            return cached_response
+
+        prompt_tokens = count_chat_tokens(messages, self.engine)
+        self.rate_limiter.acquire(prompt_tokens + MAX_TOKENS)
+        return self._get_completion(request, self.chat_completion.create(**request), prompt_tokens)
 
     def get_template_based_responses(self,
                                      conversation_template: List[str],
@@ -100,15 +175,86 @@ class OpenaiChatGpt(ChatLanguageModel):
                 content = conversation_template[num_turn].format(**input_information)
                 response = self.create_response(content)
                 responses.append(response)
-                time.sleep(1)
             self.clear_chat_memory()
             all_responses.append(responses)
         return all_responses
 
 
+class AsyncOpenaiChatGpt(BaseOpenaiChatGpt):
+    """
+    Runs many independent conversations concurrently with asyncio.
+    Each conversation keeps its own chat memory and sends its turns in order,
+    and at most max_concurrency requests are in flight at the same time.
+    """
+
+    def __init__(self, engine: str, device: str = "", temperatue=0.1, topp=0.95, frequency_penalty=0.0,
+                 presence_penalty=0.0, max_concurrency: int = 8, rate_limiter: Optional[RateLimiter] = None,
+                 backend: Optional[StubOpenaiBackend] = None, response_cache: Optional[ResponseCache] = None,
+                 response_format: Optional[Dict[str, Any]] = None):
+        super().__init__(engine, device, temperatue, topp, frequency_penalty, presence_penalty,
+                         rate_limiter=rate_limiter, backend=backend, response_cache=response_cache,
+                         response_format=response_format)
+        self.max_concurrency = max_concurrency
+
+    def _get_chat_messages(self, chat_memory: List[Dict[str, Any]], context: str) -> List[Dict[str, Any]]:
+        return self._build_chat_messages(chat_memory, context)
+
+    async def create_response(self,
+                              chat_memory: List[Dict[str, Any]],
+                              content: str,
+                              semaphore: asyncio.Semaphore) -> Optional[str]:
+        messages = self._get_chat_messages(chat_memory, content)
+
+        async def request() -> Optional[str]:
+            # the semaphore is not held during the backoff between the attempts
+            async with semaphore:
+                return await self._create_response_chat(messages)
+
+        response = await call_with_retry_async(request, self.rate_limiter)
+        if response is not None:
+            chat_memory.append({'role': 'user', 'content': content})
+            chat_memory.append({'role': 'assistant', 'content': response})
+        return response
+
+    async def _create_response_chat(self, messages: List[Dict[str, Any]]) -> Optional[str]:
+        request = self._get_chat_request(messages)
+        cached_response = self._get_cached_response(request)
+        if cached_response is not None:
+            return cached_response
+
+        prompt_tokens = count_chat_tokens(messages, self.engine)
+        await self.rate_limiter.acquire_async(prompt_tokens + MAX_TOKENS)
+        return self._get_completion(request, await self.chat_completion.acreate(**request), prompt_tokens)
+
+    async def _run_conversation(self,
+                                conversation_template: List[str],
+                                input_information: Dict[str, Any],
+                                semaphore: asyncio.Semaphore) -> List[Optional[str]]:
+        chat_memory = []
+        responses = []
+        for num_turn in range(len(conversation_template)):
+            content = conversation_template[num_turn].format(**input_information)
+            response = await self.create_response(chat_memory, content, semaphore)
+            responses.append(response)
+        return responses
+
+    async def aget_template_based_responses(self,
+                                            conversation_template: List[str],
+                                            input_informations: List[Dict[str, Any]]) -> List[List[Optional[str]]]:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        return list(await asyncio.gather(*[self._run_conversation(conversation_template, input_information, semaphore)
+                                           for input_information in input_informations]))
+
+    def get_template_based_responses(self,
+                                     conversation_template: List[str],
+                                     input_informations: List[Dict[str, Any]]) -> List[List[Optional[str]]]:
+        return asyncio.run(self.aget_template_based_responses(conversation_template, input_informations))
+
+
 class OpenaiGeneralGpt:
     def __init__(self, engine: str, temperatue=0.1, topp=0.95, frequency_penalty=0.0,
-                 presence_penalty=0.0):
+                 presence_penalty=0.0, rate_limiter: Optional[RateLimiter] = None,
+                 backend: Optional[StubOpenaiBackend] = None, response_cache: Optional[ResponseCache] = None):
         self.engine = engine
         self.temperature = temperatue
         self.topp = topp
@@ -116,38 +262,42 @@ class OpenaiGeneralGpt:
         self.presence_penalty = presence_penalty
         self.chat_memory = []
         self.system_prompt = None
+        self.rate_limiter = rate_limiter if rate_limiter is not None else get_rate_limiter(engine)
+        self.completion = backend if backend is not None else openai.Completion
+        self.response_cache = response_cache
+        self.token_usage = TokenUsage()
 
     def _create_response_completion(self, content: str) -> Optional[str]:
-        response = openai.Completion.create(
+        request = dict(
             engine=self.engine,
             prompt=content,
             temperature=self.temperature,
-            max_tokens=256,
+            max_tokens=MAX_TOKENS,
             top_p=self.topp,
             frequency_penalty=self.frequency_penalty,
             presence_penalty=self.presence_penalty,
             logprobs=1,
             stop=["\n\n"]
         )
+        if self.response_cache is not None:
+            cached_response = self.response_cache.get(request)
+            if cached_response is not None:
+                self.token_usage.add_response_cache_hit()
+                return cached_response
+
+        prompt_tokens = count_text_tokens(content, self.engine)
+        self.rate_limiter.acquire(prompt_tokens + MAX_TOKENS)
+        response = self.completion.create(**request)
         if response is None:
             return None
 
-        return response['choices'][0]['text']
+        completion = response['choices'][0]['text']
+        # same accounting as the chat models, without a static prefix
+        prompt_tokens, completion_tokens, cached_tokens = get_usage(response, prompt_tokens, completion, self.engine)
+        self.token_usage.add(prompt_tokens, completion_tokens, cached_tokens=cached_tokens)
+        if self.response_cache is not None:
+            self.response_cache.put(request, completion)
+        return completion
 
     def create_response(self, content: str) -> Optional[str]:
-        # Retry logic --- 10 times
-        for _ in range(10):
-            try:
-                response = self._create_response_completion(content)
-
-            except openai.error.RateLimitError as e:
-                print(f"Reach rate limit: {e}")
-                time.sleep(30)
-                continue
-            except Exception as e:
-                print(f"Exception: {e}")
-                time.sleep(30)
-                continue
-            return response
-
-        return None
+        return call_with_retry(lambda: self._create_response_completion(content), self.rate_limiter)
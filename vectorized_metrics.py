@@ -0,0 +1,251 @@
+"""Corpus-level BLEU / ROUGE over interned token-id arrays.
+
+The scores follow pycocoevalcap's per-segment BLEU (whitespace tokens, 'closest' reference length)
+and rouge_score's stemmed ROUGE-1/2/L fmeasure averaged over the aligned references, so this backend
+can replace them in ModelEvaulator.evaluate_batch.
+"""
+import argparse
+from typing import List, Dict, Tuple
+
+import numpy as np
+from rouge_score import tokenizers
+
+ROUGE_TYPES = ['rouge1', 'rouge2', 'rougeL']
+# number of (reference, prediction) pairs per LCS table
+LCS_CHUNK_SIZE = 4096
+
+
+class VectorizedMetricBackend:
+
+    def __init__(self, bleu_n: int = 4):
+        self.bleu_n = bleu_n
+        self._rouge_tokenizer = tokenizers.DefaultTokenizer(use_stemmer=True)
+        self._token_ids: Dict[str, int] = {}
+        self._bleu_tokens: Dict[str, np.ndarray] = {}
+        self._rouge_tokens: Dict[str, np.ndarray] = {}
+
+    def _intern(self, tokens: List[str]) -> np.ndarray:
+        token_ids = self._token_ids
+        return np.array([token_ids.setdefault(token, len(token_ids)) for token in tokens], dtype=np.int64)
+
+    def bleu_tokens(self, text: str, cache: bool = True) -> np.ndarray:
+        if text in self._bleu_tokens:
+            return self._bleu_tokens[text]
+        # same tokenization as pycocoevalcap's precook
+        tokens = self._intern(text.split())
+        if cache:
+            self._bleu_tokens[text] = tokens
+        return tokens
+
+    def rouge_tokens(self, text: str, cache: bool = True) -> np.ndarray:
+        if text in self._rouge_tokens:
+            return self._rouge_tokens[text]
+        tokens = self._intern(self._rouge_tokenizer.tokenize(text))
+        if cache:
+            self._rouge_tokens[text] = tokens
+        return tokens
+
+    def add_pretokenized(self, text: str, bleu_tokens: List[str], rouge_tokens: List[str]) -> None:
+        """
+            Registers the tokens of a text that was tokenized ahead of time, e.g. by a reference cache.
+        """
+        self._bleu_tokens[text] = self._intern(bleu_tokens)
+        self._rouge_tokens[text] = self._intern(rouge_tokens)
+
+    def compute_bleu(self, gts: Dict[int, List[str]], res: Dict[int, List[str]]) -> np.ndarray:
+        """
+            :return: per-segment BLEU-1..n, shape (len(gts), n), in the order of gts.keys()
+        """
+        segment_ids = list(gts.keys())
+        num_segments = len(segment_ids)
+        refs = [self.bleu_tokens(ref) for segment_id in segment_ids for ref in gts[segment_id]]
+        ref_owner = np.repeat(np.arange(num_segments), [len(gts[segment_id]) for segment_id in segment_ids])
+        # only references are cached, so that the cache does not grow with the prediction file
+        hyps = [self.bleu_tokens(res[segment_id][0], cache=False) for segment_id in segment_ids]
+
+        counts = _count_ngrams(refs + hyps, self.bleu_n)
+        num_refs = len(refs)
+        ref_lens = np.array([len(ref) for ref in refs], dtype=np.int64)
+        test_lens = np.array([len(hyp) for hyp in hyps], dtype=np.int64)
+
+        correct = np.zeros((num_segments, self.bleu_n))
+        guess = np.zeros((num_segments, self.bleu_n))
+        for k, (seq_ids, gram_ids, gram_counts, num_grams) in enumerate(counts):
+            is_ref = seq_ids < num_refs
+            # clip each hypothesis n-gram count by its max count over the segment's references
+            ref_keys = ref_owner[seq_ids[is_ref]] * num_grams + gram_ids[is_ref]
+            ref_max_keys, ref_max_counts = _group_max(ref_keys, gram_counts[is_ref])
+            hyp_segments = seq_ids[~is_ref] - num_refs
+            hyp_keys = hyp_segments * num_grams + gram_ids[~is_ref]
+            matched_counts = _lookup(ref_max_keys, ref_max_counts, hyp_keys)
+            clipped = np.minimum(gram_counts[~is_ref], matched_counts)
+            correct[:, k] = np.bincount(hyp_segments, weights=clipped, minlength=num_segments)
+            guess[:, k] = np.maximum(0, test_lens - k)
+
+        # 'closest' reference length, ties broken by the shorter reference
+        distance_keys = np.abs(ref_lens - test_lens[ref_owner]) * (ref_lens.max() + 1) + ref_lens
+        ref_starts = np.r_[0, np.cumsum(np.bincount(ref_owner, minlength=num_segments))[:-1]]
+        ref_len_closest = np.minimum.reduceat(distance_keys, ref_starts) % (ref_lens.max() + 1)
+
+        small = 1e-9
+        tiny = 1e-15
+        precisions = np.cumprod((correct + tiny) / (guess + small), axis=1)
+        bleu = precisions ** (1. / np.arange(1, self.bleu_n + 1))
+        ratio = (test_lens + tiny) / (ref_len_closest + small)
+        brevity_penalty = np.where(ratio < 1, np.exp(1 - 1 / ratio), 1.)
+        return bleu * brevity_penalty[:, None]
+
+    def compute_rouge(self, gts: Dict[int, List[str]], res: Dict[int, List[str]]) -> Dict[str, np.ndarray]:
+        """
+            :return: per-segment ROUGE fmeasure averaged over the references, in the order of gts.keys()
+        """
+        segment_ids = list(gts.keys())
+        num_segments = len(segment_ids)
+        refs = [self.rouge_tokens(ref) for segment_id in segment_ids for ref in gts[segment_id]]
+        ref_owner = np.repeat(np.arange(num_segments), [len(gts[segment_id]) for segment_id in segment_ids])
+        hyps = [self.rouge_tokens(res[segment_id][0], cache=False) for segment_id in segment_ids]
+        num_refs = len(refs)
+        ref_lens = np.array([len(ref) for ref in refs], dtype=np.int64)
+        hyp_lens = np.array([len(hyp) for hyp in hyps], dtype=np.int64)
+        refs_per_segment = np.bincount(ref_owner, minlength=num_segments)
+
+        fmeasures = {}
+        counts = _count_ngrams(refs + hyps, 2)
+        for k, (seq_ids, gram_ids, gram_counts, num_grams) in enumerate(counts):
+            is_ref = seq_ids < num_refs
+            hyp_keys = (seq_ids[~is_ref] - num_refs) * num_grams + gram_ids[~is_ref]
+            ref_seq_ids = seq_ids[is_ref]
+            ref_keys = ref_owner[ref_seq_ids] * num_grams + gram_ids[is_ref]
+            overlap = np.minimum(gram_counts[is_ref], _lookup(hyp_keys, gram_counts[~is_ref], ref_keys))
+            intersection = np.bincount(ref_seq_ids, weights=overlap, minlength=num_refs)
+            ref_total = np.maximum(ref_lens - k, 0)
+            hyp_total = np.maximum(hyp_lens[ref_owner] - k, 0)
+            precision = intersection / np.maximum(hyp_total, 1)
+            recall = intersection / np.maximum(ref_total, 1)
+            fmeasures[f'rouge{k + 1}'] = _fmeasure(precision, recall)
+
+        lcs = _lcs_lengths(refs, [hyps[owner] for owner in ref_owner])
+        has_tokens = (ref_lens > 0) & (hyp_lens[ref_owner] > 0)
+        precision = np.where(has_tokens, lcs / np.maximum(hyp_lens[ref_owner], 1), 0.)
+        recall = np.where(has_tokens, lcs / np.maximum(ref_lens, 1), 0.)
+        fmeasures['rougeL'] = _fmeasure(precision, recall)
+
+        return {rouge_type: np.bincount(ref_owner, weights=fmeasures[rouge_type], minlength=num_segments)
+                            / refs_per_segment
+                for rouge_type in ROUGE_TYPES}
+
+
+def _count_ngrams(sequences: List[np.ndarray], n: int) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray, int]]:
+    """
+        Counts the 1..n-grams of all sequences at once.
+        N-grams are interned into dense ids order by order: the k-gram starting at i is identified
+        by the pair (id of the (k-1)-gram at i, token at i + k - 1).
+        :return: for each order, (sequence ids, n-gram ids, counts, number of distinct n-grams)
+    """
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    tokens = np.concatenate(sequences) if len(sequences) > 0 else np.zeros(0, dtype=np.int64)
+    seq_of_token = np.repeat(np.arange(len(sequences)), lengths)
+    remaining = lengths[seq_of_token] - (np.arange(len(tokens)) - np.repeat(np.cumsum(lengths) - lengths, lengths))
+
+    vocab_size = int(tokens.max()) + 1 if len(tokens) > 0 else 1
+    gram_ids = tokens
+    num_grams = vocab_size
+    counts = []
+    for k in range(1, n + 1):
+        if k > 1:
+            valid = remaining >= k
+            starts = np.nonzero(valid)[0]
+            pair_keys = gram_ids[starts] * vocab_size + tokens[starts + k - 1]
+            unique_keys, inverse = np.unique(pair_keys, return_inverse=True)
+            gram_ids = np.full(len(tokens), -1, dtype=np.int64)
+            gram_ids[starts] = inverse
+            num_grams = max(len(unique_keys), 1)
+        starts = np.nonzero(remaining >= k)[0]
+        keys, key_counts = np.unique(seq_of_token[starts] * num_grams + gram_ids[starts], return_counts=True)
+        counts.append((keys // num_grams, keys % num_grams, key_counts, num_grams))
+    return counts
+
+
+def _group_max(keys: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    order = np.lexsort((values, keys))
+    keys = keys[order]
+    values = values[order]
+    last_of_group = np.r_[keys[1:] != keys[:-1], True] if len(keys) > 0 else np.zeros(0, dtype=bool)
+    return keys[last_of_group], values[last_of_group]
+
+
+def _lookup(sorted_keys: np.ndarray, values: np.ndarray, queries: np.ndarray) -> np.ndarray:
+    if len(sorted_keys) == 0:
+        return np.zeros(len(queries), dtype=values.dtype)
+    positions = np.minimum(np.searchsorted(sorted_keys, queries), len(sorted_keys) - 1)
+    return np.where(sorted_keys[positions] == queries, values[positions], 0)
+
+
+def _fmeasure(precision: np.ndarray, recall: np.ndarray) -> np.ndarray:
+    denominator = precision + recall
+    return np.where(denominator > 0, 2 * precision * recall / np.where(denominator > 0, denominator, 1), 0.)
+
+
+def _lcs_lengths(targets: List[np.ndarray], predictions: List[np.ndarray]) -> np.ndarray:
+    """
+        LCS length of each (target, prediction) pair, one DP row per target position for all pairs at once.
+        The row update curr[j] = prev[j-1] + 1 if match else max(prev[j], curr[j-1]) is a running
+        maximum, because a row never exceeds the previous one by more than one.
+    """
+    lcs = np.zeros(len(targets), dtype=np.int64)
+    for start in range(0, len(targets), LCS_CHUNK_SIZE):
+        chunk_targets = targets[start:start + LCS_CHUNK_SIZE]
+        chunk_predictions = predictions[start:start + LCS_CHUNK_SIZE]
+        target_lens = np.array([len(target) for target in chunk_targets], dtype=np.int64)
+        prediction_lens = np.array([len(prediction) for prediction in chunk_predictions], dtype=np.int64)
+        if target_lens.max() == 0 or prediction_lens.max() == 0:
+            continue
+        # padding never matches, and rows past the end of a target leave the DP row unchanged
+        padded_targets = np.full((len(chunk_targets), target_lens.max()), -1, dtype=np.int64)
+        padded_predictions = np.full((len(chunk_predictions), prediction_lens.max()), -2, dtype=np.int64)
+        for i, (target, prediction) in enumerate(zip(chunk_targets, chunk_predictions)):
+            padded_targets[i, :len(target)] = target
+            padded_predictions[i, :len(prediction)] = prediction
+
+        row = np.zeros((len(chunk_targets), prediction_lens.max() + 1), dtype=np.int64)
+        for i in range(target_lens.max()):
+            match = padded_targets[:, i:i + 1] == padded_predictions
+            candidates = np.where(match, row[:, :-1] + 1, row[:, 1:])
+            row[:, 1:] = np.maximum.accumulate(candidates, axis=1)
+        lcs[start:start + len(chunk_targets)] = row[np.arange(len(chunk_targets)), prediction_lens]
+    return lcs
+
+
+if __name__ == '__main__':
+    # parity check against pycocoevalcap / rouge_score on a reference and prediction file
+    from evaluation import ModelEvaulator, load_prediction_data, load_reference_data
+
+    parser = argparse.ArgumentParser(description='Check the vectorized backend against the reference metrics')
+    parser.add_argument('--reference-path', type=str, required=True)
+    parser.add_argument('--prediction-path', type=str, required=True)
+    parser.add_argument('--tolerance', type=float, default=1e-6,
+                        help='Maximum allowed absolute difference (in points, i.e. x100)')
+    args = parser.parse_args()
+
+    prediction_per_question = load_prediction_data(args.prediction_path)
+    reference_per_question = load_reference_data(args.reference_path)
+    questions = []
+    for question_id, prediction in prediction_per_question.items():
+        reference = reference_per_question[question_id]
+        questions.append((prediction['answer_judgment'],
+                          prediction['answer_explanation'].strip(),
+                          reference['answer_judgment'],
+                          reference['answer_explanation']))
+
+    metrics = ["bleu1", "bleu2", "bleu3", "bleu4", "rouge1", "rouge2", "rougeL"]
+    expected = ModelEvaulator(metrics).evaluate_batch(questions)
+    actual = ModelEvaulator(metrics, backend='vectorized').evaluate_batch(questions)
+
+    failed = False
+    for metric in metrics:
+        max_diff = max(abs(e[metric] - a[metric]) for e, a in zip(expected, actual))
+        print(f'{metric}: max abs diff {max_diff:.3g}')
+        failed = failed or max_diff > args.tolerance
+    if failed:
+        raise SystemExit('vectorized backend does not match the reference metrics')
+    print('parity check passed')